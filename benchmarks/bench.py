@@ -0,0 +1,166 @@
+"""
+Offline benchmark of the download paths against FakeServers.
+
+Each (target, concurrency) run happens in a fresh process, so its peak RSS
+is its own, while the fake Bing and origins run in this one. Run from the
+repository root:
+
+    python -m benchmarks.bench --images 500 --concurrency 1 8 32 --latency 0.05
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+from benchmarks.servers import FakeServers
+
+TARGETS = ('downloader', 'bing', 'helperdownload')
+
+Result = namedtuple('Result', ['target', 'concurrency', 'images', 'files', 'failures', 'seconds',
+                               'images_per_second', 'p50', 'p99', 'peak_rss_mb'])
+
+
+def _metrics():
+    from better_bing_image_downloader.metrics import Metrics
+
+    class RecordingMetrics(Metrics):
+        """ Metrics that also keep every per-request latency, for exact percentiles. """
+
+        def __init__(self):
+            super(RecordingMetrics, self).__init__()
+            self.latencies = []
+
+        def observe_host(self, host, seconds):
+            super(RecordingMetrics, self).observe_host(host, seconds)
+            with self._lock:
+                self.latencies.append(seconds)
+
+    return RecordingMetrics()
+
+
+def _run_downloader(bing_url, urls, limit, concurrency, output_dir, metrics):
+    from better_bing_image_downloader import download
+
+    base_url, download.Bing.base_url = download.Bing.base_url, bing_url
+    try:
+        asyncio.run(download.downloader('bench', limit=limit, output_dir=output_dir, concurrency=concurrency,
+                                        per_host=concurrency, page_rate=None, resume=False, metrics=metrics))
+    finally:
+        download.Bing.base_url = base_url
+
+
+def _run_bing(bing_url, urls, limit, concurrency, output_dir, metrics):
+    from better_bing_image_downloader.bing import Bing
+
+    bing = Bing('bench', limit, output_dir, 'on', 30, metrics=metrics)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(bing.download_image, urls))
+
+
+def _run_helperdownload(bing_url, urls, limit, concurrency, output_dir, metrics):
+    from better_bing_image_downloader import helperdownload
+
+    helperdownload.download_images(urls[:limit], output_dir, concurrency=concurrency, per_host=concurrency,
+                                   metrics=metrics)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def count_files(directory):
+    """ Images actually on disk, leaving out hidden bookkeeping files. """
+    return sum(1 for _, _, names in os.walk(directory) for name in names if not name.startswith('.'))
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1024
+
+
+def run_one(target, concurrency, bing_url, urls, limit):
+    """ Run one target once in this process and return its Result. """
+    run = globals()['_run_' + target]
+    metrics = _metrics()
+    output_dir = tempfile.mkdtemp(prefix='bench-')
+    logging.disable(logging.CRITICAL)
+    try:
+        start = time.monotonic()
+        run(bing_url, urls, limit, concurrency, output_dir, metrics)
+        seconds = time.monotonic() - start
+        files = count_files(output_dir)
+    finally:
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(output_dir, ignore_errors=True)
+    stats = metrics.stats()
+    return Result(target, concurrency, stats.images, files, sum(stats.failures.values()), seconds,
+                  stats.images / seconds, percentile(metrics.latencies, 0.5),
+                  percentile(metrics.latencies, 0.99), peak_rss_mb())
+
+
+def run_isolated(target, concurrency, bing_url, urls, limit):
+    """ run_one in a fresh spawned process. """
+    context = multiprocessing.get_context('spawn')
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_one, target, concurrency, bing_url, urls, limit).result()
+
+
+HEADER = '{:<15} {:>5} {:>7} {:>6} {:>6} {:>8} {:>9} {:>8} {:>8} {:>8}'.format(
+    'target', 'conc', 'images', 'files', 'fail', 'seconds', 'images/s', 'p50 ms', 'p99 ms', 'rss MB')
+
+
+def format_row(r):
+    return '{:<15} {:>5} {:>7} {:>6} {:>6} {:>8.2f} {:>9.1f} {:>8} {:>8} {:>8.1f}'.format(
+        r.target, r.concurrency, r.images, r.files, r.failures, r.seconds, r.images_per_second,
+        '-' if r.p50 is None else '%.1f' % (r.p50 * 1000), '-' if r.p99 is None else '%.1f' % (r.p99 * 1000),
+        r.peak_rss_mb)
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the downloaders against a local fake Bing.')
+    parser.add_argument('--images', type=int, default=300, help='Images to download per run.')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='Concurrency levels.')
+    parser.add_argument('--targets', nargs='+', default=list(TARGETS), choices=TARGETS, help='Paths to drive.')
+    parser.add_argument('--hosts', type=int, default=4, help='Number of image origins.')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds before each image response.')
+    parser.add_argument('--bandwidth', type=int, default=None, help='Bytes per second of each image response.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of images answered with a 500.')
+    parser.add_argument('--slow-hosts', type=int, default=0, help='Number of origins that are slower.')
+    parser.add_argument('--slow-factor', type=float, default=10.0, help='How much slower the slow origins are.')
+    parser.add_argument('--duplicates', type=float, default=0.0, help='Fraction of result urls that repeat.')
+    parser.add_argument('--image-bytes', type=int, default=32 * 1024, help='Size of each image.')
+    parser.add_argument('--json', type=str, default=None, help='Also write the results to this JSON file.')
+    args = parser.parse_args(argv)
+
+    # Leave room for failures and duplicates so every run can reach --images.
+    total = int(args.images / max(0.05, 1 - args.error_rate - args.duplicates)) + 1
+    results = []
+    print(HEADER)
+    with FakeServers(total, args.hosts, args.latency, args.bandwidth, args.error_rate, args.slow_hosts,
+                     args.slow_factor, args.duplicates, args.image_bytes) as servers:
+        for target in args.targets:
+            for concurrency in args.concurrency:
+                results.append(run_isolated(target, concurrency, servers.bing_url, servers.image_urls,
+                                            args.images))
+                print(format_row(results[-1]), flush=True)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump([r._asdict() for r in results], f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,159 @@
+""" Local stand-ins for Bing's result pages and for the image origins they point to. """
+
+import asyncio
+import random
+import threading
+
+from aiohttp import web
+
+PAGE_SIZE = 35
+CHUNK = 16 * 1024
+
+
+class FakeServers(object):
+    """
+    A fake Bing serving ``/images/async?q=&first=&count=`` pages in the
+    ``murl&quot;`` format, and ``hosts`` image origins on 127.0.0.1,
+    127.0.0.2, ... (separate loopback addresses, so the downloaders see
+    separate hosts), all run by one event loop in a background thread.
+
+    The results are ``images`` image urls spread over the hosts in turn.
+    ``duplicates`` of them (a fraction) repeat an earlier url. Every image
+    is a distinct ``image_bytes`` JPEG-looking body.
+
+    Origin knobs:
+    - ``latency`` is the seconds before response headers.
+    - ``bandwidth`` is the bytes per second of each response body (None for
+      as fast as possible).
+    - ``error_rate`` is the fraction of images answered with a 500, chosen
+      from ``seed`` so runs are comparable.
+    - The first ``slow_hosts`` hosts are ``slow_factor`` times slower in both
+      latency and bandwidth.
+    """
+
+    def __init__(self, images=300, hosts=4, latency=0.0, bandwidth=None, error_rate=0.0, slow_hosts=0,
+                 slow_factor=10.0, duplicates=0.0, image_bytes=32 * 1024, seed=0):
+        self.images = images
+        self.hosts = hosts
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.slow_hosts = slow_hosts
+        self.slow_factor = slow_factor
+        self.duplicates = duplicates
+        self.image_bytes = image_bytes
+        self.seed = seed
+        self.requests = 0
+        size = max(image_bytes, 32)
+        self._padding = random.Random(seed).getrandbits(8 * size).to_bytes(size, 'little')
+        rng = random.Random(seed)
+        self._failing = {i for i in range(images) if rng.random() < error_rate}
+        self._loop = None
+        self._runners = []
+        self._thread = None
+        self.image_urls = []
+        self.bing_url = None
+
+    def body(self, index):
+        return b'\xff\xd8\xff\xe0' + b'%012d' % index + self._padding[16:self.image_bytes]
+
+    async def _page(self, request):
+        first = int(request.query.get('first', 0))
+        count = min(int(request.query.get('count', PAGE_SIZE)), PAGE_SIZE)
+        urls = self.image_urls[first:first + count]
+        return web.Response(text=''.join('<a class="thumb" m="murl&quot;:&quot;%s&quot;"></a>' % url
+                                         for url in urls), content_type='text/html')
+
+    async def _image(self, request, slow):
+        self.requests += 1
+        index = int(request.match_info['index'])
+        factor = self.slow_factor if slow else 1.0
+        if self.latency:
+            await asyncio.sleep(self.latency * factor)
+        if index in self._failing or index >= self.images:
+            return web.Response(status=500 if index in self._failing else 404)
+        body = self.body(index)
+        response = web.StreamResponse(headers={'Content-Type': 'image/jpeg', 'Content-Length': str(len(body))})
+        await response.prepare(request)
+        rate = self.bandwidth / factor if self.bandwidth else None
+        for offset in range(0, len(body), CHUNK):
+            chunk = body[offset:offset + CHUNK]
+            await response.write(chunk)
+            if rate:
+                await asyncio.sleep(len(chunk) / rate)
+        await response.write_eof()
+        return response
+
+    def _image_handler(self, slow):
+        async def handler(request):
+            return await self._image(request, slow)
+        return handler
+
+    async def _serve(self, app, address):
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, address, 0)
+        await site.start()
+        self._runners.append(runner)
+        return runner.addresses[0][1]
+
+    async def _start(self):
+        bing = web.Application()
+        bing.router.add_get('/images/async', self._page)
+        self.bing_url = 'http://127.0.0.1:%d' % await self._serve(bing, '127.0.0.1')
+        origins = []
+        for host in range(self.hosts):
+            app = web.Application()
+            app.router.add_get('/img/{index:\\d+}.jpg', self._image_handler(host < self.slow_hosts))
+            address = '127.0.0.%d' % (host + 1)
+            origins.append('http://%s:%d' % (address, await self._serve(app, address)))
+        rng = random.Random(self.seed + 1)
+        for i in range(self.images):
+            if i and rng.random() < self.duplicates:
+                self.image_urls.append(self.image_urls[rng.randrange(i)])
+            else:
+                self.image_urls.append('%s/img/%d.jpg' % (origins[i % self.hosts], i))
+
+    def start(self):
+        self._loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            ready.set()
+            self._loop.run_forever()
+
+        self._thread = threading.Thread(target=run, name='fake-servers', daemon=True)
+        self._thread.start()
+        ready.wait()
+        return self
+
+    def stop(self):
+        async def cleanup():
+            for runner in self._runners:
+                await runner.cleanup()
+
+        asyncio.run_coroutine_threadsafe(cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == '__main__':
+    import time
+
+    with FakeServers() as servers:
+        print('Fake Bing at %s (%d images on %d hosts); Ctrl-C to stop.' % (servers.bing_url, servers.images,
+                                                                             servers.hosts))
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
@@ -1,2 +1,3 @@
 from .bing import Bing
-from .download import downloader
\ No newline at end of file
+from .download import downloader, download_many
+from .processing import Transform
@@ -0,0 +1,164 @@
+""" Adaptive concurrency: the number of downloads run at once, resized from observed latency, timeouts and throughput. """
+
+import asyncio
+import contextlib
+import threading
+import time
+from collections import deque
+
+from .metrics import failure_cause
+
+# Failures that mean the other end is overloaded, rather than that the url is bad.
+OVERLOAD_CAUSES = ('timeout', 'connection', 'http_429', 'http_503')
+
+
+class _Controller(object):
+    """
+    AIMD limit on concurrent downloads. Every ``interval`` seconds (once
+    ``min_samples`` downloads have finished) the last ``window`` downloads
+    are looked at:
+
+    - when more than ``max_overload_rate`` of them timed out or were refused,
+      or their p95 latency is over ``latency_tolerance`` times the lowest p95
+      seen so far, the limit is multiplied by ``backoff``;
+    - otherwise, when every slot was in use and throughput in bytes per
+      second did not drop, the limit grows by one.
+
+    The lowest p95 creeps up by ``drift`` per interval, so a baseline taken
+    while the network was unusually fast is forgotten. The limit stays
+    between ``min_limit`` and ``max_limit``.
+    """
+
+    def __init__(self, min_limit=1, max_limit=64, initial=None, interval=2.0, window=200, min_samples=10,
+                 max_overload_rate=0.05, latency_tolerance=2.0, backoff=0.7, drift=0.05):
+        assert 0 < min_limit <= max_limit, "need 0 < min_limit <= max_limit"
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = min(max(initial or min_limit, min_limit), max_limit)
+        self.interval = interval
+        self.min_samples = min_samples
+        self.max_overload_rate = max_overload_rate
+        self.latency_tolerance = latency_tolerance
+        self.backoff = backoff
+        self.drift = drift
+        self.samples = deque(maxlen=window)
+        self.baseline = None
+        self.throughput = None
+        self.in_use = 0
+        self.peak = 0
+        self.bytes = 0
+        self.updated = time.monotonic()
+
+    def _observe(self, seconds, error, now):
+        self.samples.append((seconds, error is not None and failure_cause(error) in OVERLOAD_CAUSES))
+        if now - self.updated < self.interval or len(self.samples) < self.min_samples:
+            return False
+        latencies = sorted(seconds for seconds, _ in self.samples)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        overload_rate = sum(overloaded for _, overloaded in self.samples) / len(self.samples)
+        throughput = self.bytes / (now - self.updated)
+        if self.baseline is None:
+            self.baseline = p95
+        else:
+            self.baseline = min(p95, self.baseline * (1 + self.drift))
+        old = self.limit
+        if overload_rate > self.max_overload_rate or p95 > self.baseline * self.latency_tolerance:
+            self.limit = max(self.min_limit, int(self.limit * self.backoff))
+            # Judge the smaller limit on downloads made under it.
+            self.samples.clear()
+        elif self.peak >= self.limit and (self.throughput is None or throughput >= self.throughput * 0.9):
+            self.limit = min(self.max_limit, self.limit + 1)
+        self.throughput = throughput
+        self.bytes = 0
+        self.peak = self.in_use
+        self.updated = now
+        return self.limit > old
+
+    def _take(self):
+        self.in_use += 1
+        self.peak = max(self.peak, self.in_use)
+
+
+class AdaptiveLimit(_Controller):
+    """ Thread-safe adaptive limit for the requests based thread pool. """
+
+    def __init__(self, *args, **kwargs):
+        super(AdaptiveLimit, self).__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    def received(self, amount):
+        with self._cond:
+            self.bytes += amount
+
+    def observe(self, seconds, error=None, now=None):
+        """ Record one finished download: how long it took and the exception it failed with, if any. """
+        with self._cond:
+            if self._observe(seconds, error, time.monotonic() if now is None else now):
+                self._cond.notify_all()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_use >= self.limit:
+                self._cond.wait()
+            self._take()
+
+    def release(self):
+        with self._cond:
+            self.in_use -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self):
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+
+class AsyncAdaptiveLimit(_Controller):
+    """ Event loop flavour of AdaptiveLimit for the httpx workers. """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncAdaptiveLimit, self).__init__(*args, **kwargs)
+        self.waiters = deque()
+
+    def _grant(self):
+        while self.in_use < self.limit and self.waiters:
+            future = self.waiters.popleft()
+            if not future.done():
+                self._take()
+                future.set_result(None)
+
+    def received(self, amount):
+        self.bytes += amount
+
+    def observe(self, seconds, error=None, now=None):
+        """ Record one finished download: how long it took and the exception it failed with, if any. """
+        if self._observe(seconds, error, time.monotonic() if now is None else now):
+            self._grant()
+
+    async def acquire(self):
+        if self.in_use < self.limit and not self.waiters:
+            self._take()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._grant()
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
@@ -1,29 +1,63 @@
 import urllib.request
 import urllib
 import logging
+import os
+import threading
+import time
 import asyncio
+import contextlib
 import aiohttp
-import imghdr
 import posixpath
-import re
 from pathlib import Path
-from PIL import Image
-from io import BytesIO
+from .dedup import DuplicateImage, image_phash
+from .journal import DONE, DUPLICATE, FAILED
+from .metrics import DownloadEvent
+from .parser import parse_result_page
+from .processing import image_info, verify_image
+from .ratelimit import TokenBucket
+from .retry import HostUnavailable, RetryPolicy
+from .seen import FingerprintSet
+from .sniff import extension
+from .streaming import CHUNK_SIZE, PartFile, check_content_length
+
+
+class _RequestFailed(ValueError):
+    """ save_image returned None; the cause was already logged and counted. """
 
 
 class Bing:
-    def __init__(self, query, limit, output_dir, adult, timeout, filter='', verbose=False, badsites=[], name='Image'):
+    base_url = 'https://www.bing.com'
+
+    def __init__(self, query, limit, output_dir, adult, timeout, filter='', verbose=False, badsites=[], name='Image', max_bytes=None,
+                 page_rate=1.0, read_ahead=True, journal=None,
+                 dedup=None, cache=None, candidate_filter=None, verify=False, manifest=None,
+                 metrics=None, retry=None, seen=None):
         self.download_count = 0
         self.query = query
         self.output_dir = Path(output_dir)
         self.adult = adult
         self.filter = filter
         self.verbose = verbose
-        self.seen = set()
+        self.seen = seen if seen is not None else FingerprintSet()
         self.urls = []
         self.badsites = badsites
         self.image_name = name
+        self._stems = None
+        self._next_index = None
+        # download_image may be called from several threads at once.
+        self._lock = threading.Lock()
         self.download_callback = None
+        self.max_bytes = max_bytes
+        self.page_limiter = TokenBucket(page_rate)
+        self.read_ahead = read_ahead
+        self.journal = journal
+        self.dedup = dedup
+        self.cache = cache
+        self.candidate_filter = candidate_filter
+        self.verify = verify
+        self.manifest = manifest
+        self.metrics = metrics
+        self.retry = retry if retry is not None else RetryPolicy()
         
         if self.verbose:
             logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
@@ -39,6 +73,9 @@ class Bing:
         self.timeout = timeout
 
         self.page_counter = 0
+        if self.journal is not None:
+            self.page_counter = self.journal.page_counter
+            self.download_count = self.journal.done_count()
         self.headers = {
             'User-Agent': ('Mozilla/5.0 (X11; Linux x86_64) '
                            'AppleWebKit/537.11 (KHTML, like Gecko) '
@@ -62,32 +99,76 @@ class Bing:
         }
         return filters.get(shorthand, "")
 
-    def save_image(self, link, file_path) -> None:
+    def save_image(self, link, file_path):
+        """
+        Save link to file_path, with its extension corrected to the sniffed
+        format, and return ``(sha256 hex digest, saved path)``, or None when
+        the request failed. Failed requests are retried as self.retry says.
+        """
         try:
-            request = urllib.request.Request(link, None, self.headers)
-            image = urllib.request.urlopen(request, timeout=self.timeout).read()
-            try:
-                with Image.open(BytesIO(image)) as img:
-                    img.verify()
-            except (IOError, SyntaxError) as e:
-                logging.error('Invalid image, not saving %s: %s', link, e)
-                raise ValueError('Invalid image, not saving %s' % link)
-
-            with open(str(file_path), 'wb') as f:
-                f.write(image)
+            return self.retry.call(self._save_image, link, file_path,
+                                   host=urllib.parse.urlsplit(link).hostname, metrics=self.metrics)
 
         except urllib.error.HTTPError as e:
             logging.error('HTTPError while saving image %s: %s', link, e)
+            if self.metrics is not None:
+                self.metrics.failed(e)
 
         except urllib.error.URLError as e:
             logging.error('URLError while saving image %s: %s', link, e)
-        
+            if self.metrics is not None:
+                self.metrics.failed('connection')
 
-    def download_image(self, link):
-        if self.download_count >= self.limit:
-            return
-        
-        self.download_count += 1
+        except HostUnavailable as e:
+            logging.error('Skipping image %s: %s', link, e)
+            if self.metrics is not None:
+                self.metrics.failed(e)
+
+    def _save_image(self, link, file_path):
+        request = urllib.request.Request(link, None, self.headers)
+        start = time.monotonic()
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            headers_at = time.monotonic()
+            check_content_length(response.headers, self.max_bytes)
+            with PartFile(self.output_dir, self.max_bytes, require_image=True) as part:
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+                    part.write(chunk)
+                    if self.metrics is not None:
+                        self.metrics.received(len(chunk))
+                part.close()
+                downloaded_at = time.monotonic()
+                if self.metrics is not None:
+                    self.metrics.observe('response', headers_at - start)
+                    self.metrics.observe('transfer', downloaded_at - headers_at)
+                    self.metrics.observe_host(urllib.parse.urlsplit(link).hostname, downloaded_at - start)
+                if self.verify:
+                    try:
+                        verify_image(part.path)
+                    except ValueError as e:
+                        logging.error('Invalid image, not saving %s: %s', link, e)
+                        raise ValueError('Invalid image, not saving %s' % link)
+                file_path = Path(file_path)
+                file_path = file_path.with_suffix('.' + extension(part.format, file_path.suffix[1:]))
+                sha256 = part.sha256.hexdigest()
+                if self.dedup is not None:
+                    phash = image_phash(part.path) if self.dedup.phash_distance is not None else None
+                    if not self.dedup.add(sha256, file_path, phash):
+                        raise DuplicateImage('Duplicate image, not saving %s' % link)
+                part.commit(file_path)
+                if self.metrics is not None:
+                    self.metrics.observe('write', time.monotonic() - downloaded_at)
+                return sha256, file_path
+
+    def download_image(self, link, page_url=None):
+        with self._lock:
+            if self.download_count >= self.limit:
+                return
+            if self._next_index is None:
+                self._next_index = self.download_count + 1
+            self.download_count += 1
+        index = None
+        started_at = time.time()
+        start = time.monotonic()
         try:
             path = urllib.parse.urlsplit(link).path
             filename = posixpath.basename(path).split('?')[0]
@@ -98,60 +179,190 @@ class Bing:
             if self.verbose:
                 logging.info("[%] Downloading Image #{} from {}".format(self.download_count, link))
 
-            self.save_image(link, self.output_dir.joinpath("{}_{}.{}".format(self.image_name, str(self.download_count), file_type)))
+            index = self._reserve_index()
+            file_path = self.output_dir.joinpath("{}_{}.{}".format(self.image_name, index, file_type))
+            saved = self.save_image(link, file_path)
+            if saved is None:
+                raise _RequestFailed('Request failed')
+            sha256, file_path = saved
+            if self.journal is not None:
+                self.journal.record(link, DONE, file_path, sha256)
+            if self.manifest is not None:
+                fmt, width, height = image_info(file_path)
+                self.manifest.add(query=self.query, url=link, page_url=page_url, path=file_path,
+                                  bytes=os.path.getsize(file_path), format=fmt, width=width, height=height,
+                                  sha256=sha256, started_at=started_at,
+                                  download_seconds=time.monotonic() - start)
 
             if self.verbose:
                 logging.info("[%] File Downloaded !\n")
-                
-            if self.download_callback:
-                self.download_callback(self.download_count)
+
+            if self.metrics is not None:
+                self.metrics.saved()
+            self._report(link, DONE, start, file_path, os.path.getsize(file_path))
+
+        except DuplicateImage as e:
+            self._unreserve(index)
+            if self.journal is not None:
+                self.journal.record(link, DUPLICATE)
+            if self.metrics is not None:
+                self.metrics.duplicate()
+            self._report(link, DUPLICATE, start)
+            logging.info('%s', e)
 
         except Exception as e:
-            self.download_count -= 1
+            self._unreserve(index)
+            if self.journal is not None:
+                self.journal.record(link, FAILED)
+            if self.metrics is not None and not isinstance(e, _RequestFailed):
+                self.metrics.failed(e)
+            self._report(link, FAILED, start, error=e)
             logging.error('Issue getting: %s\nError: %s', link, e)
 
-    async def get_image_urls(self):
-        while self.download_count < self.limit:
-            if self.verbose:
-                logging.info('\n\n[!] Indexing page: %d\n', self.page_counter + 1)
-            
+    def _reserve_index(self):
+        """
+        Claim the first number past those already saved whose name no file in
+        output_dir and no download in progress has, so that neither a run
+        without a journal nor a concurrent download_image overwrites an image.
+        """
+        with self._lock:
+            if self._stems is None:
+                names = os.listdir(self.output_dir) if self.output_dir.is_dir() else []
+                self._stems = {os.path.splitext(name)[0] for name in names}
+            index = self._next_index
+            while "{}_{}".format(self.image_name, index) in self._stems:
+                index += 1
+            self._stems.add("{}_{}".format(self.image_name, index))
+            self._next_index = index + 1
+            return index
+
+    def _unreserve(self, index):
+        """ Give back the count, and the number if one was claimed, of a download that saved nothing. """
+        with self._lock:
+            self.download_count -= 1
+            if index is not None:
+                self._stems.discard("{}_{}".format(self.image_name, index))
+                self._next_index = min(self._next_index, index)
+
+    def _report(self, link, status, start, path=None, size=0, error=None):
+        if self.download_callback:
+            self.download_callback(DownloadEvent(self.query, link, status, path, size, time.monotonic() - start,
+                                                 self.download_count, error))
+
+    def get_page_url(self, page):
+        return (
+            self.base_url + '/images/async?q='
+            + urllib.parse.quote_plus(self.query)
+            + '&first=' + str(page)
+            + '&count=' + str(self.limit)
+            + '&adlt=' + self.adult
+            + '&qft=' + ('' if self.filter is None else self.get_filter(self.filter))
+        )
+
+    async def fetch_page(self, session, page):
+        request_url = self.get_page_url(page)
+        if self.cache is not None:
+            html = self.cache.get(request_url)
+            if html is not None:
+                return html
+        await self.page_limiter.acquire_async()
+        start = time.monotonic()
+        async with session.get(request_url, headers=self.headers) as response:
+            if response.status >= 400:
+                response.raise_for_status()
+            html = await response.text()
+            if self.metrics is not None:
+                self.metrics.observe('page', time.monotonic() - start)
+            if self.cache is not None and response.status == 200:
+                self.cache.set(request_url, html)
+            return html
+
+    async def get_image_urls(self, session=None):
+        """ Yield the url of every candidate from get_image_candidates. """
+        async for candidate in self.get_image_candidates(session):
+            yield candidate.url
+
+    async def get_image_candidates(self, session=None):
+        """
+        Yield an ImageCandidate per result, page by page over a single session,
+        either the one given or one opened for the crawl. Candidates rejected
+        by candidate_filter are dropped before anything is downloaded. With
+        read_ahead, the next page is requested while links from the current
+        one are being consumed, so pagination overlaps with the downloads.
+        A page that fails is requested again as self.retry says; when it
+        cannot be fetched the crawl ends there.
+        """
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        next_page = None
+        failures = 0
+        async with contextlib.AsyncExitStack() as stack:
+            if session is None:
+                session = await stack.enter_async_context(aiohttp.ClientSession(timeout=timeout))
             try:
-                request_url = (
-                    'https://www.bing.com/images/async?q='
-                    + urllib.parse.quote_plus(self.query)
-                    + '&first=' + str(self.page_counter)
-                    + '&count=' + str(self.limit)
-                    + '&adlt=' + self.adult
-                    + '&qft=' + ('' if self.filter is None else self.get_filter(self.filter))
-                )
-                
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(request_url, headers=self.headers) as response:
-                        html = await response.text()
-
-                if html == "":
-                    logging.info("[%] No more images are available")
-                    break
-                
-                links = re.findall('murl&quot;:&quot;(.*?)&quot;', html)
-                
-                if self.verbose:
-                    logging.info("[%%] Indexed %d Images on Page %d.", len(links), self.page_counter + 1)
-                    logging.info("\n===============================================\n")
-
-                for link in links:
-                    if any(badsite in link for badsite in self.badsites):
-                        if self.verbose:
-                            logging.info("[!] Link included in badsites: %s", link)
+                while self.download_count < self.limit:
+                    if self.verbose:
+                        logging.info('\n\n[!] Indexing page: %d\n', self.page_counter + 1)
+
+                    try:
+                        if next_page is not None:
+                            html = await next_page
+                        else:
+                            html = await self.fetch_page(session, self.page_counter)
+                    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                        failures += 1
+                        if failures >= self.retry.attempts or not self.retry.retryable(e):
+                            logging.error('ClientError while making request to Bing, giving up: %s', e)
+                            if self.metrics is not None:
+                                self.metrics.failed(e)
+                            break
+                        logging.error('ClientError while making request to Bing: %s', e)
+                        if self.metrics is not None:
+                            self.metrics.retry()
+                        await asyncio.sleep(self.retry.delay(failures, e))
                         continue
+                    finally:
+                        next_page = None
+                    failures = 0
+
+                    if html == "":
+                        logging.info("[%] No more images are available")
+                        break
+
+                    if self.journal is not None:
+                        self.journal.checkpoint(self.page_counter)
+
+                    if self.read_ahead:
+                        next_page = asyncio.ensure_future(self.fetch_page(session, self.page_counter + 1))
+
+                    candidates = list(parse_result_page(html))
+
+                    if self.verbose:
+                        logging.info("[%%] Indexed %d Images on Page %d.", len(candidates), self.page_counter + 1)
+                        logging.info("\n===============================================\n")
+
+                    for candidate in candidates:
+                        link = candidate.url
+                        if any(badsite in link for badsite in self.badsites):
+                            if self.verbose:
+                                logging.info("[!] Link included in badsites: %s", link)
+                            continue
+
+                        if self.journal is not None and self.journal.is_done(link):
+                            continue
+
+                        if self.candidate_filter and not self.candidate_filter.accepts(candidate):
+                            if self.verbose:
+                                logging.info("[!] Link rejected by filter: %s", link)
+                            continue
 
-                    if self.download_count < self.limit and link not in self.seen:
-                        self.seen.add(link)
-                        yield link
+                        if self.download_count < self.limit and link not in self.seen:
+                            self.seen.add(link)
+                            yield candidate
 
-                self.page_counter += 1
-                await asyncio.sleep(1)
-            except aiohttp.ClientError as e:
-                logging.error('ClientError while making request to Bing: %s', e)
+                    self.page_counter += 1
+            finally:
+                if next_page is not None:
+                    next_page.cancel()
+                    await asyncio.gather(next_page, return_exceptions=True)
 
         logging.info("\n\n[%%] Done. Downloaded %d images.", self.download_count)
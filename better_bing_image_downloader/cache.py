@@ -0,0 +1,130 @@
+""" On-disk cache of Bing result pages, so repeated crawls of a query skip the network. """
+
+import abc
+import hashlib
+import os
+import struct
+import threading
+import time
+import zlib
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+_HEADER = struct.Struct('<d')
+
+
+def normalize_url(url):
+    """
+    Canonical form of a request url used as the cache key: lower-cased scheme
+    and host, query parameters sorted. Parameters such as adlt and qft are part
+    of the query, so pages fetched with other filter settings never collide.
+    """
+    parts = urlsplit(url)
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', query, ''))
+
+
+class PageCache(abc.ABC):
+    """
+    Interface for result page caches. get() returns the cached page text or
+    None; set() stores it. Implementations must be safe to call from threads.
+    """
+
+    @abc.abstractmethod
+    def get(self, url):
+        pass
+
+    @abc.abstractmethod
+    def set(self, url, text):
+        pass
+
+
+class DiskCache(PageCache):
+    """
+    One zlib-compressed file per page under ``directory``. Entries older than
+    ``ttl`` seconds are treated as missing; once the cache grows past
+    ``max_bytes`` the least recently used entries are evicted. A file's mtime
+    is its last use, the creation time is stored in its header.
+    """
+
+    def __init__(self, directory, ttl=24 * 3600, max_bytes=256 * 1024 * 1024):
+        self.directory = str(directory)
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+
+    def path(self, url):
+        key = hashlib.sha256(normalize_url(url).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, key + '.z')
+
+    def get(self, url):
+        path = self.path(url)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None
+        try:
+            (created,) = _HEADER.unpack_from(data)
+            text = zlib.decompress(data[_HEADER.size:]).decode('utf-8')
+        except (struct.error, zlib.error, UnicodeDecodeError):
+            # Truncated or corrupt entry: a miss, and the page is fetched again.
+            self._remove(path)
+            return None
+        if self.ttl is not None and time.time() - created > self.ttl:
+            self._remove(path)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return text
+
+    def set(self, url, text):
+        path = self.path(url)
+        data = _HEADER.pack(time.time()) + zlib.compress(text.encode('utf-8'))
+        tmp_path = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        with self._lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self.size += len(data) - old_size
+        if self.max_bytes is not None:
+            self.evict()
+
+    def _remove(self, path):
+        with self._lock:
+            self._remove_locked(path)
+
+    def _remove_locked(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        self.size -= size
+
+    def evict(self):
+        """ Remove least recently used entries until the cache fits in max_bytes. """
+        with self._lock:
+            if self.max_bytes is None or self.size <= self.max_bytes:
+                return
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith('.z'):
+                    try:
+                        entries.append((entry.stat().st_mtime, entry.path))
+                    except OSError:
+                        pass
+            for _, path in sorted(entries):
+                if self.size <= self.max_bytes:
+                    break
+                self._remove_locked(path)
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.z'):
+                self._remove(entry.path)
@@ -6,19 +6,21 @@
 from __future__ import print_function
 
 import re
-import time
 import sys
 import os
-import json
-import shutil
+import itertools
+import collections
 
 from urllib.parse import unquote, quote
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
+from selenium.common.exceptions import TimeoutException
+from selenium.webdriver.support.ui import WebDriverWait
 import requests
 from concurrent import futures
 
+from .driverpool import make_driver
+from .helperdownload import make_session
+from .parser import parse_result_page
+
 g_headers = {
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
     "Proxy-Connection": "keep-alive",
@@ -69,67 +71,98 @@ def google_gen_query_url(keywords, face_only=False, safe_mode=False, image_type=
     return query_url
 
 
-def google_image_url_from_webpage(driver, max_number, quiet=False):
-    thumb_elements_old = []
-    thumb_elements = []
-    while True:
-        try:
-            thumb_elements = driver.find_elements(By.CLASS_NAME, "rg_i")
-            my_print("Find {} images.".format(len(thumb_elements)), quiet)
-            if len(thumb_elements) >= max_number:
+# Scripts run in the browser, so each step of a crawl is one WebDriver round trip
+# however many images are on the page.
+_COUNT_SCRIPT = "return document.querySelectorAll(arguments[0]).length;"
+
+_SCROLL_SCRIPT = "window.scrollTo(0, document.body.scrollHeight);"
+
+# Click the first visible, enabled element matching arguments[0]; true if there was one.
+_CLICK_SCRIPT = """
+var els = document.querySelectorAll(arguments[0]);
+for (var i = 0; i < els.length; i++) {
+    if (els[i].offsetParent !== null && !els[i].disabled) { els[i].click(); return true; }
+}
+return false;
+"""
+
+# Media urls of the Bing results from index arguments[0] on, then scroll for more.
+_BING_COLLECT_SCRIPT = """
+var els = document.querySelectorAll('.iusc');
+var urls = [];
+for (var i = arguments[0]; i < els.length; i++) {
+    try { urls.push(JSON.parse(els[i].getAttribute('m')).murl); } catch (e) { urls.push(null); }
+}
+window.scrollTo(0, document.body.scrollHeight);
+return urls;
+"""
+
+# Press every Google thumbnail up to arguments[0], which fills in the imgurl of its link.
+_GOOGLE_CLICK_SCRIPT = """
+var els = document.querySelectorAll('.rg_i');
+for (var i = 0; i < els.length && i < arguments[0]; i++) {
+    try {
+        els[i].dispatchEvent(new MouseEvent('mousedown', {bubbles: true}));
+        els[i].click();
+    } catch (e) {}
+}
+"""
+
+_GOOGLE_HREFS_SCRIPT = """
+return Array.prototype.slice.call(document.querySelectorAll('.islib'), 0, arguments[0]).map(
+    function (e) { return e.getAttribute('href') || ''; });
+"""
+
+
+def _count(driver, selector):
+    return driver.execute_script(_COUNT_SCRIPT, selector)
+
+
+def _wait_for_count(driver, selector, count, timeout):
+    """ Wait until more than ``count`` elements match selector; False if that has not happened in time. """
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=0.1).until(lambda d: _count(d, selector) > count)
+        return True
+    except TimeoutException:
+        return False
+
+
+def google_image_url_from_webpage(driver, max_number, quiet=False, stream=False, timeout=10, scroll_timeout=3):
+    """
+    Image urls on a Google result page; a generator over them with ``stream``.
+    Waits up to ``timeout`` seconds for the first results and up to
+    ``scroll_timeout`` for more after each scroll.
+    """
+    urls = _google_image_urls(driver, max_number, quiet, timeout, scroll_timeout)
+    return urls if stream else list(urls)
+
+
+def _google_image_urls(driver, max_number, quiet=False, timeout=10, scroll_timeout=3):
+    if not _wait_for_count(driver, ".rg_i", 0, timeout):
+        return
+    count = _count(driver, ".rg_i")
+    while count < max_number:
+        my_print("Find {} images.".format(count), quiet)
+        driver.execute_script(_SCROLL_SCRIPT)
+        if not _wait_for_count(driver, ".rg_i", count, scroll_timeout):
+            if not driver.execute_script(_CLICK_SCRIPT, ".mye4qd"):
                 break
-            if len(thumb_elements) == len(thumb_elements_old):
+            my_print("Click show_more button.", quiet)
+            if not _wait_for_count(driver, ".rg_i", count, scroll_timeout):
                 break
-            thumb_elements_old = thumb_elements
-            driver.execute_script("window.scrollTo(0, document.body.scrollHeight);")
-            time.sleep(2)
-            show_more = driver.find_elements(By.CLASS_NAME, "mye4qd")
-            if len(show_more) == 1 and show_more[0].is_displayed() and show_more[0].is_enabled():
-                my_print("Click show_more button.", quiet)
-                show_more[0].click()
-            time.sleep(3)
-        except Exception as e:
-            print("Exception ", e)
-            pass
-    
-    if len(thumb_elements) == 0:
-        return []
+        count = _count(driver, ".rg_i")
+    my_print("Find {} images.".format(count), quiet)
 
     my_print("Click on each thumbnail image to get image url, may take a moment ...", quiet)
+    driver.execute_script(_GOOGLE_CLICK_SCRIPT, max_number)
+    # Links get their imgurl as the clicks are handled.
+    _wait_for_count(driver, '.islib[href*="imgurl="]', min(count, max_number) - 1, scroll_timeout)
 
-    retry_click = []
-    for i, elem in enumerate(thumb_elements):
-        try:
-            if i != 0 and i % 50 == 0:
-                my_print("{} thumbnail clicked.".format(i), quiet)
-            if not elem.is_displayed() or not elem.is_enabled():
-                retry_click.append(elem)
-                continue
-            elem.click()
-        except Exception as e:
-            print("Error while clicking in thumbnail:", e)
-            retry_click.append(elem)
-
-    if len(retry_click) > 0:    
-        my_print("Retry some failed clicks ...", quiet)
-        for elem in retry_click:
-            try:
-                if elem.is_displayed() and elem.is_enabled():
-                    elem.click()
-            except Exception as e:
-                print("Error while retrying click:", e)
-    
-    image_elements = driver.find_elements(By.CLASS_NAME, "islib")
-    image_urls = list()
-    url_pattern = r"imgurl=\S*&amp;imgrefurl"
-
-    for image_element in image_elements[:max_number]:
-        outer_html = image_element.get_attribute("outerHTML")
-        re_group = re.search(url_pattern, outer_html)
+    url_pattern = r"imgurl=([^&]*)&imgrefurl"
+    for href in driver.execute_script(_GOOGLE_HREFS_SCRIPT, max_number):
+        re_group = re.search(url_pattern, href)
         if re_group is not None:
-            image_url = unquote(re_group.group()[7:-14])
-            image_urls.append(image_url)
-    return image_urls
+            yield unquote(re_group.group(1))
 
 
 def bing_gen_query_url(keywords, face_only=False, safe_mode=False, image_type=None, color=None):
@@ -154,53 +187,133 @@ def bing_gen_query_url(keywords, face_only=False, safe_mode=False, image_type=No
     return query_url
 
 
-def bing_image_url_from_webpage(driver):
-    image_urls = list()
+def bing_image_url_from_webpage(driver, stream=False, timeout=10, scroll_timeout=3):
+    """
+    Image urls on a Bing result page, scrolling for more until there are
+    none. With ``stream``, a generator yielding the urls of each batch as
+    soon as it has loaded, so they can be downloaded while scrolling goes on.
+    Waits up to ``timeout`` seconds for the first results and up to
+    ``scroll_timeout`` for more after each scroll.
+    """
+    urls = _bing_image_urls(driver, timeout, scroll_timeout)
+    return urls if stream else list(urls)
+
 
-    time.sleep(7)
+def _bing_image_urls(driver, timeout=10, scroll_timeout=3):
+    if not _wait_for_count(driver, ".iusc", 0, timeout):
+        return
     img_count = 0
 
     while True:
-        image_elements = driver.find_elements(By.CLASS_NAME, "iusc")
-        if len(image_elements) > img_count:
-            img_count = len(image_elements)
-            driver.execute_script(
-                "window.scrollTo(0, document.body.scrollHeight);")
-        else:
-            smb = driver.find_elements(By.CLASS_NAME, "btn_seemore")
-            if len(smb) > 0 and smb[0].is_displayed():
-                smb[0].click()
-            else:
+        # One round trip reads the new results and scrolls, so the next batch
+        # loads while this one is consumed.
+        new_urls = driver.execute_script(_BING_COLLECT_SCRIPT, img_count)
+        img_count += len(new_urls)
+        yield from (url for url in new_urls if url)
+        if not _wait_for_count(driver, ".iusc", img_count, scroll_timeout):
+            if not driver.execute_script(_CLICK_SCRIPT, ".btn_seemore"):
                 break
-        time.sleep(2)
-    for image_element in image_elements:
-        m_json_str = image_element.get_attribute("m")
-        m_json = json.loads(m_json_str)
-        image_urls.append(m_json["murl"])
-    return image_urls
+            if not _wait_for_count(driver, ".iusc", img_count, scroll_timeout):
+                break
+
+
+API_PAGE_SIZE = 35
+
+
+def _cached_get(url, cache=None, session=None, **kwargs):
+    if cache is not None:
+        text = cache.get(url)
+        if text is not None:
+            return text
+    res = (session or requests).get(url, **kwargs)
+    res.encoding = "utf-8"
+    if cache is not None and res.status_code == 200:
+        cache.set(url, res.text)
+    return res.text
+
 
 def bing_get_image_url_using_api(keywords, max_number=10000, face_only=False,
-                                 proxy=None, proxy_type=None):
-    proxies = None
+                                 proxy=None, proxy_type=None, cache=None, candidate_filter=None, stream=False,
+                                 window=1):
+    """
+    Image urls from Bing's result pages; with ``stream``, a generator
+    yielding each page's as it arrives. With ``window`` above 1, that many
+    pages are requested at a time over one pooled session, and their
+    results are merged in page order without duplicates.
+    """
+    if window > 1:
+        urls = _bing_api_image_urls_concurrent(keywords, max_number, proxy, proxy_type, cache, candidate_filter,
+                                               window)
+    else:
+        urls = _bing_api_image_urls(keywords, max_number, proxy, proxy_type, cache, candidate_filter)
+    return urls if stream else list(urls)
+
+
+def _proxies(proxy, proxy_type):
     if proxy and proxy_type:
-        proxies = {"http": "{}://{}".format(proxy_type, proxy),
-                   "https": "{}://{}".format(proxy_type, proxy)}                             
+        return {"http": "{}://{}".format(proxy_type, proxy),
+                "https": "{}://{}".format(proxy_type, proxy)}
+    return None
+
+
+def _api_page_url(keywords, first):
+    return 'https://www.bing.com/images/async?q={}&first={}&count={}'.format(keywords, first, API_PAGE_SIZE)
+
+
+def _bing_api_image_urls(keywords, max_number, proxy, proxy_type, cache, candidate_filter):
+    proxies = _proxies(proxy, proxy_type)
     start = 1
-    image_urls = []
+    last_url = None
     while start <= max_number:
-        url = 'https://www.bing.com/images/async?q={}&first={}&count=35'.format(keywords, start)
-        res = requests.get(url, proxies=proxies, headers=g_headers)
-        res.encoding = "utf-8"
-        image_urls_batch = re.findall('murl&quot;:&quot;(.*?)&quot;', res.text)
-        if len(image_urls) > 0 and image_urls_batch[-1] == image_urls[-1]:
+        url = _api_page_url(keywords, start)
+        text = _cached_get(url, cache, proxies=proxies, headers=g_headers)
+        candidates = list(parse_result_page(text))
+        if len(candidates) == 0 or candidates[-1].url == last_url:
             break
-        image_urls += image_urls_batch
-        start += len(image_urls_batch)
-    return image_urls
+        last_url = candidates[-1].url
+        for c in candidates:
+            if not candidate_filter or candidate_filter.accepts(c):
+                yield c.url
+        start += len(candidates)
+
+
+def _bing_api_image_urls_concurrent(keywords, max_number, proxy, proxy_type, cache, candidate_filter, window):
+    """
+    Request the pages at offsets 1, 36, 71, ... up to max_number, ``window``
+    at a time, and yield their urls in offset order. The first page that is
+    empty or brings nothing new (Bing repeats its last page past the end)
+    ends the crawl; pages still queued are then never requested.
+    """
+    proxies = _proxies(proxy, proxy_type)
+    session = make_session(window)
+    executor = futures.ThreadPoolExecutor(max_workers=window)
+    offsets = iter(range(1, max_number + 1, API_PAGE_SIZE))
+    pending = collections.deque()
+    seen = set()
+    try:
+        while True:
+            for first in itertools.islice(offsets, window - len(pending)):
+                pending.append(executor.submit(_cached_get, _api_page_url(keywords, first), cache, session,
+                                               proxies=proxies, headers=g_headers))
+            if not pending:
+                return
+            candidates = [c for c in parse_result_page(pending.popleft().result()) if c.url not in seen]
+            if not candidates:
+                return
+            for c in candidates:
+                seen.add(c.url)
+                if not candidate_filter or candidate_filter.accepts(c):
+                    yield c.url
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        session.close()
+
 
 def crawl_image_urls(keywords, engine="Google", max_number=10000,
                      face_only=False, safe_mode=False, proxy=None, 
-                     proxy_type="http", quiet=False, browser="chrome_headless", image_type=None, color=None):
+                     proxy_type="http", quiet=False, browser="chrome_headless", image_type=None, color=None,
+                     cache=None, candidate_filter=None, stream=False, page_window=1, driver_pool=None,
+                     scroll_timeout=3):
     """
     Scrape image urls of keywords from Google Image Search
     :param keywords: keywords you want to search
@@ -211,6 +324,13 @@ def crawl_image_urls(keywords, engine="Google", max_number=10000,
     :param proxy: proxy address, example: socks5 127.0.0.1:1080
     :param proxy_type: socks5, http
     :param browser: browser to use when crawl image urls
+    :param cache: PageCache for result pages fetched in api mode
+    :param candidate_filter: parser.CandidateFilter applied to results in api mode
+    :param page_window: result pages requested at a time in api mode
+    :param driver_pool: driverpool.DriverPool to borrow the browser from instead of starting one
+    :param scroll_timeout: seconds the browser waits for more results after each scroll
+    :param stream: return a generator yielding urls as they are found instead of a list; the crawl runs
+        (and the browser stays open) while it is consumed
     :return: list of scraped image urls
     """
 
@@ -233,54 +353,73 @@ def crawl_image_urls(keywords, engine="Google", max_number=10000,
 
     my_print("Query URL:  " + query_url, quiet)
 
-    image_urls = []
+    image_urls = _crawl(keywords, engine, query_url, max_number, face_only, proxy, proxy_type, quiet, browser,
+                        cache, candidate_filter, page_window, driver_pool, scroll_timeout)
+    if stream:
+        return itertools.islice(image_urls, max_number)
+    image_urls = list(image_urls)
 
+    if max_number > len(image_urls):
+        output_num = len(image_urls)
+    else:
+        output_num = max_number
+
+    my_print("\n== {0} out of {1} crawled images urls will be used.\n".format(
+        output_num, len(image_urls)), quiet)
+
+    return image_urls[0:output_num]
+
+
+def _crawl(keywords, engine, query_url, max_number, face_only, proxy, proxy_type, quiet, browser, cache,
+           candidate_filter, page_window, driver_pool, scroll_timeout):
+    """
+    Generator behind crawl_image_urls; the browser is closed (or given back
+    to driver_pool) when it finishes or is closed.
+    """
     if browser != "api":
-        browser = str.lower(browser)
-        if "firefox" in browser:
-            firefox_path = shutil.which("geckodriver")
-            firefox_options = webdriver.FirefoxOptions()
-            if "headless" in browser:
-                firefox_options.add_argument("-headless")
-            if proxy is not None and proxy_type is not None:
-                firefox_options.add_argument("--proxy-server={}://{}".format(proxy_type, proxy))
-            #driver = webdriver.Firefox(options=firefox_options)
-            service = Service(executable_path=firefox_path)
-            driver = webdriver.Chrome(service=service, options=firefox_options)
-        else:
-            chrome_path = shutil.which("chromedriver")
-            chrome_options = webdriver.ChromeOptions()
-            if "headless" in browser:
-                chrome_options.add_argument("headless")
-            if proxy is not None and proxy_type is not None:
-                chrome_options.add_argument("--proxy-server={}://{}".format(proxy_type, proxy))
-            #driver = webdriver.Chrome(chrome_path, chrome_options=chrome_options)
-            service = Service(executable_path=chrome_path)
-            driver = webdriver.Chrome(service=service, options=chrome_options)
-            
-        if engine == "Google":
-            driver.set_window_size(1920, 1080)
-            driver.get(query_url)
-            image_urls = google_image_url_from_webpage(driver, max_number, quiet)
-        elif engine == "Bing":
+        if driver_pool is not None:
+            with driver_pool.driver() as driver:
+                yield from _crawl_page(driver, engine, query_url, max_number, quiet, scroll_timeout)
+            return
+        driver = make_driver(browser, proxy, proxy_type)
+        try:
             driver.set_window_size(1920, 1080)
-            driver.get(query_url)
-            image_urls = bing_image_url_from_webpage(driver)
-            
-        driver.close()
+            yield from _crawl_page(driver, engine, query_url, max_number, quiet, scroll_timeout)
+        finally:
+            driver.quit()
     else: # api
         if engine == "Bing":
-            image_urls = bing_get_image_url_using_api(keywords, max_number=max_number, face_only=face_only,
-                                                      proxy=proxy, proxy_type=proxy_type)
+            yield from bing_get_image_url_using_api(keywords, max_number, face_only, proxy, proxy_type, cache,
+                                                    candidate_filter, stream=True, window=page_window)
         else:
             my_print("Engine {} is not supported on API mode.".format(engine))
 
-    if max_number > len(image_urls):
-        output_num = len(image_urls)
-    else:
-        output_num = max_number
 
-    my_print("\n== {0} out of {1} crawled images urls will be used.\n".format(
-        output_num, len(image_urls)), quiet)
 
-    return image_urls[0:output_num]
\ No newline at end of file
+def _crawl_page(driver, engine, query_url, max_number, quiet, scroll_timeout):
+    driver.get(query_url)
+    if engine == "Google":
+        yield from _google_image_urls(driver, max_number, quiet, scroll_timeout=scroll_timeout)
+    elif engine == "Bing":
+        yield from _bing_image_urls(driver, scroll_timeout=scroll_timeout)
+
+
+def crawl_many_image_urls(keywords_list, driver_pool=None, **kwargs):
+    """
+    Crawl several keywords at once with crawl_image_urls, each on a browser
+    borrowed from ``driver_pool`` (one per keyword at a time, up to its size).
+    Without a pool the crawls run one after another. Other keyword arguments
+    are passed to crawl_image_urls. Returns a dict mapping each keywords
+    string to its list of urls, or to the exception that ended its crawl.
+    """
+    kwargs.pop("stream", None)
+
+    def crawl(keywords):
+        try:
+            return crawl_image_urls(keywords, driver_pool=driver_pool, **kwargs)
+        except Exception as e:
+            return e
+
+    workers = driver_pool.size if driver_pool is not None else 1
+    with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(keywords_list, executor.map(crawl, keywords_list)))
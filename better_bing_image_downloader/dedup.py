@@ -0,0 +1,126 @@
+""" Content-hash and perceptual-hash index used to drop duplicate images across runs and queries. """
+
+import os
+import sqlite3
+import threading
+
+from PIL import Image
+
+from .storage import location_exists
+
+PHASH_BITS = 64
+
+
+class DuplicateImage(ValueError):
+    pass
+
+
+def image_phash(path):
+    """
+    64-bit difference hash of the image at path: compare horizontally adjacent
+    pixels of a 9x8 greyscale thumbnail. Similar images differ in few bits.
+    """
+    with Image.open(path) as img:
+        pixels = img.convert('L').resize((9, 8), Image.LANCZOS).tobytes()
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+def _to_signed(value):
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+class DedupIndex(object):
+    """
+    SQLite index of saved images kept at the output root and shared by every
+    query below it. Exact duplicates are found by sha256; with phash_distance
+    set, images whose perceptual hash is within that many bits of a saved one
+    are duplicates as well. Entries whose file (or tar shard) has since been
+    removed are ignored.
+
+    Near matches are looked up with multi-index hashing: the hash is split in
+    phash_distance + 1 bands, and any hash within the distance shares at least
+    one band exactly with the query.
+    """
+
+    FILE_NAME = '.dedup.sqlite'
+
+    def __init__(self, directory, phash_distance=None):
+        self.path = os.path.join(str(directory), self.FILE_NAME)
+        self.phash_distance = phash_distance
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS images ('
+                         'sha256 TEXT PRIMARY KEY, phash INTEGER, path TEXT NOT NULL)')
+        self._bands = {}
+        if phash_distance is not None:
+            self._band_width = max(1, PHASH_BITS // (phash_distance + 1))
+            for phash, path in self._db.execute('SELECT phash, path FROM images WHERE phash IS NOT NULL'):
+                self._index_phash(phash & ((1 << 64) - 1), path)
+
+    def _split(self, phash):
+        mask = (1 << self._band_width) - 1
+        return [(i, (phash >> (i * self._band_width)) & mask)
+                for i in range(-(-PHASH_BITS // self._band_width))]
+
+    def _index_phash(self, phash, path):
+        for band in self._split(phash):
+            self._bands.setdefault(band, []).append((phash, path))
+
+    def _find(self, sha256, phash):
+        row = self._db.execute('SELECT path FROM images WHERE sha256 = ?', (sha256,)).fetchone()
+        if row is not None and location_exists(row[0]):
+            return row[0]
+        if phash is None or self.phash_distance is None:
+            return None
+        for band in self._split(phash):
+            for other, path in self._bands.get(band, ()):
+                if hamming(phash, other) <= self.phash_distance and location_exists(path):
+                    return path
+        return None
+
+    def find(self, sha256, phash=None):
+        """ Path of an already saved duplicate, or None. """
+        with self._lock:
+            return self._find(sha256, phash)
+
+    def add(self, sha256, path, phash=None):
+        """
+        Record a saved image. Returns False without recording anything when it
+        turns out to duplicate an existing entry.
+        """
+        with self._lock:
+            if self._find(sha256, phash) is not None:
+                return False
+            self._db.execute('INSERT OR REPLACE INTO images (sha256, phash, path) VALUES (?, ?, ?)',
+                             (sha256, None if phash is None else _to_signed(phash), str(path)))
+            if phash is not None and self.phash_distance is not None:
+                self._index_phash(phash, str(path))
+            return True
+
+    def forget(self, directory):
+        """ Drop every entry saved under directory, e.g. before it is wiped. """
+        prefix = os.path.join(str(directory), '')
+        with self._lock:
+            self._db.execute('DELETE FROM images WHERE substr(path, 1, ?) = ?', (len(prefix), prefix))
+            for band, entries in list(self._bands.items()):
+                self._bands[band] = [entry for entry in entries if not entry[1].startswith(prefix)]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
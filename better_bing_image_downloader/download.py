@@ -2,12 +2,32 @@ import os
 import argparse
 import asyncio
 import shutil
-import logging
-from pathlib import Path
+import time
+from collections import namedtuple
+from .adaptive import AsyncAdaptiveLimit
 from .bing import Bing
+from .cache import DiskCache
+from .dedup import DedupIndex
+from .journal import DONE, DUPLICATE, FAILED, Journal
+from .manifest import Manifest
+from .metrics import DownloadEvent, Metrics, exporting
+from .parser import CandidateFilter
+from .processing import (ImagePool, Transform, commit_transformed, discard_transformed, examine_image,
+                         image_info, transform_image)
+from .ratelimit import TokenBucket
+from .retry import RetryPolicy
+from .scheduler import AsyncHostScheduler, FairShare, host_of
+from .seen import open_seen, save_seen
+from .sniff import extension
+from .storage import make_backend
+from .streaming import CHUNK_SIZE, PartFile, check_content_length
+import aiohttp
 import httpx
 
 
+QueryResult = namedtuple('QueryResult', ['query', 'image_dir', 'downloaded', 'failed', 'duplicates'])
+
+
 async def downloader(
     query,
     limit=5,
@@ -18,12 +38,280 @@ async def downloader(
     filter="",
     verbose=False,
     badsites=[],
-    name='Image'
+    name='Image',
+    concurrency=8,
+    min_concurrency=None,
+    max_concurrency=None,
+    bandwidth=None,
+    max_bytes=None,
+    page_rate=1.0,
+    per_host=4,
+    host_rate=None,
+    resume=True,
+    dedup=True,
+    phash_distance=None,
+    cache_dir=None,
+    cache_ttl=24 * 3600,
+    min_width=None,
+    min_height=None,
+    min_aspect=None,
+    max_aspect=None,
+    verify=False,
+    process_workers=None,
+    transform=None,
+    output_backend='directory',
+    shard_size=1024 ** 3,
+    manifest=None,
+    metrics=None,
+    metrics_file=None,
+    metrics_interval=10.0,
+    metrics_port=None,
+    retry=None,
+    seen=None,
+    seen_error_rate=None,
+    callback=None
+):
+    """
+    Asynchronous downloader using httpx: images found by Bing are fetched by ``concurrency`` workers sharing one client.
+    :param query: keywords to search for, also the name of the folder under output_dir
+    :param limit: number of images to save
+    :param concurrency: number of images downloaded at once, or the starting number when adaptive
+    :param min_concurrency: when this or max_concurrency is set, the number of downloads at once follows the
+        observed latency, timeouts and throughput (see adaptive.AsyncAdaptiveLimit), no lower than this
+    :param max_concurrency: and no higher than this
+    :param bandwidth: max download rate in bytes per second, None for unlimited
+    :param max_bytes: images larger than this are abandoned mid-stream
+    :param page_rate: max Bing result pages per second
+    :param per_host: max number of requests in flight to a single host
+    :param host_rate: max requests per second to a single host, None for unlimited
+    :param resume: keep a journal in the query folder so a re-run continues from where it stopped
+    :param dedup: drop images identical to one already saved under output_dir
+    :param phash_distance: also drop images within this perceptual hash distance of a saved one
+    :param cache_dir: directory caching Bing result pages for cache_ttl seconds
+    :param min_width: (and min_height, min_aspect, max_aspect) skip results reported as outside these bounds
+    :param verify: fully decode each image with PIL before keeping it
+    :param process_workers: number of processes decoding and hashing images, one per CPU if None
+    :param transform: processing.Transform applied to each image before it is saved
+    :param output_backend: "directory" for one file per image, or "tar" for rolling tar shards in the query folder
+    :param shard_size: size in bytes at which a new tar shard is started
+    :param manifest: .jsonl or .parquet path (or a manifest.Manifest) receiving one record per saved image
+    :param metrics: metrics.Metrics collecting counters and latencies, created when metrics_file or metrics_port is set
+    :param metrics_file: JSON lines file receiving metrics.stats() every metrics_interval seconds
+    :param metrics_port: localhost port serving the metrics in Prometheus text format
+    :param retry: retry.RetryPolicy for failed page and image requests, a default one if None
+    :param seen: set (or path of a saved seen.FingerprintSet or seen.BloomFilter) of urls to skip, updated with
+        the urls saved or found to be duplicates
+    :param seen_error_rate: false positive rate of the seen.BloomFilter created when the seen file does not exist
+        yet; None creates a seen.FingerprintSet
+    :param callback: called with a metrics.DownloadEvent for every image tried
+    :return: QueryResult
+    """
+
+    assert isinstance(concurrency, int) and concurrency > 0, "concurrency must be a positive integer"
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    seen_file = seen if isinstance(seen, (str, os.PathLike)) else None
+    if seen_file is not None:
+        seen = open_seen(seen_file, seen_error_rate)
+    index = DedupIndex(output_dir, phash_distance) if dedup else None
+    pool = None
+    if verify or transform is not None or (dedup and phash_distance is not None):
+        pool = ImagePool(process_workers)
+    own_manifest = manifest is not None and not isinstance(manifest, Manifest)
+    if own_manifest:
+        manifest = Manifest(manifest)
+    if metrics is None and (metrics_file or metrics_port is not None):
+        metrics = Metrics()
+
+    try:
+        with exporting(metrics, metrics_file, metrics_interval, metrics_port):
+            async with httpx.AsyncClient(timeout=timeout) as client:
+                return await _download_query(
+                    client, None, query, limit, output_dir, adult_filter_off, force_replace, timeout, filter,
+                    verbose, badsites, name, concurrency, max_bytes, page_rate, per_host, host_rate, resume,
+                    index, phash_distance, min_concurrency=min_concurrency, max_concurrency=max_concurrency,
+                    budget=TokenBucket(bandwidth, bandwidth) if bandwidth else None,
+                    cache=DiskCache(cache_dir, cache_ttl) if cache_dir else None,
+                    min_width=min_width, min_height=min_height, min_aspect=min_aspect, max_aspect=max_aspect,
+                    verify=verify, pool=pool, transform=transform, output_backend=output_backend,
+                    shard_size=shard_size, manifest=manifest, metrics=metrics, retry=retry, seen=seen,
+                    callback=callback)
+    finally:
+        if seen_file is not None:
+            save_seen(seen, seen_file)
+        if index is not None:
+            index.close()
+        if pool is not None:
+            pool.close()
+        if own_manifest:
+            manifest.close()
+
+
+async def download_many(
+    queries,
+    limit=5,
+    output_dir='downloads',
+    timeout=60,
+    verbose=False,
+    max_connections=32,
+    query_concurrency=4,
+    bandwidth=None,
+    dedup=True,
+    phash_distance=None,
+    cache_dir=None,
+    cache_ttl=24 * 3600,
+    process_workers=None,
+    manifest=None,
+    metrics=None,
+    metrics_file=None,
+    metrics_interval=10.0,
+    metrics_port=None,
+    retry=None,
+    seen=None,
+    seen_error_rate=None,
+    on_result=None,
+    **kwargs
 ):
     """
-    Asynchronous downloader using httpx.
+    Download images for many queries concurrently inside one event loop.
+
+    Up to ``query_concurrency`` queries run at a time. They share one httpx
+    client (and its connection pool), one aiohttp session for result pages,
+    one dedup index and one image process pool. At most ``max_connections``
+    image requests are in flight overall; free slots are handed to the
+    running queries in turn, so a large query cannot starve the others. ``bandwidth`` caps the combined
+    download rate in bytes per second. All queries write to the same
+    ``manifest`` and report to the same ``metrics``, and share one ``retry``
+    policy, so its circuit breakers see the traffic of every query.
+    A ``seen`` set (or file, see ``seen_error_rate``) given here is shared
+    too, so an url saved by one query is skipped by the ones started after it.
+
+    ``queries`` may be any iterable or async iterable; it is read only as
+    queries can be started, so it can be fed while the downloads run.
+    ``on_result`` is called with ``(query, result)`` as each query ends.
+
+    Other keyword arguments are passed on per query as for ``downloader``.
+    Returns a dict mapping each query to its QueryResult (or to the exception
+    that ended it).
     """
 
+    if not hasattr(queries, '__aiter__'):
+        queries = _aiter(queries)
+    source = queries.__aiter__()
+    pull = asyncio.Lock()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    seen_file = seen if isinstance(seen, (str, os.PathLike)) else None
+    if seen_file is not None:
+        seen = open_seen(seen_file, seen_error_rate)
+    fair = FairShare(max_connections)
+    budget = TokenBucket(bandwidth, bandwidth) if bandwidth else None
+    index = DedupIndex(output_dir, phash_distance) if dedup else None
+    cache = DiskCache(cache_dir, cache_ttl) if cache_dir else None
+    pool = None
+    if kwargs.get('verify') or kwargs.get('transform') is not None or (dedup and phash_distance is not None):
+        pool = ImagePool(process_workers)
+    own_manifest = manifest is not None and not isinstance(manifest, Manifest)
+    if own_manifest:
+        manifest = Manifest(manifest)
+    if metrics is None and (metrics_file or metrics_port is not None):
+        metrics = Metrics()
+    if retry is None:
+        retry = RetryPolicy()
+    options = dict(limit=limit, output_dir=output_dir, timeout=timeout, verbose=verbose)
+    options.update(kwargs)
+    results = {}
+    started = set()
+
+    async def run(query):
+        try:
+            results[query] = await _download_query(
+                client, session, query, index=index, phash_distance=phash_distance,
+                fair=fair, budget=budget, cache=cache, pool=pool, manifest=manifest, metrics=metrics,
+                retry=retry, seen=seen, **options)
+        except Exception as e:
+            if verbose:
+                print(f"Query {query} failed: {e}")
+            results[query] = e
+        if on_result is not None:
+            on_result(query, results[query])
+
+    async def runner():
+        while True:
+            async with pull:
+                try:
+                    query = await source.__anext__()
+                except StopAsyncIteration:
+                    return
+            query = query.strip()
+            if query and query not in started:
+                started.add(query)
+                await run(query)
+
+    limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+    try:
+        with exporting(metrics, metrics_file, metrics_interval, metrics_port):
+            async with httpx.AsyncClient(timeout=timeout, limits=limits) as client, \
+                    aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+                await asyncio.gather(*[runner() for _ in range(query_concurrency)])
+    finally:
+        if seen_file is not None:
+            save_seen(seen, seen_file)
+        if index is not None:
+            index.close()
+        if pool is not None:
+            pool.close()
+        if own_manifest:
+            manifest.close()
+    return results
+
+
+async def _download_query(
+    client,
+    session,
+    query,
+    limit=5,
+    output_dir='downloads',
+    adult_filter_off=False,
+    force_replace=False,
+    timeout=60,
+    filter="",
+    verbose=False,
+    badsites=[],
+    name='Image',
+    concurrency=8,
+    max_bytes=None,
+    page_rate=1.0,
+    per_host=4,
+    host_rate=None,
+    resume=True,
+    index=None,
+    phash_distance=None,
+    min_concurrency=None,
+    max_concurrency=None,
+    fair=None,
+    budget=None,
+    cache=None,
+    min_width=None,
+    min_height=None,
+    min_aspect=None,
+    max_aspect=None,
+    verify=False,
+    pool=None,
+    transform=None,
+    output_backend='directory',
+    shard_size=1024 ** 3,
+    manifest=None,
+    metrics=None,
+    retry=None,
+    seen=None,
+    callback=None
+):
+    if retry is None:
+        retry = RetryPolicy()
     if adult_filter_off:
         adult = 'off'
     else:
@@ -32,6 +320,8 @@ async def downloader(
     image_dir = os.path.join(output_dir, query)
 
     if force_replace and os.path.isdir(image_dir):
+        if index is not None:
+            index.forget(image_dir)
         shutil.rmtree(image_dir)
 
     if not os.path.isdir(image_dir):
@@ -40,35 +330,234 @@ async def downloader(
     if verbose:
         print(f"Downloading images to {image_dir}")
 
-    async with httpx.AsyncClient(timeout=timeout) as client:
-        bing = Bing(query, limit, image_dir, adult, timeout, filter, verbose, badsites, name)
-        total_downloaded = 0
-        url_ = bing.get_image_urls()
+    journal = Journal(image_dir, query) if resume else None
+    backend = make_backend(output_backend, image_dir, shard_size)
+    bing = Bing(query, limit, image_dir, adult, timeout, filter, verbose, badsites, name, max_bytes,
+                page_rate=page_rate, journal=journal, cache=cache, metrics=metrics, retry=retry,
+                candidate_filter=CandidateFilter(min_width, min_height, max_bytes, min_aspect, max_aspect))
+    limiter = None
+    if min_concurrency is not None or max_concurrency is not None:
+        limiter = AsyncAdaptiveLimit(min_concurrency or 1, max(max_concurrency or concurrency, concurrency),
+                                     initial=concurrency)
+        concurrency = limiter.max_limit
+    scheduler = AsyncHostScheduler(maxsize=concurrency * 2, per_host=per_host, host_rate=host_rate,
+                                   key=lambda candidate: host_of(candidate.url))
+    done = asyncio.Event()
+    total_downloaded = bing.download_count
+    # Files are numbered on from the first free name, so a run without a
+    # journal never overwrites the images of an earlier one.
+    next_index = total_downloaded
+    failed = 0
+    duplicates = 0
 
-        async for url in url_:
-            if total_downloaded >= limit:
-                break
-            
-            try:
-                response = await client.get(url)
-                if response.status_code == 200:
-                    file_path = os.path.join(image_dir, f"{name}_{total_downloaded}.jpg")
-                    with open(file_path, 'wb') as f:
-                        f.write(response.content)
+    async def produce():
+        try:
+            async for candidate in bing.get_image_candidates(session):
+                if done.is_set():
+                    break
+                if seen is not None and candidate.url in seen:
+                    continue
+                await scheduler.put(candidate)
+        finally:
+            await scheduler.close()
+
+    def report(url, status, start, path=None, size=0, error=None):
+        if callback is not None:
+            callback(DownloadEvent(query, url, status, path, size, time.monotonic() - start, total_downloaded,
+                                   error))
+
+    async def fetch(candidate):
+        nonlocal total_downloaded, duplicates, next_index
+        url = candidate.url
+        started_at = time.time()
+        start = time.monotonic()
+        connect = {}
+
+        async def trace(event, info):
+            if event == 'connection.connect_tcp.started':
+                connect['start'] = time.monotonic()
+            elif event in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+                connect['end'] = time.monotonic()
+
+        extensions = {'trace': trace} if metrics is not None else None
+        async with client.stream('GET', url, extensions=extensions) as response:
+            headers_at = time.monotonic()
+            if metrics is not None:
+                if 'start' in connect and 'end' in connect:
+                    metrics.observe('connect', connect['end'] - connect['start'])
+                metrics.observe('response', headers_at - start)
+            if response.status_code != 200:
+                if metrics is not None:
+                    metrics.observe_host(host_of(url), headers_at - start)
+                raise httpx.HTTPStatusError(f"HTTP {response.status_code}", request=response.request,
+                                            response=response)
+            check_content_length(response.headers, max_bytes)
+            with PartFile(image_dir, max_bytes, require_image=True) as part:
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    part.write(chunk)
+                    if metrics is not None:
+                        metrics.received(len(chunk))
+                    if limiter is not None:
+                        limiter.received(len(chunk))
+                    if budget is not None:
+                        await budget.spend_async(len(chunk))
+                part.close()
+                downloaded_at = time.monotonic()
+                if metrics is not None:
+                    metrics.observe('transfer', downloaded_at - headers_at)
+                    metrics.observe_host(host_of(url), downloaded_at - start)
+                sha256 = part.sha256.hexdigest()
+                phash = None
+                need_phash = index is not None and phash_distance is not None and index.find(sha256) is None
+                if verify or need_phash:
+                    phash = await pool.run(examine_image, part.path, verify, need_phash)
+                transformed = None
+                if transform is not None and total_downloaded < limit:
+                    transformed = await pool.run(transform_image, part.path, transform, discard=discard_transformed)
+                processed_at = time.monotonic()
+                if metrics is not None and pool is not None:
+                    metrics.observe('process', processed_at - downloaded_at)
+                try:
+                    if total_downloaded >= limit:
+                        return
+                    if index is not None and index.find(sha256, phash) is not None:
+                        duplicates += 1
+                        if journal is not None:
+                            journal.record(url, DUPLICATE, sha256=sha256)
+                        if seen is not None:
+                            seen.add(url)
+                        if metrics is not None:
+                            metrics.duplicate()
+                        report(url, DUPLICATE, start, size=part.size)
+                        if verbose:
+                            print(f"Skipped duplicate {url}")
+                        return
+                    if manifest is not None:
+                        _, width, height = image_info((transformed or part).path)
+                        size = part.size if transformed is None else os.path.getsize(transformed.path)
+                    while backend.taken(f"{name}_{next_index}"):
+                        next_index += 1
+                    stem = f"{name}_{next_index}"
+                    next_index += 1
                     total_downloaded += 1
-                    if verbose:
-                        print(f"Downloaded {file_path}")
-            except Exception as e:
-                if verbose:
-                    print(f"Failed to download {url}: {e}")
+                    bing.download_count = total_downloaded
+                    if transformed is not None:
+                        file_path = commit_transformed(part, transformed, backend, stem, transform.keep_original)
+                    else:
+                        file_path = backend.store(part.path, f"{stem}.{extension(part.format)}")
+                    if index is not None:
+                        index.add(sha256, file_path, phash)
+                    if journal is not None:
+                        journal.record(url, DONE, file_path, sha256)
+                    if seen is not None:
+                        seen.add(url)
+                    if metrics is not None:
+                        metrics.observe('write', time.monotonic() - processed_at)
+                        metrics.saved()
+                    if manifest is not None:
+                        manifest.add(query=query, url=url, page_url=candidate.page_url, path=file_path,
+                                     bytes=size, format=(transformed or part).format, width=width,
+                                     height=height, sha256=sha256, started_at=started_at,
+                                     download_seconds=downloaded_at - start,
+                                     process_seconds=time.monotonic() - downloaded_at)
+                    report(url, DONE, start, file_path, part.size)
+                finally:
+                    if transformed is not None:
+                        discard_transformed(transformed)
+        if verbose:
+            print(f"Downloaded {file_path}")
+        if total_downloaded >= limit:
+            done.set()
+
+    async def attempt(candidate):
+        nonlocal failed
+        start = time.monotonic()
+        try:
+            await retry.call_async(fetch, candidate, host=host_of(candidate.url), metrics=metrics)
+        except Exception as e:
+            if limiter is not None:
+                limiter.observe(time.monotonic() - start, e)
+            failed += 1
+            if journal is not None:
+                journal.record(candidate.url, FAILED)
+            if metrics is not None:
+                metrics.failed(e)
+            report(candidate.url, FAILED, start, error=e)
+            if verbose:
+                print(f"Failed to download {candidate.url}: {e}")
+        else:
+            if limiter is not None:
+                limiter.observe(time.monotonic() - start)
+
+    async def step():
+        candidate = await scheduler.get()
+        if candidate is None:
+            return False
+        try:
+            if fair is not None:
+                async with fair.slot(query):
+                    await attempt(candidate)
+            else:
+                await attempt(candidate)
+        finally:
+            await scheduler.release(candidate)
+        return True
+
+    async def work():
+        while not done.is_set():
+            if limiter is None:
+                more = await step()
+            else:
+                # Workers beyond the current limit wait here, not on a candidate.
+                async with limiter.slot():
+                    more = await step()
+            if not more:
+                break
+
+    try:
+        await _run_pool(produce(), [work() for _ in range(concurrency)], done)
+    finally:
+        backend.close()
+        if journal is not None:
+            journal.close()
 
     if verbose:
         print(f"Download completed: {total_downloaded} images downloaded.")
 
+    return QueryResult(query, image_dir, total_downloaded, failed, duplicates)
+
+
+async def _aiter(iterable):
+    for item in iterable:
+        yield item
+
+
+async def _run_pool(producer, workers, done):
+    """
+    Run a producer and its workers until the workers drain the queue or
+    ``done`` is set, then cancel whatever is still pending. An exception
+    raised by the producer or a worker is raised again once all have stopped.
+    """
+    producer_task = asyncio.ensure_future(producer)
+    worker_tasks = [asyncio.ensure_future(w) for w in workers]
+    done_task = asyncio.ensure_future(done.wait())
+    try:
+        await asyncio.wait([done_task, asyncio.gather(*worker_tasks, return_exceptions=True)],
+                           return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        pending = [t for t in [producer_task, done_task, *worker_tasks] if not t.done()]
+        for task in pending:
+            task.cancel()
+        outcomes = await asyncio.gather(producer_task, *worker_tasks, return_exceptions=True)
+        done_task.cancel()
+    for outcome in outcomes:
+        if isinstance(outcome, Exception) and not isinstance(outcome, asyncio.CancelledError):
+            raise outcome
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Download images using Bing.')
-    parser.add_argument('query', type=str, help='The search query.')
+    parser.add_argument('query', type=str, nargs='?', help='The search query.')
     parser.add_argument('-l', '--limit', type=int, default=100, help='The maximum number of images to download.')
     parser.add_argument('-d', '--output_dir', type=str, default='dataset', help='The directory to save the images in.')
     parser.add_argument('-a', '--adult_filter_off', action='store_true', help='Whether to turn off the adult filter.')
@@ -78,8 +567,81 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--verbose', action='store_true', help='Whether to print detailed output.')
     parser.add_argument('-b', '--bad_sites', nargs='*', default=[], help='List of bad sites to be excluded.')
     parser.add_argument('-n', '--name', type=str, default='Image', help='The name of the images.')
-    
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='The number of concurrent download workers.')
+    parser.add_argument('--min-concurrency', type=int, default=None, help='Adapt the number of workers to latency and timeouts, no lower than this.')
+    parser.add_argument('--max-concurrency', type=int, default=None, help='Adapt the number of workers to latency and timeouts, no higher than this.')
+    parser.add_argument('--max-bytes', type=int, default=None, help='Skip images larger than this many bytes.')
+    parser.add_argument('--per-host', type=int, default=4, help='Maximum number of concurrent requests to one host.')
+    parser.add_argument('--host-rate', type=float, default=None, help='Maximum number of requests per second to one host.')
+    parser.add_argument('--no-resume', dest='resume', action='store_false', help='Ignore and do not keep a download journal.')
+    parser.add_argument('--no-dedup', dest='dedup', action='store_false', help='Keep images identical to ones already downloaded.')
+    parser.add_argument('--phash-distance', type=int, default=None, help='Also drop images within this perceptual hash distance of a saved one.')
+    parser.add_argument('--page-rate', type=float, default=1.0, help='Maximum number of Bing result pages requested per second.')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Cache Bing result pages in this directory.')
+    parser.add_argument('--cache-ttl', type=int, default=24 * 3600, help='Seconds a cached result page stays valid.')
+    parser.add_argument('--min-width', type=int, default=None, help='Skip results narrower than this many pixels.')
+    parser.add_argument('--min-height', type=int, default=None, help='Skip results shorter than this many pixels.')
+    parser.add_argument('--min-aspect', type=float, default=None, help='Skip results with a smaller width/height ratio.')
+    parser.add_argument('--max-aspect', type=float, default=None, help='Skip results with a larger width/height ratio.')
+    parser.add_argument('--verify', action='store_true', help='Fully decode every image before keeping it.')
+    parser.add_argument('--process-workers', type=int, default=None, help='Processes used to decode and hash images (default: CPU count).')
+    parser.add_argument('--resize-max-side', type=int, default=None, help='Shrink images so their longest side is at most this.')
+    parser.add_argument('--output-format', type=str, default=None, choices=['jpeg', 'webp', 'png'], help='Re-encode images to this format.')
+    parser.add_argument('--quality', type=int, default=85, help='Encoder quality used with --output-format or --resize-max-side.')
+    parser.add_argument('--thumbnail-size', type=int, default=None, help='Also write thumbnails with this longest side.')
+    parser.add_argument('--keep-original', action='store_true', help='Keep the original next to transformed images.')
+    parser.add_argument('--output-backend', type=str, default='directory', choices=['directory', 'tar'], help='Write one file per image, or tar shards.')
+    parser.add_argument('--shard-size', type=int, default=1024 ** 3, help='Size in bytes at which a new tar shard is started.')
+    parser.add_argument('--manifest', type=str, default=None, help='Write a manifest of saved images to this .jsonl or .parquet file.')
+    parser.add_argument('--metrics-file', type=str, default=None, help='Append metrics as JSON lines to this file.')
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help='Seconds between lines in --metrics-file.')
+    parser.add_argument('--metrics-port', type=int, default=None, help='Serve Prometheus metrics on this localhost port.')
+    parser.add_argument('--retries', type=int, default=3, help='Tries per request for timeouts, connection errors and 429/5xx answers.')
+    parser.add_argument('--breaker-threshold', type=int, default=5, help='Failures in a row after which a host is left alone for a while (0 to disable).')
+    parser.add_argument('--seen-file', type=str, default=None, help='Skip urls saved by earlier runs that used this file, and add the ones saved by this run.')
+    parser.add_argument('--seen-error-rate', type=float, default=None, help='Keep a new --seen-file as a Bloom filter with this false positive rate.')
+    parser.add_argument('-q', '--queries-file', type=str, default=None, help='Download every query in this file (one per line) concurrently.')
+    parser.add_argument('--max-connections', type=int, default=32, help='Total concurrent image requests across queries (with --queries-file).')
+    parser.add_argument('--query-concurrency', type=int, default=4, help='Number of queries downloaded at once (with --queries-file).')
+    parser.add_argument('--bandwidth', type=int, default=None, help='Total download rate cap in bytes per second.')
+
     args = parser.parse_args()
-    
-    asyncio.run(downloader(args.query, args.limit, args.output_dir, args.adult_filter_off,
-                           args.force_replace, args.timeout, args.filter, args.verbose, args.bad_sites, args.name))
+
+    transform = None
+    if args.resize_max_side or args.output_format or args.thumbnail_size:
+        transform = Transform(args.resize_max_side, args.output_format, args.quality, args.thumbnail_size,
+                              args.keep_original)
+
+    options = dict(limit=args.limit, output_dir=args.output_dir, adult_filter_off=args.adult_filter_off,
+                   force_replace=args.force_replace, timeout=args.timeout, filter=args.filter,
+                   verbose=args.verbose, badsites=args.bad_sites, name=args.name,
+                   concurrency=args.concurrency, min_concurrency=args.min_concurrency,
+                   max_concurrency=args.max_concurrency, bandwidth=args.bandwidth,
+                   max_bytes=args.max_bytes, page_rate=args.page_rate,
+                   per_host=args.per_host, host_rate=args.host_rate, resume=args.resume,
+                   dedup=args.dedup, phash_distance=args.phash_distance,
+                   cache_dir=args.cache_dir, cache_ttl=args.cache_ttl,
+                   min_width=args.min_width, min_height=args.min_height,
+                   min_aspect=args.min_aspect, max_aspect=args.max_aspect, verify=args.verify,
+                   process_workers=args.process_workers, transform=transform,
+                   output_backend=args.output_backend, shard_size=args.shard_size, manifest=args.manifest,
+                   metrics_file=args.metrics_file, metrics_interval=args.metrics_interval,
+                   metrics_port=args.metrics_port, seen=args.seen_file,
+                   seen_error_rate=args.seen_error_rate,
+                   retry=RetryPolicy(args.retries, breaker_threshold=args.breaker_threshold))
+
+    if args.queries_file:
+        with open(args.queries_file, 'r', encoding='utf-8') as f:
+            queries = f.readlines()
+        results = asyncio.run(download_many(queries, max_connections=args.max_connections,
+                                            query_concurrency=args.query_concurrency, **options))
+        for query, result in results.items():
+            if isinstance(result, Exception):
+                print(f"{query}: failed ({result})")
+            else:
+                print(f"{query}: {result.downloaded} downloaded, {result.failed} failed, "
+                      f"{result.duplicates} duplicates")
+    elif args.query:
+        asyncio.run(downloader(args.query, **options))
+    else:
+        parser.error('a query or --queries-file is required')
@@ -0,0 +1,139 @@
+""" Warm, reusable WebDriver instances for browser crawls of many keywords. """
+
+import concurrent.futures
+import contextlib
+import logging
+import queue
+import shutil
+import threading
+
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
+
+# Run in the browser before a driver goes back to the pool.
+_RESET_SCRIPT = "try { window.localStorage.clear(); window.sessionStorage.clear(); } catch (e) {}"
+
+
+def make_driver(browser="chrome_headless", proxy=None, proxy_type=None):
+    """ Start a browser: "firefox" or "chrome", with "headless" anywhere in the name for a headless one. """
+    browser = str.lower(browser)
+    if "firefox" in browser:
+        firefox_path = shutil.which("geckodriver")
+        firefox_options = webdriver.FirefoxOptions()
+        if "headless" in browser:
+            firefox_options.add_argument("-headless")
+        if proxy is not None and proxy_type is not None:
+            firefox_options.add_argument("--proxy-server={}://{}".format(proxy_type, proxy))
+        #driver = webdriver.Firefox(options=firefox_options)
+        service = Service(executable_path=firefox_path)
+        return webdriver.Chrome(service=service, options=firefox_options)
+    else:
+        chrome_path = shutil.which("chromedriver")
+        chrome_options = webdriver.ChromeOptions()
+        if "headless" in browser:
+            chrome_options.add_argument("headless")
+        if proxy is not None and proxy_type is not None:
+            chrome_options.add_argument("--proxy-server={}://{}".format(proxy_type, proxy))
+        #driver = webdriver.Chrome(chrome_path, chrome_options=chrome_options)
+        service = Service(executable_path=chrome_path)
+        return webdriver.Chrome(service=service, options=chrome_options)
+
+
+class DriverPool(object):
+    """
+    ``size`` browsers started up front and handed out to crawls, so a list
+    of keywords pays the browser startup once per browser instead of once
+    per keyword, and up to ``size`` keywords are crawled at a time.
+
+    Between uses a driver is reset: cookies and storage are cleared and it
+    is sent to about:blank. A driver is quit and replaced by a fresh one
+    when a crawl using it raises (a crashed browser, a hung page), when the
+    reset fails, or after ``max_pages`` crawls, which bounds the memory a
+    long-lived browser accumulates. ``factory`` creates the drivers; by
+    default make_driver(browser, proxy, proxy_type).
+    """
+
+    def __init__(self, size=2, browser="chrome_headless", proxy=None, proxy_type=None, max_pages=50,
+                 factory=None):
+        self.size = size
+        self.max_pages = max_pages
+        self.factory = factory or (lambda: make_driver(browser, proxy, proxy_type))
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._drivers = set()
+        self._closed = False
+        with concurrent.futures.ThreadPoolExecutor(max_workers=size) as executor:
+            for driver in executor.map(lambda _: self._start(), range(size)):
+                self._idle.put([driver, 0])
+
+    def _start(self):
+        driver = self.factory()
+        driver.set_window_size(1920, 1080)
+        with self._lock:
+            self._drivers.add(driver)
+        return driver
+
+    def _quit(self, driver):
+        with self._lock:
+            self._drivers.discard(driver)
+        try:
+            driver.quit()
+        except Exception as e:
+            logging.info("Error while quitting a browser: %s", e)
+
+    def _reset(self, driver):
+        driver.delete_all_cookies()
+        driver.execute_script(_RESET_SCRIPT)
+        driver.get("about:blank")
+
+    @contextlib.contextmanager
+    def driver(self):
+        """ Borrow a driver for one crawl, waiting for a free one. """
+        if self._closed:
+            raise RuntimeError("DriverPool is closed")
+        entry = self._idle.get()
+        if entry[0] is None:
+            try:
+                entry = [self._start(), 0]
+            except Exception:
+                self._idle.put(entry)
+                raise
+        healthy = False
+        try:
+            yield entry[0]
+            healthy = True
+        except GeneratorExit:
+            # The crawl borrowing the driver was a generator closed early,
+            # like a streamed crawl cut short: the browser itself is fine.
+            healthy = True
+            raise
+        finally:
+            entry[1] += 1
+            if healthy and entry[1] < self.max_pages and not self._closed:
+                try:
+                    self._reset(entry[0])
+                except Exception as e:
+                    logging.info("Recycling a browser that failed to reset: %s", e)
+                    healthy = False
+            if not healthy or entry[1] >= self.max_pages or self._closed:
+                self._quit(entry[0])
+                # Replaced on its next use, so returning a driver never waits on a browser start.
+                entry = [None, 0]
+            self._idle.put(entry)
+
+    def close(self):
+        """ Quit every browser; the ones in use are quit when they are returned. """
+        self._closed = True
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            if entry[0] is not None:
+                self._quit(entry[0])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
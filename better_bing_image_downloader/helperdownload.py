@@ -4,12 +4,24 @@
 
 from __future__ import print_function
 
-import shutil
-import imghdr
 import os
 import concurrent.futures
+import queue
 import requests
-import socket
+import requests.adapters
+import threading
+import time
+from collections import namedtuple
+
+from .adaptive import AdaptiveLimit
+from .manifest import Manifest
+from .processing import commit_transformed, discard_transformed, image_info, transform_image
+from .ratelimit import TokenBucket
+from .retry import RetryPolicy
+from .scheduler import HostScheduler, host_of
+from .sniff import NotAnImage, extension
+from .storage import DirectoryBackend, make_backend
+from .streaming import CHUNK_SIZE, PartFile
 
 headers = {
     "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8",
@@ -20,7 +32,99 @@ headers = {
     # 'Connection': 'close',
 }
 
-def download_image(image_url, dst_dir, file_name, timeout=20, proxy_type=None, proxy=None):
+ALLOWED_FORMATS = ["jpeg", "png", "bmp", "webp"]
+
+DownloadResult = namedtuple('DownloadResult', ['url', 'path', 'bytes', 'seconds', 'error'])
+DownloadResult.__doc__ = """
+Outcome of downloading one url.
+:param path: where the image was saved, or None when it failed
+:param bytes: size of the body received
+:param seconds: time taken, retries included
+:param error: the exception it failed with, else None
+"""
+
+
+def _manifest_info(manifest, path):
+    if manifest is None:
+        return None
+    fmt, width, height = image_info(path)
+    return fmt, width, height, os.path.getsize(path)
+
+
+def _fetch_image(image_url, dst_dir, file_name, timeout, proxies, transform, backend, manifest, query, metrics,
+                 session, budget):
+    """ One try at download_image; returns ``(path, size)`` and raises on any failure. """
+    started_at = time.time()
+    start = time.monotonic()
+    with session.get(image_url, headers=headers, timeout=timeout, proxies=proxies, stream=True) as response:
+        headers_at = time.monotonic()
+        if metrics is not None:
+            metrics.observe('response', headers_at - start)
+        if response.status_code >= 400 and metrics is not None:
+            metrics.observe_host(host_of(image_url), headers_at - start)
+        response.raise_for_status()
+        with PartFile(dst_dir, require_image=True) as part:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                part.write(chunk)
+                if metrics is not None:
+                    metrics.received(len(chunk))
+                if budget is not None:
+                    wait = budget.spend(len(chunk))
+                    if wait:
+                        time.sleep(wait)
+                if part.format is not None and part.format not in ALLOWED_FORMATS:
+                    raise NotAnImage('Unsupported image format {}'.format(part.format))
+            response.close()
+            part.close()
+            downloaded_at = time.monotonic()
+            if metrics is not None:
+                metrics.observe('transfer', downloaded_at - headers_at)
+                metrics.observe_host(host_of(image_url), downloaded_at - start)
+            size = part.size
+            if transform is not None:
+                transformed = transform_image(part.path, transform)
+                if metrics is not None:
+                    metrics.observe('process', time.monotonic() - downloaded_at)
+                try:
+                    info = _manifest_info(manifest, transformed.path)
+                    path = commit_transformed(part, transformed, backend, file_name, transform.keep_original)
+                finally:
+                    discard_transformed(transformed)
+            else:
+                info = _manifest_info(manifest, part.path)
+                path = backend.store(part.path, "{}.{}".format(file_name, extension(part.format)))
+            if metrics is not None:
+                metrics.saved()
+            if manifest is not None:
+                fmt, width, height, stored = info
+                manifest.add(query=query, url=image_url, path=path, bytes=stored, format=fmt,
+                             width=width, height=height, sha256=part.sha256.hexdigest(),
+                             started_at=started_at, download_seconds=downloaded_at - start,
+                             process_seconds=time.monotonic() - downloaded_at)
+            return path, size
+
+
+def make_session(pool_size=10):
+    """ A requests.Session keeping up to ``pool_size`` connections alive per host and to ``pool_size`` hosts. """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_image(image_url, dst_dir, file_name, timeout=20, proxy_type=None, proxy=None, transform=None,
+                   backend=None, manifest=None, query=None, metrics=None, retry=None, session=None, budget=None):
+    """
+    Download one image to dst_dir as ``file_name`` plus the extension of its
+    format, over ``session`` (a requests.Session, for connection reuse) when
+    given, drawing on ``budget`` (a ratelimit.TokenBucket of bytes) if set.
+    Returns a DownloadResult; failures are reported in it, not raised.
+    """
+    if backend is None:
+        backend = DirectoryBackend(dst_dir)
+    if retry is None:
+        retry = RetryPolicy()
     proxies = None
     if proxy_type is not None:
         proxies = {
@@ -28,60 +132,158 @@ def download_image(image_url, dst_dir, file_name, timeout=20, proxy_type=None, p
             "https": proxy_type + "://" + proxy
         }
 
-    response = None
-    file_path = os.path.join(dst_dir, file_name)
-    try_times = 0
-    while True:
+    start = time.monotonic()
+    try:
+        path, size = retry.call(_fetch_image, image_url, dst_dir, file_name, timeout, proxies, transform, backend,
+                                manifest, query, metrics, session or requests, budget, host=host_of(image_url),
+                                metrics=metrics)
+    except Exception as e:
+        if metrics is not None:
+            metrics.failed(e)
+        return DownloadResult(image_url, None, 0, time.monotonic() - start, e)
+    return DownloadResult(image_url, path, size, time.monotonic() - start, None)
+
+
+def iter_download_images(image_urls, dst_dir, file_prefix="img", concurrency=50, timeout=20, proxy_type=None,
+                         proxy=None, per_host=4, host_rate=None, transform=None, output_backend='directory',
+                         shard_size=1024 ** 3, manifest=None, query=None, metrics=None, retry=None,
+                         min_concurrency=None, max_concurrency=None, bandwidth=None):
+    """
+    Like download_images, but yield each DownloadResult as soon as it is
+    done, in completion order. ``image_urls`` may be any iterable and is
+    read lazily: only a few times ``concurrency`` urls are queued, in flight
+    or finished but not yet consumed at any time, so memory stays flat
+    however many urls there are, and a slow consumer slows the downloads
+    down. Closing the generator early skips the urls still queued.
+    When the concurrency is adaptive, max_concurrency threads are started
+    and the ones over the current limit wait for it to grow.
+    """
+
+    if not os.path.exists(dst_dir):
+        os.makedirs(dst_dir)
+
+    backend = make_backend(output_backend, dst_dir, shard_size)
+    if retry is None:
+        retry = RetryPolicy()
+    own_manifest = manifest is not None and not isinstance(manifest, Manifest)
+    if own_manifest:
+        manifest = Manifest(manifest)
+    limiter = None
+    if min_concurrency is not None or max_concurrency is not None:
+        limiter = AdaptiveLimit(min_concurrency or 1, max(max_concurrency or concurrency, concurrency),
+                                initial=concurrency)
+        concurrency = limiter.max_limit
+    budget = TokenBucket(bandwidth, bandwidth) if bandwidth else None
+    scheduler = HostScheduler(maxsize=concurrency * 2, per_host=per_host, host_rate=host_rate,
+                              key=lambda job: host_of(job[0]))
+    results = queue.Queue(maxsize=concurrency)
+    stop = threading.Event()
+    local = threading.local()
+    sessions = []
+
+    def feed():
         try:
-            try_times += 1
-            response = requests.get(
-                image_url, headers=headers, timeout=timeout, proxies=proxies)
-            with open(file_path, 'wb') as f:
-                f.write(response.content)
-            response.close()
-            file_type = imghdr.what(file_path)
-            # if file_type is not None:
-            if file_type in ["jpg", "jpeg", "png", "bmp", "webp"]:
-                new_file_name = "{}.{}".format(file_name, file_type)
-                new_file_path = os.path.join(dst_dir, new_file_name)
-                shutil.move(file_path, new_file_path)
-                print("## OK:  {}  {}".format(new_file_name, image_url))
-            else:
-                os.remove(file_path)
-                print("## Err: TYPE({})  {}".format(file_type, image_url))
-            break
-        except Exception as e:
-            if try_times < 3:
-                continue
-            if response:
-                response.close()
-            print("## Fail:  {}  {}".format(image_url, e.args))
-            break
-
-
-def download_images(image_urls, dst_dir, file_prefix="img", concurrency=50, timeout=20, proxy_type=None, proxy=None):
+            index = 0
+            for image_url in image_urls:
+                if stop.is_set():
+                    break
+                # Number on past files left by earlier runs rather than overwrite them.
+                while backend.taken(file_prefix + "_" + "%04d" % index):
+                    index += 1
+                scheduler.put((image_url, file_prefix + "_" + "%04d" % index))
+                index += 1
+        finally:
+            scheduler.close()
+
+    def work():
+        job = scheduler.get()
+        if job is None:
+            return False
+        try:
+            if not stop.is_set():
+                result = download_image(job[0], dst_dir, job[1], timeout, proxy_type, proxy, transform, backend,
+                                        manifest, query, metrics, retry, local.session, budget)
+                if limiter is not None:
+                    limiter.received(result.bytes)
+                    limiter.observe(result.seconds, result.error)
+                results.put(result)
+        finally:
+            scheduler.release(job)
+        return True
+
+    def worker():
+        local.session = make_session(concurrency)
+        sessions.append(local.session)
+        try:
+            while True:
+                if limiter is None:
+                    more = work()
+                else:
+                    # Threads beyond the current limit wait here, not on a job.
+                    with limiter.slot():
+                        more = work()
+                if not more:
+                    return
+        finally:
+            results.put(None)
+
+    finished = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency + 1) as executor:
+            feeder = executor.submit(feed)
+            for _ in range(concurrency):
+                executor.submit(worker)
+            try:
+                while finished < concurrency:
+                    result = results.get()
+                    if result is None:
+                        finished += 1
+                    else:
+                        yield result
+            finally:
+                # Stopped early: skip what is still queued and let the workers finish.
+                stop.set()
+                while finished < concurrency:
+                    if results.get() is None:
+                        finished += 1
+        feeder.result()
+    finally:
+        for session in sessions:
+            session.close()
+        backend.close()
+        if own_manifest:
+            manifest.close()
+
+
+def download_images(image_urls, dst_dir, file_prefix="img", concurrency=50, timeout=20, proxy_type=None, proxy=None,
+                    per_host=4, host_rate=None, transform=None, output_backend='directory', shard_size=1024 ** 3,
+                    manifest=None, query=None, metrics=None, retry=None, min_concurrency=None, max_concurrency=None,
+                    bandwidth=None):
     """
     Download image according to given urls and automatically rename them in order.
+    Each download thread keeps its own requests.Session, so connections are reused.
     :param timeout:
     :param proxy:
     :param proxy_type:
-    :param image_urls: list of image urls
+    :param image_urls: any iterable of image urls, read lazily
     :param dst_dir: output the downloaded images to dst_dir
     :param file_prefix: if set to "img", files will be in format "img_xxx.jpg"
-    :param concurrency: number of requests process simultaneously
-    :return: none
+    :param concurrency: number of requests process simultaneously, or the starting number when adaptive
+    :param min_concurrency: when this or max_concurrency is set, the number of requests in flight follows the
+        observed latency, timeouts and throughput (see adaptive.AdaptiveLimit), no lower than this
+    :param max_concurrency: and no higher than this
+    :param per_host: max number of requests in flight to a single host
+    :param host_rate: max requests per second to a single host, None for unlimited
+    :param transform: processing.Transform applied to each image by the download threads before it is saved
+    :param output_backend: "directory" for one file per image, or "tar" for rolling tar shards in dst_dir
+    :param shard_size: size in bytes at which a new tar shard is started
+    :param manifest: .jsonl or .parquet path (or a manifest.Manifest) receiving one record per saved image
+    :param query: keywords recorded in the manifest
+    :param metrics: metrics.Metrics updated by the download threads
+    :param retry: retry.RetryPolicy shared by the download threads, a default one if None
+    :param bandwidth: cap on the combined download rate in bytes per second, None for unlimited
+    :return: list of DownloadResult, one per url in completion order (see iter_download_images to stream them)
     """
-
-    socket.setdefaulttimeout(timeout)
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
-        future_list = list()
-        count = 0
-        if not os.path.exists(dst_dir):
-            os.makedirs(dst_dir)
-        for image_url in image_urls:
-            file_name = file_prefix + "_" + "%04d" % count
-            future_list.append(executor.submit(
-                download_image, image_url, dst_dir, file_name, timeout, proxy_type, proxy))
-            count += 1
-        concurrent.futures.wait(future_list, timeout=180)
\ No newline at end of file
+    return list(iter_download_images(image_urls, dst_dir, file_prefix, concurrency, timeout, proxy_type, proxy,
+                                     per_host, host_rate, transform, output_backend, shard_size, manifest, query,
+                                     metrics, retry, min_concurrency, max_concurrency, bandwidth))
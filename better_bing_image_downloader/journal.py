@@ -0,0 +1,69 @@
+""" On-disk journal of a crawl, so an interrupted or extended run can pick up where it stopped. """
+
+import os
+import sqlite3
+import threading
+
+DONE = 'done'
+FAILED = 'failed'
+DUPLICATE = 'duplicate'
+
+
+class Journal(object):
+    """
+    SQLite journal kept in the output directory of a query. It records the
+    last result page reached and, for every url tried, its status, local path
+    and sha256 of the saved body.
+    """
+
+    FILE_NAME = '.journal.sqlite'
+
+    def __init__(self, directory, query):
+        self.query = query
+        self.path = os.path.join(str(directory), self.FILE_NAME)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS runs ('
+                         'query TEXT PRIMARY KEY, page_counter INTEGER NOT NULL DEFAULT 0)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS urls ('
+                         'query TEXT NOT NULL, url TEXT NOT NULL, status TEXT NOT NULL, '
+                         'path TEXT, sha256 TEXT, PRIMARY KEY (query, url))')
+        self._db.execute('INSERT OR IGNORE INTO runs (query) VALUES (?)', (query,))
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    @property
+    def page_counter(self):
+        return self._execute('SELECT page_counter FROM runs WHERE query = ?', (self.query,))[0][0]
+
+    def checkpoint(self, page_counter):
+        self._execute('UPDATE runs SET page_counter = ? WHERE query = ?', (page_counter, self.query))
+
+    def status(self, url):
+        rows = self._execute('SELECT status FROM urls WHERE query = ? AND url = ?', (self.query, url))
+        return rows[0][0] if rows else None
+
+    def is_done(self, url):
+        return self.status(url) in (DONE, DUPLICATE)
+
+    def done_count(self):
+        return self._execute('SELECT COUNT(*) FROM urls WHERE query = ? AND status = ?',
+                             (self.query, DONE))[0][0]
+
+    def record(self, url, status, path=None, sha256=None):
+        self._execute('INSERT OR REPLACE INTO urls (query, url, status, path, sha256) VALUES (?, ?, ?, ?, ?)',
+                      (self.query, url, status, None if path is None else str(path), sha256))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
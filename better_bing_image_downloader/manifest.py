@@ -0,0 +1,98 @@
+""" Per-run manifest of downloaded images, so consumers can load a dataset index without walking the output. """
+
+import json
+import os
+import threading
+
+FIELDS = ['query', 'url', 'page_url', 'path', 'bytes', 'format', 'width', 'height', 'sha256',
+          'started_at', 'download_seconds', 'process_seconds']
+
+
+class Manifest(object):
+    """
+    Append-only record of every image saved during a run, one entry per
+    image with the FIELDS above (missing ones are None). Records are buffered
+    and written ``batch_size`` at a time, and whatever is left on close().
+
+    ``path`` ending in ``.parquet`` writes a Parquet file with one row group
+    per batch (this needs pyarrow); anything else is written as JSON lines,
+    appending to an existing file. Safe to share between threads and queries.
+    """
+
+    def __init__(self, path, batch_size=256):
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.parquet = self.path.endswith('.parquet')
+        self._lock = threading.Lock()
+        self._batch = []
+        self._writer = None
+        parent = os.path.dirname(self.path)
+        if parent and not os.path.isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+        if self.parquet:
+            try:
+                import pyarrow
+                import pyarrow.parquet
+            except ImportError:
+                raise ImportError('pyarrow is required to write a Parquet manifest; use a .jsonl path instead')
+            self._pa = pyarrow
+            self._schema = pyarrow.schema([
+                ('query', pyarrow.string()), ('url', pyarrow.string()), ('page_url', pyarrow.string()),
+                ('path', pyarrow.string()), ('bytes', pyarrow.int64()), ('format', pyarrow.string()),
+                ('width', pyarrow.int32()), ('height', pyarrow.int32()), ('sha256', pyarrow.string()),
+                ('started_at', pyarrow.float64()), ('download_seconds', pyarrow.float64()),
+                ('process_seconds', pyarrow.float64()),
+            ])
+            self._writer = pyarrow.parquet.ParquetWriter(self.path, self._schema)
+        else:
+            self._writer = open(self.path, 'a', encoding='utf-8')
+
+    def add(self, **fields):
+        """ Record one saved image. Unknown field names raise TypeError. """
+        unknown = set(fields) - set(FIELDS)
+        if unknown:
+            raise TypeError('Unknown manifest fields: {}'.format(', '.join(sorted(unknown))))
+        record = {name: fields.get(name) for name in FIELDS}
+        if record['path'] is not None:
+            record['path'] = str(record['path'])
+        with self._lock:
+            self._batch.append(record)
+            if len(self._batch) >= self.batch_size:
+                self._flush()
+
+    def _flush(self):
+        if not self._batch:
+            return
+        if self.parquet:
+            self._writer.write_table(self._pa.Table.from_pylist(self._batch, schema=self._schema))
+        else:
+            self._writer.write(''.join(json.dumps(record) + '\n' for record in self._batch))
+            self._writer.flush()
+        self._batch = []
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._flush()
+                self._writer.close()
+                self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def load_manifest(path):
+    """ Read a manifest back as a list of dicts with one sequential read. """
+    path = str(path)
+    if path.endswith('.parquet'):
+        import pyarrow.parquet
+        return pyarrow.parquet.read_table(path).to_pylist()
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
@@ -0,0 +1,310 @@
+""" Counters, stage latency histograms and throughput for a crawl, with JSON lines and Prometheus exporters. """
+
+import bisect
+import collections
+import contextlib
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .retry import HostUnavailable, status_of
+from .sniff import NotAnImage
+from .streaming import ImageTooLarge
+
+STAGES = ('page', 'connect', 'response', 'transfer', 'process', 'write')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+DownloadEvent = collections.namedtuple('DownloadEvent', ['query', 'url', 'status', 'path', 'bytes', 'seconds',
+                                                         'count', 'error'])
+DownloadEvent.__doc__ = """
+Passed to download callbacks once per image tried.
+:param status: journal.DONE, journal.DUPLICATE or journal.FAILED
+:param path: where the image was saved, or None
+:param bytes: size of the body received
+:param seconds: time from the request to the outcome
+:param count: images saved so far for the query
+:param error: the exception for failures, else None
+"""
+
+Stats = collections.namedtuple('Stats', ['elapsed', 'images', 'bytes', 'duplicates', 'retries', 'failures',
+                                         'images_per_second', 'mb_per_second', 'stages', 'hosts'])
+Stats.__doc__ = """
+Snapshot returned by Metrics.stats(). ``failures`` maps causes to counts;
+throughput is over the last ``Metrics.window`` seconds; ``stages`` and
+``hosts`` map names to {"count", "sum", "p50", "p95", "p99"} in seconds.
+"""
+
+
+def failure_cause(error):
+    """ Short label for why a download failed, used as the failures counter key. """
+    if isinstance(error, ImageTooLarge):
+        return 'too_large'
+    if isinstance(error, NotAnImage):
+        return 'not_image'
+    if isinstance(error, HostUnavailable):
+        return 'circuit_open'
+    status = status_of(error)
+    if status is not None:
+        return 'http_{}'.format(status)
+    name = type(error).__name__
+    if isinstance(error, TimeoutError) or 'Timeout' in name:
+        return 'timeout'
+    if isinstance(error, ConnectionError) or 'Connect' in name or 'Network' in name:
+        return 'connection'
+    if isinstance(error, ValueError):
+        return 'invalid'
+    return 'error'
+
+
+class Histogram(object):
+    """ Cumulative-bucket latency histogram with quantiles estimated from the buckets. """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95), 'p99': self.quantile(0.99)}
+
+
+class Metrics(object):
+    """
+    Thread-safe metrics shared by everything working on a crawl: counters for
+    saved images, bytes received, duplicates, retries and failures by cause,
+    latency histograms per stage (see STAGES) and per host, and throughput
+    over a sliding ``window`` of seconds. Read it with stats(), or export it
+    with JsonLinesReporter and PrometheusServer.
+    """
+
+    def __init__(self, window=10.0):
+        self.window = window
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self.images = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self.retries = 0
+        self.failures = collections.Counter()
+        self.stages = {}
+        self.hosts = {}
+        self._recent = collections.deque()
+
+    def _trim(self, now):
+        while self._recent and self._recent[0][0] < now - self.window:
+            self._recent.popleft()
+
+    def received(self, amount):
+        """ Count ``amount`` body bytes received. """
+        now = time.monotonic()
+        with self._lock:
+            self.bytes += amount
+            self._recent.append((now, 0, amount))
+            self._trim(now)
+
+    def saved(self):
+        now = time.monotonic()
+        with self._lock:
+            self.images += 1
+            self._recent.append((now, 1, 0))
+            self._trim(now)
+
+    def duplicate(self):
+        with self._lock:
+            self.duplicates += 1
+
+    def retry(self):
+        with self._lock:
+            self.retries += 1
+
+    def failed(self, cause):
+        """ Count a failure; ``cause`` is a label or an exception (see failure_cause). """
+        if isinstance(cause, BaseException):
+            cause = failure_cause(cause)
+        with self._lock:
+            self.failures[cause] += 1
+
+    def observe(self, stage, seconds):
+        """ Record the time spent in a stage. """
+        with self._lock:
+            self.stages.setdefault(stage, Histogram()).observe(seconds)
+
+    def observe_host(self, host, seconds):
+        """ Record the time a request to host took, from sending it to its last byte. """
+        with self._lock:
+            self.hosts.setdefault(host, Histogram()).observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.monotonic() - start)
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            self._trim(now)
+            span = min(self.window, now - self.started) or 1e-9
+            images = sum(item[1] for item in self._recent)
+            received = sum(item[2] for item in self._recent)
+            return Stats(
+                elapsed=now - self.started,
+                images=self.images,
+                bytes=self.bytes,
+                duplicates=self.duplicates,
+                retries=self.retries,
+                failures=dict(self.failures),
+                images_per_second=images / span,
+                mb_per_second=received / span / 1e6,
+                stages={name: h.summary() for name, h in self.stages.items()},
+                hosts={name: h.summary() for name, h in self.hosts.items()},
+            )
+
+    def prometheus(self, prefix='bing_downloader'):
+        """ The current metrics in the Prometheus text exposition format. """
+        stats = self.stats()
+        lines = []
+
+        def metric(name, kind, samples):
+            lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+            for labels, value in samples:
+                lines.append('{}_{}{} {}'.format(prefix, name, labels, value))
+
+        metric('images_total', 'counter', [('', stats.images)])
+        metric('bytes_total', 'counter', [('', stats.bytes)])
+        metric('duplicates_total', 'counter', [('', stats.duplicates)])
+        metric('retries_total', 'counter', [('', stats.retries)])
+        metric('failures_total', 'counter',
+               [('{{cause="{}"}}'.format(_escape(cause)), n) for cause, n in sorted(stats.failures.items())])
+        metric('images_per_second', 'gauge', [('', stats.images_per_second)])
+        metric('bytes_per_second', 'gauge', [('', stats.mb_per_second * 1e6)])
+        with self._lock:
+            for name, label, histograms in (('stage_seconds', 'stage', self.stages),
+                                            ('host_seconds', 'host', self.hosts)):
+                lines.append('# TYPE {}_{} histogram'.format(prefix, name))
+                for key, h in sorted(histograms.items()):
+                    key = _escape(key)
+                    cumulative = 0
+                    for bound, n in zip(h.buckets + ('+Inf',), h.counts):
+                        cumulative += n
+                        lines.append('{}_{}_bucket{{{}="{}",le="{}"}} {}'.format(
+                            prefix, name, label, key, bound, cumulative))
+                    lines.append('{}_{}_sum{{{}="{}"}} {}'.format(prefix, name, label, key, h.sum))
+                    lines.append('{}_{}_count{{{}="{}"}} {}'.format(prefix, name, label, key, h.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class JsonLinesReporter(object):
+    """
+    Write ``metrics.stats()`` as a JSON line to ``output`` (a path, appended
+    to, or a text stream; stderr by default) every ``interval`` seconds from
+    a background thread, and once more when stopped.
+    """
+
+    def __init__(self, metrics, output=None, interval=10.0):
+        self.metrics = metrics
+        self.interval = interval
+        self._own = isinstance(output, str)
+        self._stream = open(output, 'a', encoding='utf-8') if self._own else (output or sys.stderr)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='metrics-reporter', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+
+    def report(self):
+        record = self.metrics.stats()._asdict()
+        record['time'] = time.time()
+        self._stream.write(json.dumps(record) + '\n')
+        self._stream.flush()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.report()
+        if self._own:
+            self._stream.close()
+
+
+class PrometheusServer(object):
+    """ Serve ``metrics.prometheus()`` over HTTP at ``host:port`` (0 picks a free port) from a daemon thread. """
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+@contextlib.contextmanager
+def exporting(metrics, output=None, interval=10.0, port=None):
+    """
+    Run the exporters asked for around a crawl: JSON lines to ``output`` when
+    given, Prometheus on ``port`` when given. Does nothing if metrics is None.
+    """
+    reporter = server = None
+    if metrics is not None and output is not None:
+        reporter = JsonLinesReporter(metrics, output, interval).start()
+    if metrics is not None and port is not None:
+        server = PrometheusServer(metrics, port).start()
+    try:
+        yield
+    finally:
+        if server is not None:
+            server.close()
+        if reporter is not None:
+            reporter.stop()
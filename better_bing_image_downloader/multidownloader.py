@@ -4,11 +4,21 @@
 from __future__ import print_function
 
 import argparse
+import os
 import sys
 
-import crawler
-import helperdownload
-import utils
+if __package__ in (None, ""):
+    # Run as a script from inside the package directory.
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    __package__ = "better_bing_image_downloader"
+
+from . import crawler
+from . import cache
+from . import helperdownload
+from . import metrics
+from . import processing
+from . import retry
+from . import utils
 
 def main(argv):
     parser = argparse.ArgumentParser(description="Image helperdownload")
@@ -22,8 +32,50 @@ def main(argv):
                         help="Max number of images download for the keywords.")
     parser.add_argument("--num-threads", "-j", type=int, default=50,
                         help="Number of threads to concurrently download images.")
+    parser.add_argument("--min-threads", type=int, default=None,
+                        help="Adapt the number of downloading threads to latency and timeouts, no lower than this.")
+    parser.add_argument("--max-threads", type=int, default=None,
+                        help="Adapt the number of downloading threads to latency and timeouts, no higher than this.")
+    parser.add_argument("--bandwidth", type=int, default=None,
+                        help="Total download rate cap in bytes per second.")
+    parser.add_argument("--per-host", type=int, default=4,
+                        help="Max number of concurrent downloads from a single host.")
+    parser.add_argument("--host-rate", type=float, default=None,
+                        help="Max number of requests per second to a single host.")
     parser.add_argument("--timeout", "-t", type=int, default=10,
                         help="Seconds to timeout when download an image.")
+    parser.add_argument("--cache-dir", type=str, default=None,
+                        help="Cache Bing result pages in this directory (api driver only).")
+    parser.add_argument("--page-window", type=int, default=1,
+                        help="Bing result pages requested at a time (api driver only).")
+    parser.add_argument("--cache-ttl", type=int, default=24 * 3600,
+                        help="Seconds a cached result page stays valid.")
+    parser.add_argument("--resize-max-side", type=int, default=None,
+                        help="Shrink images so their longest side is at most this many pixels.")
+    parser.add_argument("--output-format", type=str, default=None, choices=["jpeg", "webp", "png"],
+                        help="Re-encode images to this format (metadata is stripped).")
+    parser.add_argument("--quality", type=int, default=85,
+                        help="Encoder quality for jpeg and webp output.")
+    parser.add_argument("--thumbnail-size", type=int, default=None,
+                        help="Also write thumbnails whose longest side is this many pixels.")
+    parser.add_argument("--keep-original", action="store_true", default=False,
+                        help="Keep the original next to transformed images.")
+    parser.add_argument("--output-backend", type=str, default="directory", choices=["directory", "tar"],
+                        help="Write one file per image, or append them to tar shards.")
+    parser.add_argument("--shard-size", type=int, default=1024 ** 3,
+                        help="Size in bytes at which a new tar shard is started.")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Write a manifest of saved images to this .jsonl or .parquet file.")
+    parser.add_argument("--metrics-file", type=str, default=None,
+                        help="Append download metrics as JSON lines to this file.")
+    parser.add_argument("--metrics-interval", type=float, default=10.0,
+                        help="Seconds between lines in --metrics-file.")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Serve Prometheus metrics on this localhost port while downloading.")
+    parser.add_argument("--retries", type=int, default=3,
+                        help="Tries per image for timeouts, connection errors and 429/5xx answers.")
+    parser.add_argument("--breaker-threshold", type=int, default=5,
+                        help="Failures in a row after which a host is left alone for a while (0 to disable).")
     parser.add_argument("--output", "-o", type=str, default="./download_images",
                         help="Output directory to save downloaded images.")
     parser.add_argument("--safe-mode", "-S", action="store_true", default=False,
@@ -58,15 +110,38 @@ def main(argv):
         print("Dependencies not resolved, exit.")
         return
 
+    transform = None
+    if args.resize_max_side or args.output_format or args.thumbnail_size:
+        transform = processing.Transform(args.resize_max_side, args.output_format, args.quality,
+                                         args.thumbnail_size, args.keep_original)
+
+    page_cache = None
+    if args.cache_dir is not None:
+        page_cache = cache.DiskCache(args.cache_dir, args.cache_ttl)
+
+    # A generator: images are downloaded while the crawl is still finding more.
     crawled_urls = crawler.crawl_image_urls(args.keywords,
                                             engine=args.engine, max_number=args.max_number,
                                             face_only=args.face_only, safe_mode=args.safe_mode,
                                             proxy_type=proxy_type, proxy=proxy,
-                                            browser=args.driver, image_type=args.type, color=args.color)
-    helperdownload.download_images(image_urls=crawled_urls, dst_dir=args.output,
-                               concurrency=args.num_threads, timeout=args.timeout,
-                               proxy_type=proxy_type, proxy=proxy,
-                               file_prefix=args.engine)
+                                            browser=args.driver, image_type=args.type, color=args.color,
+                                            cache=page_cache, page_window=args.page_window, stream=True)
+    download_metrics = None
+    if args.metrics_file is not None or args.metrics_port is not None:
+        download_metrics = metrics.Metrics()
+    with metrics.exporting(download_metrics, args.metrics_file, args.metrics_interval, args.metrics_port):
+        results = helperdownload.iter_download_images(
+            image_urls=crawled_urls, dst_dir=args.output, concurrency=args.num_threads, timeout=args.timeout,
+            proxy_type=proxy_type, proxy=proxy, file_prefix=args.engine, per_host=args.per_host,
+            host_rate=args.host_rate, transform=transform, output_backend=args.output_backend,
+            shard_size=args.shard_size, manifest=args.manifest, query=args.keywords, metrics=download_metrics,
+            retry=retry.RetryPolicy(args.retries, breaker_threshold=args.breaker_threshold),
+            min_concurrency=args.min_threads, max_concurrency=args.max_threads, bandwidth=args.bandwidth)
+        for result in results:
+            if result.error is None:
+                print("## OK:  {}  {}".format(os.path.basename(result.path), result.url))
+            else:
+                print("## Fail:  {}  {}".format(result.url, result.error))
 
     print("Finished.")
 
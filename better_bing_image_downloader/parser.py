@@ -0,0 +1,131 @@
+""" Parse Bing result pages into image records, and filter them before any image is fetched. """
+
+import html
+import json
+import posixpath
+import re
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+ImageCandidate = namedtuple('ImageCandidate', ['url', 'width', 'height', 'content_size', 'format',
+                                               'thumbnail_url', 'page_url'])
+
+_ITEM = re.compile(r'class="iusc"')
+_M = re.compile(r'\sm="([^"]*)"')
+_MAD = re.compile(r'\smad="([^"]*)"')
+_EXP = re.compile(r'expw=(\d+)&amp;exph=(\d+)')
+_INFO = re.compile(r'(\d+)\s*(?:x|&#215;|×)\s*(\d+)\s*(?:&#183;|·)\s*(\w+)')
+_MURL = re.compile('murl&quot;:&quot;(.*?)&quot;')
+
+_EXTENSIONS = {'jpg': 'jpeg', 'jpe': 'jpeg', 'jpeg': 'jpeg', 'jfif': 'jpeg', 'png': 'png', 'gif': 'gif',
+               'bmp': 'bmp', 'webp': 'webp', 'tif': 'tiff', 'tiff': 'tiff'}
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _format_from_url(url):
+    extension = posixpath.splitext(urlsplit(url).path)[1][1:].lower()
+    return _EXTENSIONS.get(extension)
+
+
+def _parse_item(segment):
+    match = _M.search(segment)
+    if match is None:
+        return None
+    try:
+        m = json.loads(html.unescape(match.group(1)))
+    except ValueError:
+        return None
+    url = m.get('murl')
+    if not url:
+        return None
+    mad = {}
+    match = _MAD.search(segment)
+    if match is not None:
+        try:
+            mad = json.loads(html.unescape(match.group(1)))
+        except ValueError:
+            pass
+    width = height = fmt = None
+    match = _EXP.search(segment)
+    if match is not None:
+        width, height = int(match.group(1)), int(match.group(2))
+    match = _INFO.search(segment)
+    if match is not None:
+        if width is None:
+            width, height = int(match.group(1)), int(match.group(2))
+        fmt = _EXTENSIONS.get(match.group(3).lower(), match.group(3).lower())
+    return ImageCandidate(
+        url=url,
+        width=width,
+        height=height,
+        content_size=_int(m.get('size') or mad.get('size')),
+        format=fmt or _format_from_url(url),
+        thumbnail_url=m.get('turl') or mad.get('turl'),
+        page_url=m.get('purl'),
+    )
+
+
+def parse_result_page(page):
+    """
+    Yield an ImageCandidate for every result on a Bing images page, taking the
+    url, thumbnail and source page from the ``m``/``mad`` JSON attributes and
+    the dimensions and format from the result's detail link and caption.
+    Fields the page does not carry are None. Pages without ``iusc`` results
+    fall back to bare ``murl`` matches.
+    """
+    starts = [match.start() for match in _ITEM.finditer(page)]
+    if not starts:
+        for url in _MURL.findall(page):
+            yield ImageCandidate(url, None, None, None, _format_from_url(url), None, None)
+        return
+    starts.append(len(page))
+    for start, end in zip(starts, starts[1:]):
+        candidate = _parse_item(page[start:end])
+        if candidate is not None:
+            yield candidate
+
+
+class CandidateFilter(object):
+    """
+    Predicates applied to ImageCandidates before download. A candidate is only
+    rejected on what the page tells about it; unknown sizes pass.
+    :param min_width: minimum width in pixels
+    :param min_height: minimum height in pixels
+    :param max_bytes: maximum content size in bytes
+    :param min_aspect: minimum width / height ratio
+    :param max_aspect: maximum width / height ratio
+    """
+
+    def __init__(self, min_width=None, min_height=None, max_bytes=None, min_aspect=None, max_aspect=None):
+        self.min_width = min_width
+        self.min_height = min_height
+        self.max_bytes = max_bytes
+        self.min_aspect = min_aspect
+        self.max_aspect = max_aspect
+
+    def __bool__(self):
+        return any(value is not None for value in
+                   (self.min_width, self.min_height, self.max_bytes, self.min_aspect, self.max_aspect))
+
+    def accepts(self, candidate):
+        width, height = candidate.width, candidate.height
+        if self.min_width is not None and width is not None and width < self.min_width:
+            return False
+        if self.min_height is not None and height is not None and height < self.min_height:
+            return False
+        if self.max_bytes is not None and candidate.content_size is not None \
+                and candidate.content_size > self.max_bytes:
+            return False
+        if width and height:
+            aspect = width / height
+            if self.min_aspect is not None and aspect < self.min_aspect:
+                return False
+            if self.max_aspect is not None and aspect > self.max_aspect:
+                return False
+        return True
@@ -0,0 +1,172 @@
+""" CPU-bound image work (decoding, verification, hashing), kept off the event loop. """
+
+import asyncio
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps
+
+from .dedup import image_phash
+from .sniff import extension
+
+Transform = namedtuple('Transform', ['resize_max_side', 'output_format', 'quality', 'thumbnail_size',
+                                     'keep_original'])
+Transform.__new__.__defaults__ = (None, None, 85, None, False)
+Transform.__doc__ = """
+Options for transform_image.
+:param resize_max_side: shrink images so their longest side is at most this many pixels
+:param output_format: "jpeg", "webp" or "png"; None keeps the source format
+:param quality: encoder quality for jpeg and webp
+:param thumbnail_size: also write a thumbnail whose longest side is this many pixels
+:param keep_original: keep the downloaded file next to the transformed one
+"""
+
+Transformed = namedtuple('Transformed', ['path', 'format', 'thumbnail_path'])
+
+_SAVE_FORMATS = {'jpeg': 'JPEG', 'webp': 'WEBP', 'png': 'PNG', 'gif': 'GIF', 'bmp': 'BMP', 'tiff': 'TIFF'}
+
+
+def verify_image(path):
+    """
+    Fully parse the image at path with PIL; raise ValueError if it is broken.
+    """
+    try:
+        with Image.open(path) as img:
+            img.verify()
+    except (IOError, SyntaxError) as e:
+        raise ValueError('Invalid image: {}'.format(e))
+
+
+def examine_image(path, verify=False, phash=False):
+    """
+    Worker entry point: verify the image at path if asked and return its
+    perceptual hash if asked (None otherwise, or when it cannot be decoded
+    and verification was not requested).
+    """
+    if verify:
+        verify_image(path)
+    if not phash:
+        return None
+    try:
+        return image_phash(path)
+    except Exception:
+        if verify:
+            raise ValueError('Invalid image: cannot decode {}'.format(path))
+        return None
+
+
+def image_info(path):
+    """
+    ``(format, width, height)`` of the image at path, read from its header
+    only, or ``(None, None, None)`` when PIL cannot tell.
+    """
+    try:
+        with Image.open(path) as img:
+            return (img.format or '').lower() or None, img.width, img.height
+    except Exception:
+        return None, None, None
+
+
+def _save(img, path, fmt, quality):
+    if fmt == 'jpeg' and img.mode != 'RGB':
+        img = img.convert('RGB')
+    elif img.mode not in ('RGB', 'RGBA', 'L'):
+        img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+    options = {'quality': quality} if fmt in ('jpeg', 'webp') else {}
+    img.save(path, _SAVE_FORMATS[fmt], **options)
+
+
+def transform_image(path, transform):
+    """
+    Worker entry point: decode the image at path once, apply its EXIF
+    orientation, resize and re-encode it without metadata into a sibling temp
+    file (plus an optional thumbnail). Returns a Transformed; the caller
+    renames the outputs into place.
+    """
+    with Image.open(path) as img:
+        fmt = transform.output_format or (img.format or 'jpeg').lower()
+        if fmt not in _SAVE_FORMATS:
+            fmt = 'jpeg'
+        img = ImageOps.exif_transpose(img)
+        if transform.resize_max_side:
+            img.thumbnail((transform.resize_max_side, transform.resize_max_side), Image.LANCZOS)
+        out_path = path + '.out'
+        _save(img, out_path, fmt, transform.quality)
+        thumbnail_path = None
+        if transform.thumbnail_size:
+            img.thumbnail((transform.thumbnail_size, transform.thumbnail_size), Image.LANCZOS)
+            thumbnail_path = path + '.thumb'
+            _save(img, thumbnail_path, fmt, transform.quality)
+    return Transformed(out_path, fmt, thumbnail_path)
+
+
+def commit_transformed(part, transformed, backend, stem, keep_original=False):
+    """
+    Store a transform_image result as ``stem.<ext>`` in the output backend,
+    its thumbnail under ``thumbnails/`` and, with keep_original, the
+    downloaded PartFile under ``originals/``. Returns the image's location.
+    """
+    name = '{}.{}'.format(stem, extension(transformed.format))
+    location = backend.store(transformed.path, name)
+    if transformed.thumbnail_path is not None:
+        backend.store(transformed.thumbnail_path, 'thumbnails/' + name)
+    if keep_original:
+        part.close()
+        backend.store(part.path, 'originals/{}.{}'.format(stem, extension(part.format)))
+    return location
+
+
+def discard_transformed(transformed):
+    for path in (transformed.path, transformed.thumbnail_path):
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+
+
+def _discard_result(job, discard):
+    if not job.cancelled() and job.exception() is None:
+        discard(job.result())
+
+
+class ImagePool(object):
+    """
+    ProcessPoolExecutor sized to the CPU count for decode/validate work.
+    At most ``max_pending`` jobs are queued or running; callers of run() wait
+    for a free place, which pushes back on the network workers feeding it
+    instead of letting finished downloads pile up.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_pending = max_pending or self.workers * 2
+        self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        self._slots = None
+
+    async def run(self, fn, *args, discard=None):
+        """
+        Run fn(*args) in the pool. If the caller is cancelled once the job has
+        started, the job is waited for and its result passed to ``discard``,
+        so files it writes are not left behind.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_pending)
+        async with self._slots:
+            job = self._executor.submit(fn, *args)
+            future = asyncio.wrap_future(job)
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not job.cancel():
+                    if discard is not None:
+                        job.add_done_callback(lambda job: _discard_result(job, discard))
+                    await asyncio.wait([future])
+                raise
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
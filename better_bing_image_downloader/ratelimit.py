@@ -0,0 +1,73 @@
+""" Token bucket rate limiting shared by the page fetcher and the image workers. """
+
+import asyncio
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    Classic token bucket: ``rate`` tokens are added per second up to
+    ``capacity``. A rate of None (or <= 0) never limits.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now=None):
+        """
+        Take a token if one is available and return 0, otherwise return the
+        number of seconds until the next token arrives without taking it.
+        """
+        if not self.rate or self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic() if now is None else now
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def spend(self, amount, now=None):
+        """
+        Take ``amount`` tokens at once, going into debt if needed, and return
+        the number of seconds the caller should wait to pay the debt back.
+        Used for byte budgets, where a chunk can be larger than the bucket.
+        """
+        if not self.rate or self.rate <= 0:
+            return 0
+        with self._lock:
+            now = time.monotonic() if now is None else now
+            self._refill(now)
+            self.tokens -= amount
+            return max(0, -self.tokens / self.rate)
+
+    async def spend_async(self, amount):
+        wait = self.spend(amount)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def acquire(self):
+        """ Block the calling thread until a token is available. """
+        while True:
+            wait = self.delay()
+            if wait == 0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """ Wait on the event loop until a token is available. """
+        while True:
+            wait = self.delay()
+            if wait == 0:
+                return
+            await asyncio.sleep(wait)
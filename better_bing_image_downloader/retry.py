@@ -0,0 +1,204 @@
+""" Retry policy shared by the page and image fetchers: failure classification, backoff and per-host circuit breaking. """
+
+import asyncio
+import email.utils
+import random
+import threading
+import time
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Exception classes (matched by name anywhere in the MRO, so that none of the
+# HTTP libraries has to be imported here) whose failures are worth retrying.
+_TRANSIENT = {
+    'TimeoutError', 'Timeout', 'TimeoutException',  # builtins, requests, httpx
+    'ConnectionError', 'ChunkedEncodingError',  # builtins and requests
+    'TransportError',  # httpx (connect, read, write and protocol errors)
+    'ClientConnectionError', 'ClientPayloadError',  # aiohttp
+    'URLError',  # urllib without an HTTP status: refused, reset, DNS
+    'IncompleteRead', 'RemoteDisconnected',  # http.client
+}
+
+
+class HostUnavailable(Exception):
+    """ Raised instead of a request while the circuit breaker of its host is open. """
+
+
+def status_of(error):
+    """ HTTP status carried by an exception from httpx, requests, aiohttp or urllib, else None. """
+    for value in (getattr(getattr(error, 'response', None), 'status_code', None),
+                  getattr(error, 'status', None), getattr(error, 'code', None)):
+        if isinstance(value, int) and 100 <= value < 600:
+            return value
+    return None
+
+
+def retry_after(error):
+    """ Seconds asked for by the Retry-After header of the response behind error, else None. """
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or getattr(error, 'headers', None)
+    value = headers.get('Retry-After') if headers is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy(object):
+    """
+    When and how long to wait before trying a request again, and which hosts
+    to leave alone for a while. One instance is meant to be shared by every
+    worker of a crawl, so the circuit breakers see all traffic to a host.
+
+    Timeouts, connection errors and ``retry_statuses`` responses are retried
+    up to ``attempts`` tries in all, waiting ``backoff * 2 ** (n - 1)``
+    seconds (capped at ``max_backoff``, half of it random jitter) or what
+    ``Retry-After`` asks for, up to ``max_retry_after``. Anything else,
+    including other 4xx responses and bodies that are not images, fails at
+    once.
+
+    After ``breaker_threshold`` retryable failures in a row a host's circuit
+    opens: calls for it raise HostUnavailable without touching the network
+    for ``breaker_cooldown`` seconds. Then one trial request is let through;
+    its success closes the circuit and its failure opens it again.
+    """
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=30.0, retry_statuses=RETRY_STATUSES,
+                 max_retry_after=60.0, breaker_threshold=5, breaker_cooldown=30.0):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = tuple(retry_statuses)
+        self.max_retry_after = max_retry_after
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def retryable(self, error):
+        if isinstance(error, HostUnavailable):
+            return False
+        status = status_of(error)
+        if status is not None:
+            return status in self.retry_statuses
+        if isinstance(error, ValueError):
+            return False
+        return any(cls.__name__ in _TRANSIENT for cls in type(error).__mro__)
+
+    def delay(self, attempt, error=None):
+        """ Seconds to wait after the ``attempt``-th failed try (counting from 1). """
+        base = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        wait = base / 2 + random.uniform(0, base / 2)
+        asked = retry_after(error) if error is not None else None
+        if asked is not None:
+            wait = max(wait, min(asked, self.max_retry_after))
+        return wait
+
+    def allow(self, host, now=None):
+        """ Whether a request may go to host now; takes the trial slot of a half-open circuit. """
+        if host is None or not self.breaker_threshold:
+            return True
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state[1] is None:
+                return True
+            if now < state[1] + self.breaker_cooldown or state[2]:
+                return False
+            state[2] = True
+            return True
+
+    def success(self, host):
+        if host is not None:
+            with self._lock:
+                self._hosts.pop(host, None)
+
+    def failure(self, host, error, now=None):
+        """
+        Count a failed request to host. Only retryable failures count toward
+        opening its circuit; any other answer shows the host is up.
+        """
+        if host is None or not self.breaker_threshold or isinstance(error, HostUnavailable):
+            return
+        if not self.retryable(error):
+            self.success(host)
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            # [failures in a row, time the circuit opened, trial in flight]
+            state = self._hosts.setdefault(host, [0, None, False])
+            state[0] += 1
+            if state[2] or state[0] >= self.breaker_threshold:
+                state[1] = now
+            state[2] = False
+
+    def abandon(self, host):
+        """ A request to host ended without an answer (cancelled); free the trial slot it may hold. """
+        if host is not None:
+            with self._lock:
+                state = self._hosts.get(host)
+                if state is not None:
+                    state[2] = False
+
+    def is_open(self, host, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._hosts.get(host)
+            return state is not None and state[1] is not None and now < state[1] + self.breaker_cooldown
+
+    def _check(self, host):
+        if not self.allow(host):
+            raise HostUnavailable('Circuit open for {}'.format(host))
+
+    def _retry(self, attempt, error, host, metrics):
+        self.failure(host, error)
+        if attempt >= self.attempts or not self.retryable(error) or self.is_open(host):
+            return None
+        if metrics is not None:
+            metrics.retry()
+        return self.delay(attempt, error)
+
+    def call(self, fn, *args, host=None, metrics=None, **kwargs):
+        """ Call fn until it returns, retrying as the policy says; the last error is raised. """
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check(host)
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                wait = self._retry(attempt, e, host, metrics)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+            except BaseException:
+                self.abandon(host)
+                raise
+            else:
+                self.success(host)
+                return result
+
+    async def call_async(self, fn, *args, host=None, metrics=None, **kwargs):
+        """ Like call() for a coroutine function, waiting on the event loop. """
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check(host)
+            try:
+                result = await fn(*args, **kwargs)
+            except Exception as e:
+                wait = self._retry(attempt, e, host, metrics)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+            except BaseException:
+                self.abandon(host)
+                raise
+            else:
+                self.success(host)
+                return result
@@ -0,0 +1,382 @@
+"""
+Download a large keyword list with several worker processes, each running
+its own download_many event loop and asking the parent for keywords as it
+has room for them.
+
+    python -m better_bing_image_downloader.runner keywords.txt --workers 8 --limit 100
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from multiprocessing.connection import wait
+
+STATE_FILE = '.runner.jsonl'
+
+RunSummary = collections.namedtuple('RunSummary', ['keywords', 'completed', 'errors', 'skipped', 'downloaded',
+                                                   'failed', 'duplicates', 'bytes', 'seconds', 'restarts',
+                                                   'interrupted'])
+RunSummary.__doc__ = """
+Progress of a ShardedRunner, merged over its workers.
+:param keywords: keywords in the job, including skipped ones
+:param completed: keywords finished in this run
+:param errors: keywords whose download raised
+:param skipped: keywords already completed by an earlier run
+:param downloaded: images saved, summed over QueryResults
+:param failed: images that could not be downloaded
+:param duplicates: images dropped as duplicates
+:param bytes: image bytes received
+:param seconds: time since the run started
+:param restarts: worker processes restarted after dying
+:param interrupted: whether the run was shut down before finishing
+"""
+
+
+def read_keywords(path):
+    """ Keywords from a file, one per line; blank lines, ``#`` comments and repeats are skipped. """
+    keywords = []
+    seen = set()
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            keyword = line.strip()
+            if keyword and not keyword.startswith('#') and keyword not in seen:
+                seen.add(keyword)
+                keywords.append(keyword)
+    return keywords
+
+
+def load_state(output_dir):
+    """ Keywords recorded as completed without error in the state file of output_dir. """
+    done = set()
+    try:
+        with open(os.path.join(output_dir, STATE_FILE), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                if record.get('error') is None:
+                    done.add(record['keyword'])
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def _shard_path(path, shard):
+    root, ext = os.path.splitext(path)
+    return '{}-{}{}'.format(root, shard, ext)
+
+
+def _worker(shard, tasks, events, options, interval, initializer, initargs):
+    # The parent handles Ctrl-C and stops handing out keywords instead.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if initializer is not None:
+        initializer(*initargs)
+    asyncio.run(_serve(shard, tasks, events, options, interval))
+
+
+async def _serve(shard, tasks, events, options, interval):
+    """
+    Run download_many over keywords asked from the parent one at a time, as
+    query slots free up. ``tasks`` receives the keywords (None for no more),
+    ``events`` carries the requests and the progress back; only the event
+    loop thread sends on it.
+    """
+    from .download import download_many
+    from .metrics import Metrics
+
+    loop = asyncio.get_running_loop()
+    metrics = Metrics()
+
+    async def keywords():
+        while True:
+            events.send(('want', shard))
+            keyword = await loop.run_in_executor(None, tasks.recv)
+            if keyword is None:
+                return
+            yield keyword
+
+    def on_result(keyword, result):
+        if isinstance(result, Exception):
+            events.send(('done', shard, keyword, 0, 0, 0, repr(result)))
+        else:
+            events.send(('done', shard, keyword, result.downloaded, result.failed, result.duplicates, None))
+
+    def progress():
+        stats = metrics.stats()
+        events.send(('progress', shard, stats.images, stats.bytes))
+
+    async def report():
+        while True:
+            await asyncio.sleep(interval)
+            progress()
+
+    reporter = asyncio.ensure_future(report())
+    try:
+        await download_many(keywords(), metrics=metrics, on_result=on_result, **options)
+    finally:
+        reporter.cancel()
+        progress()
+
+
+class ShardedRunner(object):
+    """
+    Download images for every keyword with ``workers`` processes (one per
+    CPU by default). Each process runs download_many with its own event
+    loop, connection pool and ``query_concurrency`` queries at a time, and
+    takes its next keyword from a queue shared by all of them, so a shard
+    that drew slow keywords never holds the others back.
+
+    Every finished keyword is appended to a state file in ``output_dir``.
+    A later run over the same directory skips the keywords completed there.
+    Together with the per-query journals, an interrupted job picks up where
+    it stopped.
+
+    shutdown(), which Ctrl-C or SIGTERM also call during run(), stops
+    handing out keywords. The queries under way finish, then run() returns
+    the summary. A second Ctrl-C terminates the workers at once. A worker
+    that dies has its unfinished keywords put back on the queue. It is
+    started again up to ``max_restarts`` times. restart(shard) replaces a
+    worker on demand.
+
+    ``progress`` is called with a RunSummary every ``progress_interval``
+    seconds. ``initializer(*initargs)`` runs first in every worker process.
+    Other keyword arguments go to download_many. They must be picklable,
+    so they cannot include ``metrics`` or ``retry``, which each worker
+    creates for itself. A ``manifest`` path gets one file per shard (its
+    name with ``-<shard>`` added), and ``bandwidth`` applies per worker.
+    ``seen`` must be a file path: every worker loads it and merges what it
+    saved into it when it finishes. ``seen_error_rate`` makes a new file a
+    Bloom filter, as for downloader.
+    """
+
+    def __init__(self, keywords, output_dir='downloads', workers=None, query_concurrency=4, max_restarts=3,
+                 progress=None, progress_interval=1.0, initializer=None, initargs=(), **options):
+        seen = options.get('seen')
+        if seen is not None and not isinstance(seen, (str, os.PathLike)):
+            raise ValueError('seen must be a file path, shared by the workers through the file')
+        if seen is not None:
+            from .seen import open_seen
+
+            # Reject a file of the wrong kind here rather than in every worker.
+            open_seen(seen, options.get('seen_error_rate'))
+        self.keywords = list(keywords)
+        self.output_dir = output_dir
+        self.workers = workers or os.cpu_count() or 1
+        self.query_concurrency = query_concurrency
+        self.max_restarts = max_restarts
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.initializer = initializer
+        self.initargs = initargs
+        self.options = options
+        self._context = multiprocessing.get_context('spawn')
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        # shard -> (process, keyword sender, event receiver)
+        self._shards = {}
+        self._restart_requested = set()
+        self._interrupts = 0
+
+    def _options(self, shard):
+        options = dict(self.options, output_dir=self.output_dir, query_concurrency=self.query_concurrency)
+        if options.get('manifest') is not None:
+            options['manifest'] = _shard_path(options['manifest'], shard)
+        return options
+
+    def _spawn(self, shard):
+        # A pipe each way per worker rather than shared queues: a worker that
+        # dies while waiting on a shared queue would leave its lock held.
+        tasks_recv, tasks_send = self._context.Pipe(duplex=False)
+        events_recv, events_send = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker, name='runner-{}'.format(shard),
+            args=(shard, tasks_recv, events_send, self._options(shard), self.progress_interval,
+                  self.initializer, self.initargs))
+        process.start()
+        tasks_recv.close()
+        events_send.close()
+        with self._lock:
+            self._shards[shard] = (process, tasks_send, events_recv)
+
+    def shutdown(self):
+        """ Stop handing out keywords; the queries under way are finished. """
+        self._stop.set()
+
+    def terminate(self):
+        """ Stop every worker at once; unfinished queries resume from their journals next time. """
+        self._stop.set()
+        with self._lock:
+            for process, _, _ in self._shards.values():
+                process.terminate()
+
+    def restart(self, shard):
+        """ Replace the process of shard; its unfinished keywords are handed out again. """
+        with self._lock:
+            if shard not in self._shards:
+                return
+            self._restart_requested.add(shard)
+            self._shards[shard][0].terminate()
+
+    def _on_signal(self, signum, frame):
+        self._interrupts += 1
+        if self._interrupts == 1:
+            print('Finishing the queries under way; interrupt again to stop at once.', file=sys.stderr)
+            self.shutdown()
+        else:
+            self.terminate()
+
+    def run(self):
+        """ Run the job to completion (or shutdown) and return its RunSummary. """
+        os.makedirs(self.output_dir, exist_ok=True)
+        done = load_state(self.output_dir)
+        pending = [keyword for keyword in self.keywords if keyword not in done]
+
+        handlers = {}
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                handlers[signum] = signal.signal(signum, self._on_signal)
+        try:
+            with open(os.path.join(self.output_dir, STATE_FILE), 'a', encoding='utf-8') as state:
+                return self._run(pending, len(self.keywords) - len(pending), state)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+
+    def _run(self, pending, skipped, state):
+        start = last_progress = time.monotonic()
+        queued = collections.deque(pending)
+        remaining = set(pending)
+        waiting = set()
+        in_flight = collections.defaultdict(set)
+        current = {}
+        totals = collections.Counter()
+
+        def summary():
+            return RunSummary(len(self.keywords), totals['completed'], totals['errors'], skipped,
+                              totals['downloaded'], totals['failed'], totals['duplicates'],
+                              totals['bytes'] + sum(current.values()), time.monotonic() - start,
+                              totals['restarts'], self._stop.is_set() and bool(remaining))
+
+        def send(shard, keyword):
+            waiting.discard(shard)
+            try:
+                self._shards[shard][1].send(keyword)
+            except OSError:
+                pass  # it died; its end of file is handled below
+            if keyword is not None:
+                in_flight[shard].add(keyword)
+
+        def handle(shard, event):
+            kind = event[0]
+            if kind == 'want':
+                waiting.add(shard)
+            elif kind == 'progress':
+                current[shard] = event[3]
+            elif kind == 'done':
+                keyword, downloaded, failed, duplicates, error = event[2:]
+                in_flight[shard].discard(keyword)
+                if keyword not in remaining:
+                    return
+                remaining.discard(keyword)
+                totals['errors' if error else 'completed'] += 1
+                totals['downloaded'] += downloaded
+                totals['failed'] += failed
+                totals['duplicates'] += duplicates
+                state.write(json.dumps({'keyword': keyword, 'shard': shard, 'downloaded': downloaded,
+                                        'failed': failed, 'duplicates': duplicates, 'error': error}) + '\n')
+                state.flush()
+
+        def exited(shard):
+            with self._lock:
+                process, tasks, events = self._shards.pop(shard)
+                requested = shard in self._restart_requested
+                self._restart_requested.discard(shard)
+            process.join()
+            tasks.close()
+            events.close()
+            waiting.discard(shard)
+            totals['bytes'] += current.pop(shard, 0)
+            # Whatever it had not finished goes to the front of the queue.
+            queued.extendleft(keyword for keyword in in_flight.pop(shard, ()) if keyword in remaining)
+            if process.exitcode != 0 and remaining and not self._stop.is_set() and (
+                    requested or totals['restarts'] < self.max_restarts):
+                totals['restarts'] += 1
+                self._spawn(shard)
+
+        for shard in range(min(self.workers, len(pending))):
+            self._spawn(shard)
+        while self._shards:
+            readers = {events: shard for shard, (_, _, events) in self._shards.items()}
+            for events in wait(list(readers), timeout=0.2):
+                shard = readers[events]
+                try:
+                    handle(shard, events.recv())
+                except (EOFError, OSError):
+                    exited(shard)
+            for shard in list(waiting):
+                if self._stop.is_set() or not remaining:
+                    send(shard, None)
+                elif queued:
+                    send(shard, queued.popleft())
+            if self.progress is not None and time.monotonic() - last_progress >= self.progress_interval:
+                last_progress = time.monotonic()
+                self.progress(summary())
+        return summary()
+
+
+def format_summary(summary):
+    return ('{0.completed}/{1} keywords done, {0.errors} errors, {0.downloaded} images, {0.failed} failed, '
+            '{0.duplicates} duplicates, {2:.1f} MB in {0.seconds:.0f}s ({3:.1f} MB/s), {0.restarts} restarts'.format(
+                summary, summary.keywords - summary.skipped, summary.bytes / 1e6,
+                summary.bytes / 1e6 / max(summary.seconds, 1e-9)))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Download images for a keyword file with several processes.')
+    parser.add_argument('keywords_file', type=str, help='File with one keyword per line.')
+    parser.add_argument('-o', '--output-dir', type=str, default='dataset', help='Output directory.')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Worker processes (default: CPU count).')
+    parser.add_argument('--query-concurrency', type=int, default=4, help='Keywords downloaded at once per worker.')
+    parser.add_argument('-l', '--limit', type=int, default=100, help='Images to download per keyword.')
+    parser.add_argument('--max-connections', type=int, default=32, help='Concurrent image requests per worker.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent image requests per keyword.')
+    parser.add_argument('--per-host', type=int, default=4, help='Concurrent requests to one host per worker.')
+    parser.add_argument('--page-rate', type=float, default=1.0, help='Result pages per second per keyword.')
+    parser.add_argument('-t', '--timeout', type=int, default=60, help='Timeout for connection in seconds.')
+    parser.add_argument('--bandwidth', type=int, default=None, help='Download rate cap per worker in bytes per second.')
+    parser.add_argument('--manifest', type=str, default=None, help='Manifest path; each worker writes its own.')
+    parser.add_argument('--seen-file', type=str, default=None, help='Skip urls saved by earlier runs that used this file, and add the ones saved by this run.')
+    parser.add_argument('--seen-error-rate', type=float, default=None, help='Keep a new --seen-file as a Bloom filter with this false positive rate.')
+    parser.add_argument('--max-restarts', type=int, default=3, help='Times a dead worker is started again.')
+    parser.add_argument('--progress-interval', type=float, default=5.0, help='Seconds between progress lines.')
+    args = parser.parse_args(argv)
+
+    def progress(summary):
+        print(format_summary(summary), file=sys.stderr, flush=True)
+
+    runner = ShardedRunner(read_keywords(args.keywords_file), output_dir=args.output_dir, workers=args.workers,
+                           query_concurrency=args.query_concurrency, max_restarts=args.max_restarts,
+                           progress=progress, progress_interval=args.progress_interval, limit=args.limit,
+                           max_connections=args.max_connections, concurrency=args.concurrency,
+                           per_host=args.per_host, page_rate=args.page_rate, timeout=args.timeout,
+                           bandwidth=args.bandwidth, manifest=args.manifest, seen=args.seen_file,
+                           seen_error_rate=args.seen_error_rate)
+    summary = runner.run()
+    print(format_summary(summary))
+    if summary.skipped:
+        print('{} keywords were already done in {}.'.format(summary.skipped, args.output_dir))
+    if summary.interrupted:
+        print('Interrupted; run the same command again to continue.')
+    return summary
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,221 @@
+""" Per-host scheduling of image fetches: in-flight caps and token buckets by origin. """
+
+import asyncio
+import contextlib
+import threading
+import time
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit
+
+from .ratelimit import TokenBucket
+
+
+def host_of(url):
+    return (urlsplit(url).hostname or '').lower()
+
+
+class _HostQueue(object):
+    """
+    Items bucketed by host. An item is handed out only when its host has fewer
+    than ``per_host`` items in flight and a token in its bucket; hosts are
+    visited round-robin, so a saturated host never holds back the others.
+
+    ``maxsize`` bounds the items pending for any one host, and for all hosts
+    together, except that an item for a host with nothing pending and a free
+    in-flight slot is always taken: a run of urls on one busy host then
+    cannot keep the urls of idle hosts out of the queue.
+    """
+
+    def __init__(self, maxsize=0, per_host=4, host_rate=None, host_burst=1, key=host_of):
+        self.maxsize = maxsize
+        self.per_host = per_host
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.key = key
+        self.pending = OrderedDict()
+        self.in_flight = {}
+        self.buckets = {}
+        self.size = 0
+        self.closed = False
+
+    def _full(self, host):
+        if self.maxsize <= 0:
+            return False
+        pending = len(self.pending.get(host, ()))
+        if pending >= self.maxsize:
+            return True
+        idle = not pending and self.in_flight.get(host, 0) < self.per_host
+        return self.size >= self.maxsize and not idle
+
+    def _add(self, host, item):
+        self.pending.setdefault(host, deque()).append(item)
+        self.size += 1
+
+    def _pick(self):
+        """
+        Return ``(item, None)`` for the next runnable item, or ``(None, wait)``
+        where wait is the seconds until a rate limited host frees up (None
+        when only in-flight caps are holding things back).
+        """
+        now = time.monotonic()
+        wait = None
+        for host in list(self.pending):
+            if self.in_flight.get(host, 0) >= self.per_host:
+                continue
+            bucket = self.buckets.get(host)
+            if bucket is None and self.host_rate:
+                bucket = self.buckets[host] = TokenBucket(self.host_rate, self.host_burst)
+            delay = bucket.delay(now) if bucket is not None else 0
+            if delay:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            items = self.pending[host]
+            item = items.popleft()
+            if items:
+                self.pending.move_to_end(host)
+            else:
+                del self.pending[host]
+            self.size -= 1
+            self.in_flight[host] = self.in_flight.get(host, 0) + 1
+            return item, None
+        return None, wait
+
+    def _done(self, item):
+        host = self.key(item)
+        count = self.in_flight.get(host, 0) - 1
+        if count > 0:
+            self.in_flight[host] = count
+        else:
+            self.in_flight.pop(host, None)
+
+    def _exhausted(self):
+        return self.closed and self.size == 0
+
+
+class HostScheduler(_HostQueue):
+    """ Thread-safe host scheduler for the requests based thread pool. """
+
+    def __init__(self, *args, **kwargs):
+        super(HostScheduler, self).__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+
+    def put(self, item):
+        host = self.key(item)
+        with self._cond:
+            while self._full(host):
+                self._cond.wait()
+            self._add(host, item)
+            self._cond.notify_all()
+
+    def get(self):
+        """ Next runnable item, or None once closed and drained. """
+        with self._cond:
+            while True:
+                item, wait = self._pick()
+                if item is not None:
+                    self._cond.notify_all()
+                    return item
+                if self._exhausted():
+                    return None
+                self._cond.wait(wait)
+
+    def release(self, item):
+        with self._cond:
+            self._done(item)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class AsyncHostScheduler(_HostQueue):
+    """ Event loop flavour of HostScheduler for the httpx workers. """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncHostScheduler, self).__init__(*args, **kwargs)
+        self._cond = asyncio.Condition()
+
+    async def put(self, item):
+        host = self.key(item)
+        async with self._cond:
+            while self._full(host):
+                await self._cond.wait()
+            self._add(host, item)
+            self._cond.notify_all()
+
+    async def get(self):
+        """ Next runnable item, or None once closed and drained. """
+        async with self._cond:
+            while True:
+                item, wait = self._pick()
+                if item is not None:
+                    self._cond.notify_all()
+                    return item
+                if self._exhausted():
+                    return None
+                try:
+                    await asyncio.wait_for(self._cond.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, item):
+        async with self._cond:
+            self._done(item)
+            self._cond.notify_all()
+
+    async def close(self):
+        async with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class FairShare(object):
+    """
+    Global pool of ``size`` request slots shared by several queries. When a
+    slot frees up it goes to the next query in turn that is waiting for one,
+    rather than to whichever query has queued the most requests.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.in_use = 0
+        self.waiters = OrderedDict()
+
+    def _grant(self):
+        while self.in_use < self.size and self.waiters:
+            owner, futures = next(iter(self.waiters.items()))
+            future = futures.popleft()
+            if futures:
+                self.waiters.move_to_end(owner)
+            else:
+                del self.waiters[owner]
+            if not future.done():
+                self.in_use += 1
+                future.set_result(None)
+
+    async def acquire(self, owner):
+        if self.in_use < self.size and not self.waiters:
+            self.in_use += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(owner, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_use -= 1
+        self._grant()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, owner):
+        await self.acquire(owner)
+        try:
+            yield
+        finally:
+            self.release()
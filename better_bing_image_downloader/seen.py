@@ -0,0 +1,315 @@
+""" Compact sets of crawled urls: 64-bit fingerprints in an open-addressing table, or a Bloom filter, saved to disk. """
+
+import contextlib
+import hashlib
+import math
+import os
+import struct
+import sys
+import threading
+from array import array
+from urllib.parse import urlsplit
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+# Query parameters that only say where a link was clicked, not what it points to.
+TRACKING_PARAMS = frozenset(['fbclid', 'gclid', 'dclid', 'gbraid', 'wbraid', 'msclkid', 'yclid', 'igshid',
+                             'mc_cid', 'mc_eid', '_ga', '_gl', 'ref_src', 'spm'])
+TRACKING_PREFIXES = ('utm_',)
+
+_FINGERPRINT_MAGIC = b'BBSEENF1'
+_BLOOM_MAGIC = b'BBSEENB1'
+_FINGERPRINT_HEADER = struct.Struct('<QQ')
+_BLOOM_HEADER = struct.Struct('<QQQQd')
+
+
+def normalize_url(url):
+    """
+    Canonical form of an url for deduplication: http and https are the same,
+    host case, default ports, fragments and tracking parameters (utm_*,
+    fbclid, gclid...) are dropped and the other parameters are sorted.
+    Escapes are left as they are, so this never merges two distinct urls.
+    """
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    userinfo, at, hostport = parts.netloc.rpartition('@')
+    host, _, port = hostport.rpartition(':')
+    if not port.isdigit():
+        # No port, or an IPv6 address.
+        host, port = hostport, None
+    netloc = userinfo + at + host.lower()
+    if port is not None and int(port) != DEFAULT_PORTS.get(scheme):
+        netloc += ':' + port
+    query = '&'.join(sorted(param for param in parts.query.split('&') if param and not _tracking(param)))
+    if scheme in DEFAULT_PORTS:
+        scheme = ''
+    if parts.netloc:
+        netloc = '//' + netloc
+    path = parts.path or ('/' if parts.netloc else '')
+    return (scheme + ':' if scheme else '') + netloc + path + ('?' + query if query else '')
+
+
+def _tracking(param):
+    key = param.partition('=')[0].lower()
+    return key in TRACKING_PARAMS or key.startswith(TRACKING_PREFIXES)
+
+
+def _digest(url, size):
+    return hashlib.blake2b(normalize_url(url).encode('utf-8', 'surrogatepass'), digest_size=size).digest()
+
+
+def fingerprint(url):
+    """ 64-bit hash of the normalized url, never 0. """
+    return int.from_bytes(_digest(url, 8), 'little') or 1
+
+
+def _write(path, header, payload):
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'wb') as f:
+        f.write(header)
+        f.write(payload)
+    os.replace(tmp, path)
+
+
+class FingerprintSet(object):
+    """
+    Exact set of urls kept as 64-bit fingerprints of their normalized form
+    in an open-addressing hash table: a flat array of 8-byte slots kept
+    between one and two thirds full, so 12-24 bytes per url (16 MB for a
+    million) where a set of the url strings takes hundreds. Two distinct urls share a fingerprint with odds
+    of about n² / 2^65, negligible below billions of urls.
+    """
+
+    def __init__(self, capacity=1024):
+        size = 8
+        while size * 2 < capacity * 3:
+            size *= 2
+        self._table = array('Q', bytes(8 * size))
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _slot(self, value):
+        table = self._table
+        mask = len(table) - 1
+        slot = value & mask
+        while table[slot] and table[slot] != value:
+            slot = (slot + 1) & mask
+        return slot
+
+    def _grow(self):
+        old = self._table
+        self._table = array('Q', bytes(16 * len(old)))
+        for value in old:
+            if value:
+                self._table[self._slot(value)] = value
+
+    def _insert(self, value):
+        slot = self._slot(value)
+        if self._table[slot]:
+            return False
+        self._table[slot] = value
+        self._count += 1
+        if self._count * 3 >= len(self._table) * 2:
+            self._grow()
+        return True
+
+    def add(self, url):
+        """ Add url and return True if it was not in the set yet. """
+        value = fingerprint(url)
+        with self._lock:
+            return self._insert(value)
+
+    def merge(self, other):
+        """ Add every url of another FingerprintSet. """
+        if not isinstance(other, FingerprintSet):
+            raise ValueError('Cannot merge a {} into a FingerprintSet'.format(type(other).__name__))
+        values = [value for value in other._table if value]
+        with self._lock:
+            for value in values:
+                self._insert(value)
+
+    def __contains__(self, url):
+        value = fingerprint(url)
+        with self._lock:
+            return self._table[self._slot(value)] == value
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return len(self._table) * self._table.itemsize
+
+    def save(self, path):
+        """ Write the set to path atomically; read it back with load_seen. """
+        with self._lock:
+            table = array('Q', self._table)
+            count = self._count
+        if sys.byteorder == 'big':
+            table.byteswap()
+        _write(path, _FINGERPRINT_MAGIC + _FINGERPRINT_HEADER.pack(count, len(table)), table.tobytes())
+
+    @classmethod
+    def _read(cls, f):
+        count, size = _FINGERPRINT_HEADER.unpack(f.read(_FINGERPRINT_HEADER.size))
+        seen = cls.__new__(cls)
+        seen._table = array('Q')
+        seen._table.frombytes(f.read(8 * size))
+        if sys.byteorder == 'big':
+            seen._table.byteswap()
+        seen._count = count
+        seen._lock = threading.Lock()
+        return seen
+
+
+class BloomFilter(object):
+    """
+    Bloom filter sized for ``capacity`` urls at a false positive rate of
+    ``error_rate``: 1.8 MB for a million urls at 0.1%, allocated up front
+    and never grown. A url added before is always found; a new one is taken
+    for seen (and skipped) with odds of error_rate once capacity urls are
+    in, more beyond that.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        assert capacity > 0 and 0 < error_rate < 1, "need capacity > 0 and 0 < error_rate < 1"
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self._bits = bytearray((self.size + 7) // 8)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def _positions(self, url):
+        digest = _digest(url, 16)
+        first = int.from_bytes(digest[:8], 'little')
+        step = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * step) % self.size for i in range(self.hashes)]
+
+    def add(self, url):
+        """ Add url and return True if it was (probably) not in the filter yet. """
+        positions = self._positions(url)
+        with self._lock:
+            new = False
+            for position in positions:
+                mask = 1 << (position & 7)
+                if not self._bits[position >> 3] & mask:
+                    self._bits[position >> 3] |= mask
+                    new = True
+            if new:
+                self._count += 1
+            return new
+
+    def __contains__(self, url):
+        positions = self._positions(url)
+        with self._lock:
+            return all(self._bits[position >> 3] & (1 << (position & 7)) for position in positions)
+
+    def __len__(self):
+        """ Number of urls added, not counting those taken for duplicates. """
+        return self._count
+
+    @property
+    def nbytes(self):
+        return len(self._bits)
+
+    def merge(self, other):
+        """ Add every url of another BloomFilter of the same size. """
+        if not isinstance(other, BloomFilter) or (other.size, other.hashes) != (self.size, self.hashes):
+            raise ValueError('Can only merge a BloomFilter of the same size and hash count')
+        with self._lock:
+            bits = int.from_bytes(self._bits, 'little') | int.from_bytes(other._bits, 'little')
+            self._bits = bytearray(bits.to_bytes(len(self._bits), 'little'))
+            # Urls in both filters are counted once: estimate the count from the bits set.
+            filled = bin(bits).count('1')
+            if filled < self.size:
+                self._count = int(round(-self.size / self.hashes * math.log(1 - filled / self.size)))
+
+    def save(self, path):
+        """ Write the filter to path atomically; read it back with load_seen. """
+        with self._lock:
+            header = _BLOOM_HEADER.pack(self.capacity, self.size, self.hashes, self._count, self.error_rate)
+            bits = bytes(self._bits)
+        _write(path, _BLOOM_MAGIC + header, bits)
+
+    @classmethod
+    def _read(cls, f):
+        capacity, size, hashes, count, error_rate = _BLOOM_HEADER.unpack(f.read(_BLOOM_HEADER.size))
+        seen = cls.__new__(cls)
+        seen.capacity, seen.size, seen.hashes, seen.error_rate = capacity, size, hashes, error_rate
+        seen._bits = bytearray(f.read((size + 7) // 8))
+        seen._count = count
+        seen._lock = threading.Lock()
+        return seen
+
+
+def load_seen(path):
+    """ Read a FingerprintSet or BloomFilter written by its save(). """
+    with open(path, 'rb') as f:
+        magic = f.read(8)
+        if magic == _FINGERPRINT_MAGIC:
+            return FingerprintSet._read(f)
+        if magic == _BLOOM_MAGIC:
+            return BloomFilter._read(f)
+    raise ValueError('Not a saved seen-set: {}'.format(path))
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """ Hold an exclusive lock on ``path``.lock, across processes. """
+    with open(path + '.lock', 'a+b') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def save_seen(seen, path):
+    """
+    Save seen to path, first merging in whatever other processes saved there
+    since it was loaded, so several writers of one file lose nothing.
+    """
+    path = os.fspath(path)
+    with _locked(path):
+        if os.path.exists(path):
+            saved = load_seen(path)
+            if type(saved) is not type(seen):
+                raise ValueError('{} now holds a {}, cannot save a {} there'.format(
+                    path, type(saved).__name__, type(seen).__name__))
+            seen.merge(saved)
+        seen.save(path)
+
+
+def open_seen(path, error_rate=None, capacity=1000000):
+    """
+    The seen-set saved at path, or a new one if there is none yet: a
+    BloomFilter when error_rate is given, else a FingerprintSet. A saved
+    BloomFilter keeps its own size and error rate. The two kinds hash urls
+    differently and cannot be converted, so asking for a BloomFilter where
+    a FingerprintSet was saved raises ValueError.
+    """
+    if os.path.exists(path):
+        seen = load_seen(path)
+        if error_rate is not None and not isinstance(seen, BloomFilter):
+            raise ValueError('{} holds a {}, not a BloomFilter: use another file or no error rate'.format(
+                path, type(seen).__name__))
+        return seen
+    if error_rate is not None:
+        return BloomFilter(capacity, error_rate)
+    return FingerprintSet()
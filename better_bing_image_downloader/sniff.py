@@ -0,0 +1,68 @@
+""" Detect image formats from the first bytes of a body, replacing imghdr (removed in Python 3.13). """
+
+HEAD_SIZE = 32
+
+EXTENSIONS = {
+    'jpeg': 'jpg',
+    'png': 'png',
+    'gif': 'gif',
+    'webp': 'webp',
+    'bmp': 'bmp',
+    'tiff': 'tiff',
+    'ico': 'ico',
+    'avif': 'avif',
+    'heic': 'heic',
+}
+
+_MARKUP = (b'<!doctype', b'<html', b'<head', b'<body', b'<?xml', b'<svg', b'{', b'[')
+
+
+class NotAnImage(ValueError):
+    pass
+
+
+def sniff_format(head):
+    """
+    Return the image format of a body starting with ``head`` (at least
+    HEAD_SIZE bytes when available), or None when it is not a known image.
+    """
+    if head[:3] == b'\xff\xd8\xff':
+        return 'jpeg'
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    if head[:2] == b'BM' and len(head) >= 14:
+        return 'bmp'
+    if head[:4] in (b'II*\x00', b'MM\x00*'):
+        return 'tiff'
+    if head[:4] == b'\x00\x00\x01\x00':
+        return 'ico'
+    if head[4:8] == b'ftyp':
+        brand = head[8:12]
+        if brand in (b'avif', b'avis'):
+            return 'avif'
+        if brand in (b'heic', b'heix', b'hevc', b'hevx', b'mif1', b'msf1'):
+            return 'heic'
+    return None
+
+
+def looks_like_markup(head):
+    """ True for bodies that are evidently text, like HTML error or consent pages. """
+    return head.lstrip()[:16].lower().startswith(_MARKUP)
+
+
+def check_head(head):
+    """ Return the format of head or raise NotAnImage. """
+    fmt = sniff_format(head)
+    if fmt is None:
+        if looks_like_markup(head):
+            raise NotAnImage('body is markup, not an image')
+        raise NotAnImage('unknown image format')
+    return fmt
+
+
+def extension(fmt, default='jpg'):
+    return EXTENSIONS.get(fmt, default)
@@ -0,0 +1,138 @@
+""" Output backends: one file per image (the default) or rolling tar shards with an offset index. """
+
+import json
+import mmap
+import os
+import re
+import tarfile
+import threading
+import time
+
+MEMBER_SEP = '::'
+
+
+class DirectoryBackend(object):
+    """ Store each image as its own file under ``directory``. """
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+        names = os.listdir(self.directory) if os.path.isdir(self.directory) else []
+        self._stems = {os.path.splitext(name)[0] for name in names}
+
+    def taken(self, stem):
+        """ Whether an image named ``stem`` plus any extension is already stored. """
+        return stem in self._stems
+
+    def store(self, src_path, name):
+        """ Move the finished file at src_path to ``name`` and return its location. """
+        self._stems.add(os.path.splitext(name)[0])
+        dst_path = os.path.join(self.directory, name)
+        parent = os.path.dirname(dst_path)
+        if not os.path.isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+        os.replace(src_path, dst_path)
+        return dst_path
+
+    def close(self):
+        pass
+
+
+class TarShardBackend(object):
+    """
+    Append images to ``<prefix>-NNNNN.tar`` shards in ``directory``, starting
+    a new shard once the current one reaches ``shard_size`` bytes. Each shard
+    gets a sidecar ``.idx`` file of JSON lines ``{"key", "offset", "size"}``
+    giving where a member's data starts in the tar, so a loader can either
+    stream the shards or mmap them and slice out single images.
+
+    A new run always starts a new shard; existing shards are never reopened.
+    The location returned by store() is ``<shard path>::<key>``.
+    """
+
+    def __init__(self, directory, prefix='shard', shard_size=1024 ** 3):
+        self.directory = str(directory)
+        self.prefix = prefix
+        self.shard_size = shard_size
+        self._lock = threading.Lock()
+        self._tar = None
+        self._index = None
+        pattern = re.compile(re.escape(prefix) + r'-(\d+)\.tar$')
+        numbers = [int(m.group(1)) for m in map(pattern.match, os.listdir(self.directory)) if m]
+        self._next_shard = max(numbers) + 1 if numbers else 0
+        self._stems = {os.path.splitext(key)[0] for key in load_shard_index(self.directory, prefix)}
+
+    def taken(self, stem):
+        """ Whether a member named ``stem`` plus any extension is in this or an earlier run's shards. """
+        return stem in self._stems
+
+    def _open_shard(self):
+        self.shard_path = os.path.join(self.directory, '{}-{:05d}.tar'.format(self.prefix, self._next_shard))
+        self._next_shard += 1
+        self._tar = tarfile.open(self.shard_path, 'w', format=tarfile.PAX_FORMAT)
+        self._index = open(self.shard_path[:-len('.tar')] + '.idx', 'w', encoding='utf-8')
+
+    def _close_shard(self):
+        if self._tar is not None:
+            self._tar.close()
+            self._index.close()
+            self._tar = self._index = None
+
+    def store(self, src_path, name):
+        """ Append the finished file at src_path as member ``name``, remove it and return its location. """
+        with self._lock:
+            if self._tar is None:
+                self._open_shard()
+            self._stems.add(os.path.splitext(name)[0])
+            info = tarfile.TarInfo(name)
+            info.size = os.path.getsize(src_path)
+            info.mtime = int(time.time())
+            with open(src_path, 'rb') as f:
+                self._tar.addfile(info, f)
+            self._tar.members.clear()
+            blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+            offset = self._tar.offset - (blocks + (remainder > 0)) * tarfile.BLOCKSIZE
+            self._index.write(json.dumps({'key': name, 'offset': offset, 'size': info.size}) + '\n')
+            self._index.flush()
+            location = self.shard_path + MEMBER_SEP + name
+            if self._tar.offset >= self.shard_size:
+                self._close_shard()
+        os.remove(src_path)
+        return location
+
+    def close(self):
+        with self._lock:
+            self._close_shard()
+
+
+def make_backend(kind, directory, shard_size=1024 ** 3):
+    """ Backend for the ``output_backend`` option: "directory" or "tar". """
+    if kind in (None, 'directory'):
+        return DirectoryBackend(directory)
+    if kind == 'tar':
+        return TarShardBackend(directory, shard_size=shard_size)
+    raise ValueError('Unknown output backend: {}'.format(kind))
+
+
+def location_exists(location):
+    """ Whether a location returned by a backend's store() still exists on disk. """
+    return os.path.exists(location) or os.path.exists(location.partition(MEMBER_SEP)[0])
+
+
+def load_shard_index(directory, prefix='shard'):
+    """ Map every key in the shards under directory to ``(shard path, offset, size)``. """
+    index = {}
+    for name in sorted(os.listdir(str(directory))):
+        if name.startswith(prefix + '-') and name.endswith('.idx'):
+            shard_path = os.path.join(str(directory), name[:-len('.idx')] + '.tar')
+            with open(os.path.join(str(directory), name), encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    index[entry['key']] = (shard_path, entry['offset'], entry['size'])
+    return index
+
+
+def read_member(shard_path, offset, size):
+    """ Bytes of one shard member, read through mmap. """
+    with open(shard_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[offset:offset + size]
@@ -0,0 +1,83 @@
+""" Chunked writes of downloaded bodies to a temp file, committed with an atomic rename. """
+
+import hashlib
+import os
+import tempfile
+
+from .sniff import HEAD_SIZE, check_head
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+def check_content_length(headers, max_bytes):
+    """
+    Reject a response up front when its declared Content-Length is over max_bytes.
+    :param headers: response headers (any mapping with a case-insensitive get)
+    :param max_bytes: size cap in bytes, None for unlimited
+    """
+    if max_bytes is None:
+        return
+    length = headers.get('Content-Length')
+    if length is not None and length.isdigit() and int(length) > max_bytes:
+        raise ImageTooLarge('Content-Length {} exceeds max_bytes {}'.format(length, max_bytes))
+
+
+class PartFile(object):
+    """
+    A hidden ``.part`` file in the target directory. Chunks are appended with
+    write(); commit() renames it onto its final path, anything else removes it.
+    Only one chunk is ever held in memory by the caller. The sha256 of the body
+    is computed on the way through.
+
+    With require_image, the format is sniffed from the first bytes and
+    NotAnImage is raised right away for anything else (HTML error pages and
+    the like), instead of after the whole body has been written.
+    """
+
+    def __init__(self, dst_dir, max_bytes=None, require_image=False):
+        fd, self.path = tempfile.mkstemp(dir=str(dst_dir), prefix='.', suffix='.part')
+        self._file = os.fdopen(fd, 'wb')
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.require_image = require_image
+        self.format = None
+        self._head = b''
+        self.committed = False
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.max_bytes is not None and self.size > self.max_bytes:
+            raise ImageTooLarge('body exceeds max_bytes {}'.format(self.max_bytes))
+        if self.require_image and self.format is None:
+            self._head += chunk[:HEAD_SIZE - len(self._head)]
+            if len(self._head) >= HEAD_SIZE:
+                self.format = check_head(self._head)
+        self.sha256.update(chunk)
+        self._file.write(chunk)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+            if self.require_image and self.format is None:
+                self.format = check_head(self._head)
+
+    def commit(self, file_path):
+        self.close()
+        os.replace(self.path, str(file_path))
+        self.committed = True
+
+    def discard(self):
+        self._file.close()
+        if not self.committed and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.discard()
@@ -0,0 +1,93 @@
+import asyncio
+import threading
+import time
+import unittest
+
+from better_bing_image_downloader.adaptive import AdaptiveLimit, AsyncAdaptiveLimit
+
+
+def run_interval(limit, now, seconds, count=20, error=None, received=1000):
+    """ Finish ``count`` downloads with every slot busy, then let an interval pass. """
+    for _ in range(limit.limit):
+        limit.acquire()
+    limit.received(received)
+    for _ in range(count - 1):
+        limit.observe(seconds, error, now=now)
+    for _ in range(limit.in_use):
+        limit.release()
+    limit.observe(seconds, error, now=now + limit.interval)
+    return now + limit.interval
+
+
+class TestAdaptiveLimit(unittest.TestCase):
+    def test_grows_while_latency_holds(self):
+        limit = AdaptiveLimit(2, 5, initial=2, interval=1.0)
+        now = limit.updated
+        for _ in range(10):
+            now = run_interval(limit, now, 0.1)
+        self.assertEqual(limit.limit, 5)
+
+    def test_does_not_grow_when_slots_are_idle(self):
+        limit = AdaptiveLimit(1, 10, initial=4, interval=1.0)
+        now = limit.updated
+        for _ in range(20):
+            limit.observe(0.1, now=now)
+        limit.observe(0.1, now=now + 1.0)
+        self.assertEqual(limit.limit, 4)
+
+    def test_backs_off_on_timeouts(self):
+        limit = AdaptiveLimit(2, 20, initial=10, interval=1.0)
+        now = run_interval(limit, limit.updated, 0.1)
+        self.assertEqual(limit.limit, 11)
+        run_interval(limit, now, 0.1, error=TimeoutError())
+        self.assertEqual(limit.limit, 7)
+
+    def test_backs_off_when_latency_rises(self):
+        limit = AdaptiveLimit(2, 20, initial=10, interval=1.0)
+        now = run_interval(limit, limit.updated, 0.1)
+        now = run_interval(limit, now, 1.0)
+        self.assertEqual(limit.limit, 7)
+        for _ in range(10):
+            now = run_interval(limit, now, 1.0)
+        self.assertEqual(limit.limit, 2)
+
+    def test_slot_blocks_over_the_limit(self):
+        limit = AdaptiveLimit(1, 4, initial=1)
+        running = []
+        entered = threading.Event()
+
+        def worker():
+            with limit.slot():
+                running.append(1)
+                entered.set()
+
+        limit.acquire()
+        thread = threading.Thread(target=worker)
+        thread.start()
+        self.assertFalse(entered.wait(0.1))
+        limit.release()
+        thread.join(1)
+        self.assertEqual(running, [1])
+
+
+class TestAsyncAdaptiveLimit(unittest.TestCase):
+    def test_waiters_start_when_the_limit_grows(self):
+        async def run():
+            limit = AsyncAdaptiveLimit(1, 3, initial=1, interval=1.0, min_samples=2)
+            await limit.acquire()
+            waiter = asyncio.ensure_future(limit.acquire())
+            await asyncio.sleep(0)
+            self.assertFalse(waiter.done())
+            now = time.monotonic()
+            limit.received(1000)
+            limit.observe(0.1, now=now)
+            limit.observe(0.1, now=now + 1.0)
+            await asyncio.wait_for(waiter, 1)
+            return limit
+
+        limit = asyncio.run(run())
+        self.assertEqual((limit.limit, limit.in_use), (2, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import unittest
+import urllib.request
+
+from benchmarks.bench import TARGETS, run_one
+from benchmarks.servers import FakeServers
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_fake_servers(self):
+        with FakeServers(images=40, hosts=2, error_rate=0.5, duplicates=0.2) as servers:
+            with urllib.request.urlopen(servers.bing_url + '/images/async?q=cat&first=0&count=35') as response:
+                page = response.read().decode()
+            self.assertEqual(page.count('murl&quot;'), 35)
+            self.assertEqual(len(servers.image_urls), 40)
+            self.assertLess(len(set(servers.image_urls)), 40)
+            self.assertEqual(len({url.split('/')[2].split(':')[0] for url in servers.image_urls}), 2)
+
+    def test_every_target_runs(self):
+        with FakeServers(images=20) as servers:
+            for target in TARGETS:
+                result = run_one(target, 4, servers.bing_url, servers.image_urls, 10)
+                self.assertEqual(result.images, 10, target)
+                self.assertEqual(result.files, result.images, target)
+                self.assertEqual(result.failures, 0, target)
+                self.assertGreater(result.images_per_second, 0)
+                self.assertLessEqual(result.p50, result.p99)
+                self.assertGreater(result.peak_rss_mb, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,42 +1,167 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+import shutil
+import tempfile
+import threading
 import unittest
-from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from PIL import Image
+
 from better_bing_image_downloader.bing import Bing
+from better_bing_image_downloader.journal import DONE, FAILED
+from better_bing_image_downloader.seen import FingerprintSet
+from better_bing_image_downloader.sniff import NotAnImage
+
 
 class TestBing(unittest.TestCase):
     def setUp(self):
-        self.query = 'cat'
-        self.limit = 10
-        self.output_dir = '/path/to/output'
-        self.adult = 'Moderate'
-        self.timeout = 10
-        self.filter = ''
-        self.verbose = True
+        self.output_dir = tempfile.mkdtemp()
+        png = io.BytesIO()
+        Image.new('RGB', (4, 4)).save(png, 'PNG')
+        bodies = {'/image.jpg': png.getvalue(), '/blocked.jpg': b'<!DOCTYPE html><html></html>'}
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = bodies.get(self.path)
+                self.send_response(404 if body is None else 200)
+                self.send_header('Content-Length', str(len(body or b'')))
+                self.end_headers()
+                self.wfile.write(body or b'')
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.bing = Bing('cat', 10, self.output_dir, 'on', 10)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output_dir)
 
     def test_get_filter(self):
-        bing = Bing(self.query, self.limit, self.output_dir, self.adult, self.timeout, self.filter, self.verbose)
-        self.assertEqual(bing.get_filter('Size:Small'), 'filterui:imagesize-small')
-
-    @patch('better_bing_image_downloader.bing.urllib.request')
-    def test_save_image(self, mock_urllib_request):
-        bing = Bing(self.query, self.limit, self.output_dir, self.adult, self.timeout, self.filter, self.verbose)
-        link = 'https://example.com/image.jpg'
-        file_path = '/path/to/save/image.jpg'
-        bing.save_image(link, file_path)
-        mock_urllib_request.urlretrieve.assert_called_once_with(link, file_path)
-
-    @patch('better_bing_image_downloader.bing.urllib.request')
-    def test_download_image(self, mock_urllib_request):
-        bing = Bing(self.query, self.limit, self.output_dir, self.adult, self.timeout, self.filter, self.verbose)
-        link = 'https://example.com/image.jpg'
-        bing.download_image(link)
-        mock_urllib_request.urlretrieve.assert_called_once_with(link, '/path/to/output/image.jpg')
-
-    @patch('better_bing_image_downloader.bing.urllib.request')
-    def test_run(self, mock_urllib_request):
-        bing = Bing(self.query, self.limit, self.output_dir, self.adult, self.timeout, self.filter, self.verbose)
-        bing.run()
-        self.assertEqual(bing.page_counter, 1)
-        self.assertEqual(bing.download_count, 10)
+        self.assertEqual(self.bing.get_filter('photo'), '+filterui:photo-photo')
+        self.assertEqual(self.bing.get_filter('Size:Small'), '')
+
+    def test_save_image(self):
+        sha256, path = self.bing.save_image(self.url + '/image.jpg', os.path.join(self.output_dir, 'Image_1.jpg'))
+        self.assertEqual(str(path), os.path.join(self.output_dir, 'Image_1.png'))
+        self.assertEqual(len(sha256), 64)
+        self.assertIsNone(self.bing.save_image(self.url + '/missing.jpg', os.path.join(self.output_dir, 'x.jpg')))
+
+    def test_download_image(self):
+        events = []
+        self.bing.download_callback = events.append
+        self.bing.download_image(self.url + '/image.jpg')
+        self.bing.download_image(self.url + '/blocked.jpg')
+        self.bing.download_image(self.url + '/missing.jpg')
+        self.assertEqual(self.bing.download_count, 1)
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ['Image_1.png'])
+        self.assertEqual([e.status for e in events], [DONE, FAILED, FAILED])
+        self.assertEqual(events[0].path, Path(self.output_dir, 'Image_1.png'))
+        self.assertEqual(events[0].count, 1)
+        self.assertIsInstance(events[1].error, NotAnImage)
+
+    def test_download_image_does_not_overwrite(self):
+        self.bing.download_image(self.url + '/image.jpg')
+        again = Bing('cat', 10, self.output_dir, 'on', 10)
+        again.download_image(self.url + '/image.jpg')
+        self.assertEqual(again.download_count, 1)
+        self.assertEqual(sorted(os.listdir(self.output_dir)), ['Image_1.png', 'Image_2.png'])
+
+    def test_download_image_from_threads(self):
+        bing = Bing('cat', 100, self.output_dir, 'on', 10)
+        urls = [self.url + ('/image.jpg' if i % 2 else '/missing.jpg') for i in range(60)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(bing.download_image, urls))
+        self.assertEqual(bing.download_count, 30)
+        self.assertEqual(len(os.listdir(self.output_dir)), 30)
+
+    def test_page_url(self):
+        self.bing.base_url = self.url
+        self.assertTrue(self.bing.get_page_url(2).startswith(self.url + '/images/async?q=cat&first=2&count=10'))
+
+
+class TestGetImageUrls(unittest.TestCase):
+    def serve_pages(self, pages, consume=None, **kwargs):
+        from aiohttp import web
+
+        requested = []
+
+        async def handler(request):
+            page = int(request.query['first'])
+            requested.append(page)
+            if page >= len(pages):
+                return web.Response(text='')
+            return web.Response(text=''.join('murl&quot;:&quot;%s&quot;' % url for url in pages[page]))
+
+        async def collect(urls):
+            return [url async for url in urls]
+
+        async def run():
+            app = web.Application()
+            app.router.add_get('/images/async', handler)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            await site.start()
+            port = runner.addresses[0][1]
+            bing = Bing('cat', 100, '/tmp', 'on', 10, page_rate=None, **kwargs)
+            base = bing.get_page_url
+            bing.get_page_url = lambda page: base(page).replace(
+                'https://www.bing.com', 'http://127.0.0.1:%d' % port)
+            try:
+                return await (consume or collect)(bing.get_image_urls())
+            finally:
+                await runner.cleanup()
+        return asyncio.run(run()), requested
+
+    def test_pages_until_empty(self):
+        pages = [['a', 'b'], ['b', 'c'], ['d']]
+        urls, requested = self.serve_pages(pages)
+        self.assertEqual(urls, ['a', 'b', 'c', 'd'])
+        self.assertEqual(requested, [0, 1, 2, 3])
+
+    def test_resume_from_journal(self):
+        import tempfile
+        from better_bing_image_downloader.journal import DONE, Journal
+
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(directory, 'cat')
+            journal.checkpoint(1)
+            journal.record('c', DONE)
+            urls, requested = self.serve_pages([['a', 'b'], ['c', 'd'], ['e']], journal=journal)
+            journal.close()
+        self.assertEqual(urls, ['d', 'e'])
+        self.assertEqual(requested, [1, 2, 3])
+
+    def test_read_ahead(self):
+        async def first_link(urls):
+            url = await urls.__anext__()
+            await asyncio.sleep(0.2)
+            await urls.aclose()
+            return url
+
+        for read_ahead, expected in [(True, [0, 1]), (False, [0])]:
+            url, requested = self.serve_pages([['a', 'b'], ['c']], first_link, read_ahead=read_ahead)
+            self.assertEqual(url, 'a')
+            self.assertEqual(requested, expected)
+
+    def test_seen_urls_are_skipped(self):
+        seen = FingerprintSet()
+        seen.add('https://example.com/c.jpg')
+        pages = [['http://example.com/a.jpg', 'https://example.com/a.jpg?utm_source=x'],
+                 ['https://example.com/b.jpg', 'http://example.com/c.jpg']]
+        urls, _ = self.serve_pages(pages, seen=seen)
+        self.assertEqual(urls, ['http://example.com/a.jpg', 'https://example.com/b.jpg'])
+        self.assertEqual(len(seen), 3)
+
 
 if __name__ == '__main__':
     unittest.main()
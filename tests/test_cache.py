@@ -0,0 +1,63 @@
+import os
+import tempfile
+import time
+import unittest
+
+from better_bing_image_downloader.cache import DiskCache, PageCache, normalize_url
+
+
+class TestDiskCache(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_normalize_url(self):
+        self.assertEqual(normalize_url('HTTPS://www.Bing.com/images/async?q=cat&first=1&adlt=on'),
+                         normalize_url('https://www.bing.com/images/async?adlt=on&first=1&q=cat'))
+        self.assertNotEqual(normalize_url('https://www.bing.com/images/async?q=cat&adlt=on'),
+                            normalize_url('https://www.bing.com/images/async?q=cat&adlt=off'))
+
+    def test_round_trip_and_ttl(self):
+        cache = DiskCache(self.tmp.name, ttl=60)
+        url = 'https://www.bing.com/images/async?q=cat&first=0'
+        self.assertIsNone(cache.get(url))
+        cache.set(url, 'murl&quot;:&quot;a&quot;' * 100)
+        self.assertEqual(DiskCache(self.tmp.name, ttl=60).get(url), 'murl&quot;:&quot;a&quot;' * 100)
+        self.assertLess(os.path.getsize(cache.path(url)), 200)
+        self.assertIsNone(DiskCache(self.tmp.name, ttl=-1).get(url))
+
+    def test_corrupt_entries_are_misses(self):
+        cache = DiskCache(self.tmp.name)
+        urls = ['https://www.bing.com/images/async?q=cat&first=%d' % i for i in range(2)]
+        for url in urls:
+            cache.set(url, 'murl' * 100)
+        with open(cache.path(urls[0]), 'wb') as f:
+            f.write(b'\0\0')
+        with open(cache.path(urls[1]), 'r+b') as f:
+            f.truncate(20)
+        for url in urls:
+            self.assertIsNone(cache.get(url))
+            self.assertFalse(os.path.exists(cache.path(url)))
+
+    def test_page_cache_is_abstract(self):
+        with self.assertRaises(TypeError):
+            PageCache()
+
+    def test_lru_eviction(self):
+        cache = DiskCache(self.tmp.name, max_bytes=None)
+        urls = ['https://www.bing.com/images/async?q=cat&first=%d' % i for i in range(3)]
+        for i, url in enumerate(urls):
+            cache.set(url, os.urandom(200).hex())
+            os.utime(cache.path(url), (time.time() - 100 + i, time.time() - 100 + i))
+        cache.get(urls[0])
+        cache.max_bytes = cache.size - 1
+        cache.evict()
+        self.assertIsNotNone(cache.get(urls[0]))
+        self.assertIsNone(cache.get(urls[1]))
+        self.assertIsNotNone(cache.get(urls[2]))
+
+
+if __name__ == '__main__':
+    unittest.main()
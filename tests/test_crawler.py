@@ -0,0 +1,83 @@
+import unittest
+from unittest.mock import patch
+
+from better_bing_image_downloader import crawler
+
+
+def result_page(urls):
+    return ''.join('<a class="iusc" m="{&quot;murl&quot;:&quot;%s&quot;}"></a>' % url for url in urls)
+
+
+class FakeDriver(object):
+    """ A Bing result page revealing ``batch`` more results on each scroll, up to ``total``. """
+
+    def __init__(self, total, batch):
+        self.total = total
+        self.shown = batch
+        self.batch = batch
+        self.scripts = 0
+
+    def execute_script(self, script, *args):
+        self.scripts += 1
+        if script == crawler._COUNT_SCRIPT:
+            return min(self.shown, self.total) if args[0] == '.iusc' else 0
+        if script == crawler._BING_COLLECT_SCRIPT:
+            urls = ['https://example.com/%d.jpg' % i for i in range(args[0], min(self.shown, self.total))]
+            self.shown += self.batch
+            return urls
+        if script == crawler._CLICK_SCRIPT:
+            return False
+        raise AssertionError(script)
+
+
+class TestCrawler(unittest.TestCase):
+    def test_api_streams_pages(self):
+        pages = []
+
+        def cached_get(url, cache=None, **kwargs):
+            first = int(url.split('first=')[1].split('&')[0])
+            pages.append(first)
+            return result_page(['https://example.com/%d.jpg' % i for i in range(first, min(first + 35, 100))])
+
+        with patch.object(crawler, '_cached_get', cached_get):
+            urls = crawler.bing_get_image_url_using_api('cat', max_number=1000, stream=True)
+            self.assertEqual(next(urls), 'https://example.com/1.jpg')
+            self.assertEqual(pages, [1])
+            self.assertEqual(len(list(urls)), 98)
+            self.assertEqual(len(crawler.bing_get_image_url_using_api('cat', max_number=1000)), 99)
+
+    def test_api_window(self):
+        pages = []
+
+        def cached_get(url, cache=None, session=None, **kwargs):
+            first = int(url.split('first=')[1].split('&')[0])
+            pages.append(first)
+            # Pages overlap by one result; past the end Bing repeats its last page.
+            first = min(first, 71)
+            return result_page(['https://example.com/%d.jpg' % i for i in range(first - 1, min(first + 35, 100))])
+
+        with patch.object(crawler, '_cached_get', cached_get):
+            urls = crawler.bing_get_image_url_using_api('cat', max_number=1000, window=4)
+            self.assertEqual(urls, ['https://example.com/%d.jpg' % i for i in range(100)])
+            self.assertLessEqual(max(pages), 1 + 35 * 6)
+            del pages[:]
+            urls = crawler.bing_get_image_url_using_api('cat', max_number=50, window=4)
+            self.assertEqual(sorted(pages), [1, 36])
+            self.assertEqual(len(urls), 71)
+
+    def test_webpage_streams_batches(self):
+        driver = FakeDriver(total=10, batch=4)
+        urls = crawler.bing_image_url_from_webpage(driver, stream=True, scroll_timeout=0.2)
+        self.assertEqual([next(urls) for _ in range(4)], ['https://example.com/%d.jpg' % i for i in range(4)])
+        self.assertEqual(len(list(urls)), 6)
+        urls = crawler.bing_image_url_from_webpage(FakeDriver(total=1000, batch=35), scroll_timeout=0.2)
+        self.assertEqual(len(urls), 1000)
+        self.assertEqual(len(set(urls)), 1000)
+
+    def test_webpage_without_results(self):
+        driver = FakeDriver(total=0, batch=4)
+        self.assertEqual(crawler.bing_image_url_from_webpage(driver, timeout=0.2), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
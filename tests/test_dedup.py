@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+from PIL import Image, ImageDraw
+
+from better_bing_image_downloader.dedup import DedupIndex, hamming, image_phash
+
+
+def make_image(path, shade=0, size=(64, 48)):
+    img = Image.new('RGB', size, (255, 255, 255))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle([0, 0, size[0] // 2, size[1] // 2], fill=(shade, shade, shade))
+    draw.ellipse([size[0] // 2, size[1] // 3, size[0], size[1]], fill=(200, 30, 30))
+    img.save(path)
+    return path
+
+
+class TestDedupIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def touch(self, name):
+        path = os.path.join(self.dir, name)
+        open(path, 'wb').close()
+        return path
+
+    def test_exact_duplicates_persist(self):
+        with DedupIndex(self.dir) as index:
+            self.assertTrue(index.add('abc', self.touch('a.jpg')))
+            self.assertFalse(index.add('abc', os.path.join(self.dir, 'b.jpg')))
+        with DedupIndex(self.dir) as index:
+            self.assertEqual(index.find('abc'), os.path.join(self.dir, 'a.jpg'))
+
+    def test_removed_files_are_forgotten(self):
+        with DedupIndex(self.dir) as index:
+            path = self.touch('a.jpg')
+            index.add('abc', path)
+            os.remove(path)
+            self.assertIsNone(index.find('abc'))
+            self.assertTrue(index.add('abc', self.touch('b.jpg')))
+
+    def test_perceptual_duplicates(self):
+        original = make_image(os.path.join(self.dir, 'a.png'))
+        resized = make_image(os.path.join(self.dir, 'b.png'), shade=8, size=(128, 96))
+        self.assertLessEqual(hamming(image_phash(original), image_phash(resized)), 6)
+        with DedupIndex(self.dir, phash_distance=6) as index:
+            index.add('sha-a', original, image_phash(original))
+        with DedupIndex(self.dir, phash_distance=6) as index:
+            self.assertEqual(index.find('sha-b', image_phash(resized)), original)
+            self.assertIsNone(index.find('sha-c', image_phash(original) ^ 0xFFFF0000FFFF))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,329 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch
+
+import httpx
+
+from better_bing_image_downloader import download
+from better_bing_image_downloader.parser import ImageCandidate
+from better_bing_image_downloader.retry import RetryPolicy
+from better_bing_image_downloader.seen import BloomFilter, FingerprintSet, load_seen
+
+
+def jpeg(body):
+    return b'\xff\xd8\xff\xe0' + body.encode().ljust(32, b'.')
+
+
+def fake_client(handler):
+    real_client = httpx.AsyncClient
+
+    def factory(*args, **kwargs):
+        kwargs['transport'] = httpx.MockTransport(handler)
+        return real_client(*args, **kwargs)
+    return factory
+
+
+def candidate(url):
+    return ImageCandidate(url, None, None, None, None, None, 'https://example.com/page')
+
+
+def fake_urls(urls):
+    async def get_image_candidates(self, session=None):
+        for url in urls:
+            if self.journal is not None and self.journal.is_done(url):
+                continue
+            if self.download_count >= self.limit:
+                return
+            yield candidate(url)
+    return get_image_candidates
+
+
+class TestDownloader(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def run_downloader(self, urls, handler, **kwargs):
+        with patch.object(download.httpx, 'AsyncClient', fake_client(handler)), \
+                patch.object(download.Bing, 'get_image_candidates', fake_urls(urls)):
+            asyncio.run(download.downloader('cat', output_dir=self.output_dir, **kwargs))
+        return sorted(f for f in os.listdir(os.path.join(self.output_dir, 'cat')) if not f.startswith('.journal'))
+
+    def test_stops_at_limit(self):
+        urls = ['https://example.com/%d.jpg' % i for i in range(50)]
+        files = self.run_downloader(urls, lambda request: httpx.Response(200, content=jpeg(request.url.path)),
+                                    limit=7, concurrency=4)
+        self.assertEqual(files, sorted('Image_%d.jpg' % i for i in range(7)))
+
+    def test_failures_do_not_count(self):
+        urls = ['https://example.com/%d.jpg' % i for i in range(10)]
+
+        def handler(request):
+            if request.url.path.startswith('/1') or request.url.path.startswith('/3'):
+                return httpx.Response(404)
+            return httpx.Response(200, content=jpeg(request.url.path))
+        files = self.run_downloader(urls, handler, limit=20, concurrency=3)
+        self.assertEqual(len(files), 8)
+
+    def test_max_bytes(self):
+        urls = ['https://example.com/small.jpg', 'https://example.com/big.jpg', 'https://example.com/huge.jpg']
+
+        def handler(request):
+            if request.url.path == '/big.jpg':
+                return httpx.Response(200, content=jpeg('x' * 5000))
+            if request.url.path == '/huge.jpg':
+                return httpx.Response(200, headers={'Content-Length': '999999'}, content=jpeg('x' * 999999))
+            return httpx.Response(200, content=jpeg('x' * 100))
+        files = self.run_downloader(urls, handler, limit=5, concurrency=2, max_bytes=1000)
+        self.assertEqual(files, ['Image_0.jpg'])
+
+    def test_resume_only_fetches_new_images(self):
+        urls = ['https://example.com/%d.jpg' % i for i in range(20)]
+        fetched = []
+
+        def handler(request):
+            fetched.append(str(request.url))
+            return httpx.Response(200, content=jpeg(request.url.path))
+        self.run_downloader(urls, handler, limit=3, concurrency=1)
+        self.assertEqual(len(fetched), 3)
+        files = self.run_downloader(urls, handler, limit=5, concurrency=1)
+        self.assertEqual(fetched, urls[:5])
+        self.assertEqual(files, ['Image_%d.jpg' % i for i in range(5)])
+
+    def test_runs_without_journal_do_not_overwrite(self):
+        def run(prefix):
+            urls = ['https://example.com/%s/%d.jpg' % (prefix, i) for i in range(3)]
+            return self.run_downloader(urls, lambda request: httpx.Response(200, content=jpeg(request.url.path)),
+                                       limit=3, concurrency=2, resume=False)
+        run('first')
+        files = run('second')
+        self.assertEqual(files, sorted('Image_%d.jpg' % i for i in range(6)))
+        contents = set()
+        for f in files:
+            with open(os.path.join(self.output_dir, 'cat', f), 'rb') as fh:
+                contents.add(fh.read())
+        self.assertEqual(len(contents), 6)
+
+    def test_duplicates_do_not_count(self):
+        urls = ['https://example.com/%d.jpg' % i for i in range(10)]
+
+        def handler(request):
+            index = int(request.url.path[1:-4])
+            return httpx.Response(200, content=jpeg('same' if index < 5 else request.url.path))
+        files = self.run_downloader(urls, handler, limit=4, concurrency=2)
+        self.assertEqual(len(files), 4)
+        contents = set()
+        for f in files:
+            with open(os.path.join(self.output_dir, 'cat', f), 'rb') as fh:
+                contents.add(fh.read())
+        self.assertEqual(len(contents), 4)
+
+    def test_download_many(self):
+        async def get_image_candidates(bing, session=None):
+            for i in range(30):
+                if bing.download_count >= bing.limit:
+                    return
+                yield candidate('https://example.com/%s/%d.jpg' % (bing.query, i))
+
+        with patch.object(download.httpx, 'AsyncClient', fake_client(
+                lambda request: httpx.Response(200, content=jpeg(request.url.path)))), \
+                patch.object(download.Bing, 'get_image_candidates', get_image_candidates):
+            results = asyncio.run(download.download_many(
+                ['cat\n', 'dog\n', '\n', 'fish'], limit=6, output_dir=self.output_dir,
+                max_connections=3, query_concurrency=2))
+        self.assertEqual(sorted(results), ['cat', 'dog', 'fish'])
+        for query, result in results.items():
+            self.assertEqual(result.downloaded, 6)
+            self.assertEqual(len(os.listdir(os.path.join(self.output_dir, query))), 7)
+
+    def test_crawl_errors_are_raised(self):
+        async def get_image_candidates(bing, session=None):
+            yield candidate('https://example.com/%s/0.jpg' % bing.query)
+            raise ValueError('corrupt journal')
+
+        with patch.object(download.httpx, 'AsyncClient', fake_client(
+                lambda request: httpx.Response(200, content=jpeg(request.url.path)))), \
+                patch.object(download.Bing, 'get_image_candidates', get_image_candidates):
+            with self.assertRaises(ValueError):
+                asyncio.run(download.downloader('cat', limit=5, output_dir=self.output_dir))
+            results = asyncio.run(download.download_many(['cat', 'dog'], limit=5, output_dir=self.output_dir))
+        self.assertIsInstance(results['dog'], ValueError)
+
+    def test_non_images_are_dropped(self):
+        urls = ['https://example.com/a', 'https://example.com/b', 'https://example.com/c']
+
+        def handler(request):
+            if request.url.path == '/a':
+                return httpx.Response(200, content=b'<!DOCTYPE html><html>blocked</html>' * 1000)
+            if request.url.path == '/b':
+                return httpx.Response(200, content=b'\x89PNG\r\n\x1a\n' + b'.' * 40)
+            return httpx.Response(200, content=jpeg('c'))
+        files = self.run_downloader(urls, handler, limit=5, concurrency=1)
+        self.assertEqual(files, ['Image_0.png', 'Image_1.jpg'])
+
+    def test_verify_in_process_pool(self):
+        import io
+        from PIL import Image
+
+        buf = io.BytesIO()
+        Image.new('RGB', (8, 8), (10, 200, 30)).save(buf, 'PNG')
+        urls = ['https://example.com/broken', 'https://example.com/good']
+
+        def handler(request):
+            if request.url.path == '/broken':
+                return httpx.Response(200, content=jpeg('truncated'))
+            return httpx.Response(200, content=buf.getvalue())
+        files = self.run_downloader(urls, handler, limit=5, concurrency=2, verify=True, process_workers=1)
+        self.assertEqual(files, ['Image_0.png'])
+
+    def test_tar_backend(self):
+        from better_bing_image_downloader.storage import load_shard_index, read_member
+
+        urls = ['https://example.com/%d.jpg' % i for i in range(6)]
+        files = self.run_downloader(urls, lambda request: httpx.Response(200, content=jpeg(request.url.path)),
+                                    limit=4, concurrency=2, output_backend='tar')
+        self.assertEqual(files, ['shard-00000.idx', 'shard-00000.tar'])
+        index = load_shard_index(os.path.join(self.output_dir, 'cat'))
+        self.assertEqual(sorted(index), ['Image_%d.jpg' % i for i in range(4)])
+        bodies = {read_member(*entry) for entry in index.values()}
+        self.assertEqual(len(bodies), 4)
+        self.assertTrue(all(body.startswith(b'\xff\xd8\xff') for body in bodies))
+
+    def test_manifest(self):
+        import io
+        from PIL import Image
+        from better_bing_image_downloader.manifest import load_manifest
+
+        buf = io.BytesIO()
+        Image.new('RGB', (12, 8)).save(buf, 'PNG')
+        urls = ['https://example.com/%d.png' % i for i in range(5)]
+
+        def handler(request):
+            return httpx.Response(200, content=buf.getvalue() + request.url.path.encode())
+        manifest = os.path.join(self.output_dir, 'manifest.jsonl')
+        self.run_downloader(urls, handler, limit=3, concurrency=2, manifest=manifest)
+        records = load_manifest(manifest)
+        self.assertEqual(len(records), 3)
+        for record in records:
+            self.assertEqual(record['query'], 'cat')
+            self.assertIn(record['url'], urls)
+            self.assertEqual(record['page_url'], 'https://example.com/page')
+            self.assertTrue(os.path.isfile(record['path']))
+            self.assertEqual(record['bytes'], os.path.getsize(record['path']))
+            self.assertEqual((record['format'], record['width'], record['height']), ('png', 12, 8))
+            self.assertEqual(len(record['sha256']), 64)
+            self.assertGreaterEqual(record['download_seconds'], 0)
+
+    def test_metrics_and_events(self):
+        from better_bing_image_downloader.journal import DONE, FAILED
+        from better_bing_image_downloader.metrics import Metrics
+
+        urls = ['https://example.com/%d.jpg' % i for i in range(6)]
+
+        def handler(request):
+            if request.url.path == '/2.jpg':
+                return httpx.Response(404)
+            return httpx.Response(200, content=jpeg(request.url.path))
+        metrics = Metrics()
+        events = []
+        self.run_downloader(urls, handler, limit=4, concurrency=1, metrics=metrics, callback=events.append)
+        stats = metrics.stats()
+        self.assertEqual(stats.images, 4)
+        self.assertEqual(stats.failures, {'http_404': 1})
+        self.assertEqual(stats.stages['transfer']['count'], 4)
+        self.assertEqual(stats.hosts['example.com']['count'], 5)
+        self.assertEqual([e.status for e in events], [DONE, DONE, FAILED, DONE, DONE])
+        self.assertEqual(events[-1].count, 4)
+        self.assertEqual(events[2].error.response.status_code, 404)
+
+    def test_retries_transient_failures(self):
+        urls = ['https://example.com/%d.jpg' % i for i in range(4)]
+        tries = {}
+
+        def handler(request):
+            path = request.url.path
+            tries[path] = tries.get(path, 0) + 1
+            if path == '/1.jpg' and tries[path] < 3:
+                return httpx.Response(503)
+            if path == '/2.jpg':
+                return httpx.Response(404)
+            return httpx.Response(200, content=jpeg(path))
+        files = self.run_downloader(urls, handler, limit=10, concurrency=2,
+                                    retry=RetryPolicy(attempts=3, backoff=0.01))
+        self.assertEqual(len(files), 3)
+        self.assertEqual(tries['/1.jpg'], 3)
+        self.assertEqual(tries['/2.jpg'], 1)
+
+    def test_adaptive_concurrency(self):
+        urls = ['https://example.com/%d.jpg' % i for i in range(12)]
+        in_flight = [0, 0]
+
+        async def handler(request):
+            in_flight[0] += 1
+            in_flight[1] = max(in_flight)
+            await asyncio.sleep(0.01)
+            in_flight[0] -= 1
+            return httpx.Response(200, content=jpeg(request.url.path))
+        files = self.run_downloader(urls, handler, limit=12, concurrency=2, min_concurrency=1, max_concurrency=8,
+                                    bandwidth=10 ** 6)
+        self.assertEqual(len(files), 12)
+        # Eight workers, but the limit starts at two and has no time to grow.
+        self.assertEqual(in_flight[1], 2)
+
+    def test_seen_file(self):
+        urls = ['https://example.com/%d.jpg' % i for i in range(10)]
+        path = os.path.join(self.output_dir, 'seen.bin')
+        seen = FingerprintSet()
+        seen.add(urls[0])
+        seen.save(path)
+        requested = []
+
+        async def handler(request):
+            requested.append(str(request.url))
+            await asyncio.sleep(0.01)
+            if request.url.path == '/5.jpg':
+                return httpx.Response(404)
+            return httpx.Response(200, content=jpeg(request.url.path))
+
+        def saved_urls():
+            saved = set()
+            for name in os.listdir(os.path.join(self.output_dir, 'cat')):
+                with open(os.path.join(self.output_dir, 'cat', name), 'rb') as f:
+                    saved.add('https://example.com' + f.read()[4:].rstrip(b'.').decode())
+            return saved
+
+        # Queries in flight when the limit is hit are not kept as seen, nor are failures.
+        self.run_downloader(urls, handler, limit=3, concurrency=4, resume=False, dedup=False, seen=path)
+        self.assertNotIn(urls[0], requested)
+        first = saved_urls()
+        self.assertEqual(len(first), 3)
+        self.assertEqual({url for url in urls if url in load_seen(path)}, first | {urls[0]})
+
+        requested.clear()
+        self.run_downloader(urls, handler, limit=3, concurrency=4, resume=False, dedup=False, seen=path,
+                            name='Again')
+        self.assertFalse((first | {urls[0]}) & set(requested))
+        both = saved_urls()
+        self.assertEqual(len(both), 6)
+        self.assertEqual({url for url in urls if url in load_seen(path)}, both | {urls[0]})
+
+    def test_seen_error_rate(self):
+        urls = ['https://example.com/%d.jpg' % i for i in range(4)]
+        path = os.path.join(self.output_dir, 'seen.bin')
+
+        async def handler(request):
+            return httpx.Response(200, content=jpeg(request.url.path))
+
+        self.run_downloader(urls, handler, limit=4, seen=path, seen_error_rate=0.01)
+        seen = load_seen(path)
+        self.assertIsInstance(seen, BloomFilter)
+        self.assertEqual(seen.error_rate, 0.01)
+        self.assertTrue(all(url in seen for url in urls))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+import threading
+import unittest
+
+from better_bing_image_downloader import crawler
+from better_bing_image_downloader.driverpool import DriverPool
+
+
+class FakeDriver(object):
+    started = 0
+
+    def __init__(self):
+        FakeDriver.started += 1
+        self.urls = []
+        self.cookies_cleared = 0
+        self.quit_called = False
+        self.broken = False
+
+    def set_window_size(self, width, height):
+        pass
+
+    def get(self, url):
+        if self.broken:
+            raise RuntimeError('browser crashed')
+        self.urls.append(url)
+
+    def delete_all_cookies(self):
+        self.cookies_cleared += 1
+
+    def execute_script(self, script, *args):
+        if script == crawler._COUNT_SCRIPT:
+            return 3 if args[0] == '.iusc' else 0
+        if script == crawler._BING_COLLECT_SCRIPT:
+            return ['https://example.com/%s/%d.jpg' % (self.urls[-1][-3:], i) for i in range(args[0], 3)]
+        return False
+
+    def quit(self):
+        self.quit_called = True
+
+
+class TestDriverPool(unittest.TestCase):
+    def setUp(self):
+        FakeDriver.started = 0
+
+    def test_reuse_and_reset(self):
+        with DriverPool(size=1, factory=FakeDriver) as pool:
+            with pool.driver() as first:
+                first.get('https://example.com/a')
+            with pool.driver() as second:
+                self.assertIs(first, second)
+                self.assertEqual(second.urls, ['https://example.com/a', 'about:blank'])
+                self.assertEqual(second.cookies_cleared, 1)
+        self.assertTrue(first.quit_called)
+        self.assertEqual(FakeDriver.started, 1)
+
+    def test_recycles_after_max_pages_and_crashes(self):
+        with DriverPool(size=1, max_pages=2, factory=FakeDriver) as pool:
+            for _ in range(2):
+                with pool.driver() as driver:
+                    pass
+            self.assertTrue(driver.quit_called)
+            with pool.driver() as fresh:
+                pass
+            self.assertIsNot(fresh, driver)
+            with self.assertRaises(RuntimeError):
+                with pool.driver() as crashed:
+                    crashed.broken = True
+                    crashed.get('https://example.com/b')
+            self.assertTrue(crashed.quit_called)
+            with pool.driver() as replacement:
+                self.assertFalse(replacement.broken)
+        self.assertEqual(FakeDriver.started, 3)
+
+    def test_streamed_crawls_closed_early_reuse_the_driver(self):
+        with DriverPool(size=1, factory=FakeDriver) as pool:
+            for keyword in ['k1', 'k2', 'k3']:
+                urls = crawler.crawl_image_urls(keyword, engine='Bing', browser='chrome_headless', max_number=10,
+                                                quiet=True, scroll_timeout=0.1, stream=True, driver_pool=pool)
+                self.assertTrue(next(urls).startswith('https://example.com/'))
+                # Abandoned: the crawl generator is closed as it is dropped.
+                del urls
+            with pool.driver() as driver:
+                self.assertFalse(driver.quit_called)
+        self.assertEqual(FakeDriver.started, 1)
+
+    def test_crawl_many(self):
+        in_use = []
+        peak = []
+        lock = threading.Lock()
+
+        class CountingDriver(FakeDriver):
+            def get(self, url):
+                with lock:
+                    if url != 'about:blank':
+                        in_use.append(url)
+                        peak.append(len(in_use))
+                super(CountingDriver, self).get(url)
+
+            def delete_all_cookies(self):
+                with lock:
+                    in_use.pop()
+                super(CountingDriver, self).delete_all_cookies()
+
+        keywords = ['k%02d' % i for i in range(8)]
+        with DriverPool(size=2, factory=CountingDriver) as pool:
+            results = crawler.crawl_many_image_urls(keywords, pool, engine='Bing', browser='chrome_headless',
+                                                    quiet=True, scroll_timeout=0.1)
+        self.assertEqual(sorted(results), keywords)
+        self.assertEqual(len(results['k03']), 3)
+        self.assertEqual(FakeDriver.started, 2)
+        self.assertLessEqual(max(peak), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
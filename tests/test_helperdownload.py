@@ -0,0 +1,104 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+from better_bing_image_downloader import helperdownload
+from better_bing_image_downloader.retry import RetryPolicy
+from better_bing_image_downloader.sniff import NotAnImage
+
+
+class TestDownloadImages(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        png = io.BytesIO()
+        Image.new('RGB', (4, 4)).save(png, 'PNG')
+        body = png.getvalue()
+        self.requests = []
+        requests = self.requests
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                requests.append((self.path, self.client_address[1]))
+                if self.path.startswith('/missing'):
+                    status, content = 404, b''
+                elif self.path.startswith('/page'):
+                    status, content = 200, b'<!DOCTYPE html><html></html>'
+                else:
+                    status, content = 200, body
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.output_dir)
+
+    def test_results(self):
+        urls = [self.url + '/a.png', self.url + '/missing.png', self.url + '/page.html']
+        results = helperdownload.download_images(urls, self.output_dir, concurrency=2,
+                                                 retry=RetryPolicy(backoff=0.01))
+        by_url = {r.url: r for r in results}
+        self.assertEqual(len(results), 3)
+        self.assertEqual(by_url[urls[0]].path, os.path.join(self.output_dir, 'img_0000.png'))
+        self.assertIsNone(by_url[urls[0]].error)
+        self.assertEqual(by_url[urls[1]].error.response.status_code, 404)
+        self.assertIsInstance(by_url[urls[2]].error, NotAnImage)
+        self.assertEqual(os.listdir(self.output_dir), ['img_0000.png'])
+
+    def test_streams_urls_over_reused_connections(self):
+        def urls():
+            for i in range(40):
+                yield self.url + '/%d.png' % i
+
+        results = list(helperdownload.iter_download_images(urls(), self.output_dir, concurrency=2, per_host=2))
+        self.assertEqual(len(results), 40)
+        self.assertTrue(all(r.error is None for r in results))
+        self.assertEqual(len(os.listdir(self.output_dir)), 40)
+        # Each download thread keeps its connection alive.
+        self.assertLessEqual(len({port for _, port in self.requests}), 2)
+
+    def test_stops_early(self):
+        def urls():
+            for i in range(10 ** 6):
+                yield self.url + '/%d.png' % i
+
+        results = helperdownload.iter_download_images(urls(), self.output_dir, concurrency=2)
+        first = [next(results) for _ in range(3)]
+        results.close()
+        self.assertTrue(all(r.error is None for r in first))
+        self.assertLess(len(self.requests), 50)
+
+    def test_adaptive_concurrency_and_bandwidth(self):
+        urls = [self.url + '/%d.png' % i for i in range(12)]
+        size = os.path.getsize(helperdownload.download_images(urls[:1], self.output_dir)[0].path)
+        start = time.monotonic()
+        results = helperdownload.download_images(urls, self.output_dir, concurrency=2, min_concurrency=1,
+                                                 max_concurrency=4, bandwidth=size * 8)
+        self.assertTrue(all(r.error is None for r in results))
+        # The first image is numbered on from, not overwritten.
+        self.assertEqual(len(os.listdir(self.output_dir)), 13)
+        # A burst of 8 images, then 4 more at 8 per second.
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+from better_bing_image_downloader.manifest import FIELDS, Manifest, load_manifest
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'manifest.jsonl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_flushes_in_batches(self):
+        manifest = Manifest(self.path, batch_size=3)
+        for i in range(4):
+            manifest.add(query='cat', url='https://example.com/%d.jpg' % i, bytes=i)
+        self.assertEqual(len(load_manifest(self.path)), 3)
+        manifest.close()
+        records = load_manifest(self.path)
+        self.assertEqual([r['bytes'] for r in records], [0, 1, 2, 3])
+        self.assertEqual(list(records[0]), FIELDS)
+        self.assertIsNone(records[0]['width'])
+
+    def test_appends_across_runs(self):
+        for run in range(2):
+            with Manifest(self.path) as manifest:
+                manifest.add(url=str(run))
+        self.assertEqual([r['url'] for r in load_manifest(self.path)], ['0', '1'])
+
+    def test_unknown_field(self):
+        with Manifest(self.path) as manifest:
+            self.assertRaises(TypeError, manifest.add, colour='red')
+
+    def test_parquet(self):
+        if importlib.util.find_spec('pyarrow') is None:
+            self.skipTest('pyarrow is not installed')
+        path = os.path.join(self.tmp.name, 'manifest.parquet')
+        with Manifest(path, batch_size=2) as manifest:
+            for i in range(5):
+                manifest.add(query='cat', url=str(i), width=i, height=2 * i)
+        records = load_manifest(path)
+        self.assertEqual([r['width'] for r in records], list(range(5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
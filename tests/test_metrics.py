@@ -0,0 +1,74 @@
+import io
+import json
+import unittest
+import urllib.error
+import urllib.request
+
+from better_bing_image_downloader.metrics import (Histogram, JsonLinesReporter, Metrics, PrometheusServer,
+                                                  failure_cause)
+from better_bing_image_downloader.sniff import NotAnImage
+from better_bing_image_downloader.streaming import ImageTooLarge
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_quantiles(self):
+        histogram = Histogram((1.0, 2.0, 4.0))
+        for value in [0.5] * 50 + [3.0] * 49 + [10.0]:
+            histogram.observe(value)
+        self.assertEqual(histogram.count, 100)
+        self.assertLessEqual(histogram.quantile(0.5), 1.0)
+        self.assertTrue(2.0 <= histogram.quantile(0.95) <= 4.0)
+        self.assertIsNone(Histogram().quantile(0.5))
+
+    def test_stats(self):
+        metrics = Metrics()
+        metrics.received(2000000)
+        metrics.saved()
+        metrics.duplicate()
+        metrics.retry()
+        metrics.failed(ImageTooLarge('big'))
+        metrics.failed('timeout')
+        metrics.observe('transfer', 0.2)
+        metrics.observe_host('example.com', 0.3)
+        stats = metrics.stats()
+        self.assertEqual((stats.images, stats.bytes, stats.duplicates, stats.retries), (1, 2000000, 1, 1))
+        self.assertEqual(stats.failures, {'too_large': 1, 'timeout': 1})
+        self.assertGreater(stats.images_per_second, 0)
+        self.assertGreater(stats.mb_per_second, 0)
+        self.assertEqual(stats.stages['transfer']['count'], 1)
+        self.assertEqual(stats.hosts['example.com']['count'], 1)
+
+    def test_failure_cause(self):
+        self.assertEqual(failure_cause(NotAnImage('html')), 'not_image')
+        self.assertEqual(failure_cause(urllib.error.HTTPError('u', 404, 'Not Found', {}, None)), 'http_404')
+        self.assertEqual(failure_cause(TimeoutError()), 'timeout')
+        self.assertEqual(failure_cause(ConnectionResetError()), 'connection')
+        self.assertEqual(failure_cause(RuntimeError()), 'error')
+
+    def test_json_lines_reporter(self):
+        metrics = Metrics()
+        metrics.saved()
+        stream = io.StringIO()
+        reporter = JsonLinesReporter(metrics, stream, interval=60).start()
+        reporter.stop()
+        record = json.loads(stream.getvalue().splitlines()[-1])
+        self.assertEqual(record['images'], 1)
+        self.assertIn('time', record)
+
+    def test_prometheus_server(self):
+        metrics = Metrics()
+        metrics.failed('http_503')
+        metrics.observe('page', 0.07)
+        server = PrometheusServer(metrics, 0).start()
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:%d/metrics' % server.port) as response:
+                text = response.read().decode()
+        finally:
+            server.close()
+        self.assertIn('bing_downloader_failures_total{cause="http_503"} 1', text)
+        self.assertIn('bing_downloader_stage_seconds_bucket{stage="page",le="0.1"} 1', text)
+        self.assertIn('bing_downloader_stage_seconds_count{stage="page"} 1', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
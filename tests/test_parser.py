@@ -0,0 +1,44 @@
+import unittest
+
+from better_bing_image_downloader.parser import CandidateFilter, ImageCandidate, parse_result_page
+
+PAGE = (
+    '<div class="imgpt"><a class="iusc" style="height:180px" '
+    'm="{&quot;purl&quot;:&quot;https://example.com/page&quot;,'
+    '&quot;murl&quot;:&quot;https://example.com/big.jpg?a=1&amp;b=2&quot;,'
+    '&quot;turl&quot;:&quot;https://tse1.mm.bing.net/th?id=1&quot;}" '
+    'mad="{&quot;maw&quot;:&quot;474&quot;,&quot;mah&quot;:&quot;266&quot;}" '
+    'href="/images/search?view=detailV2&amp;expw=1920&amp;exph=1080&amp;q=cat">'
+    '</a><div class="img_info hon"><span class="nowrap">1920 x 1080 &#183; jpeg</span></div></div>'
+    '<div class="imgpt"><a class="iusc" '
+    'm="{&quot;murl&quot;:&quot;https://example.com/small.png&quot;}" href="/images/search">'
+    '</a><span class="nowrap">120 x 90 · png</span></div>'
+    '<div class="imgpt"><a class="iusc" m="{&quot;murl&quot;:&quot;https://example.com/unknown&quot;}"></a></div>'
+)
+
+
+class TestParser(unittest.TestCase):
+    def test_parse_result_page(self):
+        big, small, unknown = parse_result_page(PAGE)
+        self.assertEqual(big, ImageCandidate(
+            'https://example.com/big.jpg?a=1&b=2', 1920, 1080, None, 'jpeg',
+            'https://tse1.mm.bing.net/th?id=1', 'https://example.com/page'))
+        self.assertEqual((small.width, small.height, small.format), (120, 90, 'png'))
+        self.assertEqual((unknown.width, unknown.format), (None, None))
+
+    def test_bare_murl_fallback(self):
+        page = 'murl&quot;:&quot;https://a.com/x.gif&quot; murl&quot;:&quot;https://b.com/y&quot;'
+        self.assertEqual([(c.url, c.format) for c in parse_result_page(page)],
+                         [('https://a.com/x.gif', 'gif'), ('https://b.com/y', None)])
+
+    def test_candidate_filter(self):
+        candidates = list(parse_result_page(PAGE))
+        accepted = [c.url for c in candidates if CandidateFilter(min_width=800).accepts(c)]
+        self.assertEqual(accepted, ['https://example.com/big.jpg?a=1&b=2', 'https://example.com/unknown'])
+        self.assertFalse(CandidateFilter(max_aspect=1.5).accepts(candidates[0]))
+        self.assertTrue(CandidateFilter(min_aspect=1.2).accepts(candidates[1]))
+        self.assertFalse(CandidateFilter())
+
+
+if __name__ == '__main__':
+    unittest.main()
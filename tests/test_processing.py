@@ -0,0 +1,86 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from PIL import Image
+
+from better_bing_image_downloader.processing import (ImagePool, Transform, commit_transformed, discard_transformed,
+                                                     examine_image, transform_image, verify_image)
+from better_bing_image_downloader.storage import DirectoryBackend
+from better_bing_image_downloader.streaming import PartFile
+
+
+def slow_transform_image(path, transform):
+    transformed = transform_image(path, transform)
+    time.sleep(0.5)
+    return transformed
+
+
+class TestProcessing(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make_part(self, size=(400, 200), fmt='PNG'):
+        path = os.path.join(self.dir, 'src')
+        exif = Image.Exif()
+        exif[0x010e] = 'secret description'
+        Image.new('RGB', size, (200, 10, 10)).save(path, fmt, exif=exif)
+        part = PartFile(self.dir, require_image=True)
+        with open(path, 'rb') as f:
+            part.write(f.read())
+        part.close()
+        os.remove(path)
+        return part
+
+    def test_verify(self):
+        part = self.make_part()
+        verify_image(part.path)
+        self.assertIsInstance(examine_image(part.path, verify=True, phash=True), int)
+        with open(part.path, 'r+b') as f:
+            f.truncate(40)
+        with self.assertRaises(ValueError):
+            verify_image(part.path)
+        part.discard()
+
+    def test_transform(self):
+        part = self.make_part(fmt='JPEG')
+        transform = Transform(resize_max_side=100, output_format='webp', thumbnail_size=20, keep_original=True)
+        transformed = transform_image(part.path, transform)
+        path = commit_transformed(part, transformed, DirectoryBackend(self.dir), 'Image_0', transform.keep_original)
+        self.assertEqual(path, os.path.join(self.dir, 'Image_0.webp'))
+        with Image.open(path) as img:
+            self.assertEqual((img.format, img.size), ('WEBP', (100, 50)))
+            self.assertNotIn(0x010e, img.getexif())
+        with Image.open(os.path.join(self.dir, 'thumbnails', 'Image_0.webp')) as img:
+            self.assertEqual(img.size, (20, 10))
+        self.assertTrue(os.path.exists(os.path.join(self.dir, 'originals', 'Image_0.jpg')))
+        self.assertEqual(sorted(os.listdir(self.dir)), ['Image_0.webp', 'originals', 'thumbnails'])
+
+    def test_cancelled_transform_leaves_no_files(self):
+        part = self.make_part()
+        transform = Transform(thumbnail_size=20)
+
+        async def worker(pool):
+            with part:
+                await pool.run(slow_transform_image, part.path, transform, discard=discard_transformed)
+
+        async def run():
+            with ImagePool(1) as pool:
+                task = asyncio.ensure_future(worker(pool))
+                await asyncio.sleep(0.2)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+
+        asyncio.run(run())
+        self.assertEqual(os.listdir(self.dir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
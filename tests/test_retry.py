@@ -0,0 +1,128 @@
+import asyncio
+import time
+import unittest
+
+import httpx
+
+from better_bing_image_downloader.retry import HostUnavailable, RetryPolicy, retry_after, status_of
+
+
+def status_error(status, headers=None):
+    request = httpx.Request('GET', 'https://example.com/a.jpg')
+    response = httpx.Response(status, headers=headers, request=request)
+    return httpx.HTTPStatusError('HTTP %d' % status, request=request, response=response)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_classification(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.retryable(status_error(503)))
+        self.assertTrue(policy.retryable(status_error(429)))
+        self.assertFalse(policy.retryable(status_error(404)))
+        self.assertTrue(policy.retryable(httpx.ConnectTimeout('slow')))
+        self.assertTrue(policy.retryable(ConnectionResetError()))
+        self.assertFalse(policy.retryable(ValueError('not an image')))
+        self.assertFalse(policy.retryable(HostUnavailable('open')))
+        self.assertEqual(status_of(status_error(502)), 502)
+        self.assertIsNone(status_of(TimeoutError()))
+
+    def test_delay(self):
+        policy = RetryPolicy(backoff=1.0, max_backoff=4.0, max_retry_after=10.0)
+        self.assertTrue(0.5 <= policy.delay(1) <= 1.0)
+        self.assertTrue(2.0 <= policy.delay(5) <= 4.0)
+        self.assertEqual(retry_after(status_error(429, {'Retry-After': '7'})), 7.0)
+        self.assertEqual(policy.delay(1, status_error(429, {'Retry-After': '7'})), 7.0)
+        self.assertEqual(policy.delay(1, status_error(429, {'Retry-After': '600'})), 10.0)
+        self.assertTrue(retry_after(status_error(503, {'Retry-After': 'Wed, 21 Oct 2015 07:28:00 GMT'})) == 0.0)
+
+    def test_circuit_breaker(self):
+        policy = RetryPolicy(breaker_threshold=2, breaker_cooldown=10.0)
+        policy.failure('a', status_error(500), now=0.0)
+        self.assertTrue(policy.allow('a', now=0.0))
+        policy.failure('a', status_error(500), now=1.0)
+        self.assertFalse(policy.allow('a', now=5.0))
+        self.assertTrue(policy.allow('b', now=5.0))
+        # Half open: one trial after the cooldown, whose failure opens it again.
+        self.assertTrue(policy.allow('a', now=11.0))
+        self.assertFalse(policy.allow('a', now=11.0))
+        policy.failure('a', status_error(500), now=11.0)
+        self.assertFalse(policy.allow('a', now=20.0))
+        self.assertTrue(policy.allow('a', now=21.5))
+        policy.success('a')
+        self.assertTrue(policy.allow('a', now=21.5))
+        # A 4xx answer shows the host is up.
+        policy.failure('c', status_error(500), now=0.0)
+        policy.failure('c', status_error(404), now=0.0)
+        policy.failure('c', status_error(500), now=0.0)
+        self.assertTrue(policy.allow('c', now=0.0))
+
+    def test_call(self):
+        policy = RetryPolicy(attempts=3, backoff=0.001)
+        tries = []
+
+        def flaky():
+            tries.append(1)
+            if len(tries) < 3:
+                raise status_error(503)
+            return 'ok'
+        self.assertEqual(policy.call(flaky, host='a'), 'ok')
+        self.assertEqual(len(tries), 3)
+
+        def missing():
+            tries.append(1)
+            raise status_error(404)
+        del tries[:]
+        with self.assertRaises(httpx.HTTPStatusError):
+            policy.call(missing, host='a')
+        self.assertEqual(len(tries), 1)
+
+    def test_call_skips_open_hosts(self):
+        policy = RetryPolicy(attempts=5, backoff=0.001, breaker_threshold=2)
+        tries = []
+
+        def down():
+            tries.append(1)
+            raise ConnectionRefusedError()
+        with self.assertRaises(ConnectionRefusedError):
+            policy.call(down, host='a')
+        self.assertEqual(len(tries), 2)
+        with self.assertRaises(HostUnavailable):
+            policy.call(down, host='a')
+        self.assertEqual(len(tries), 2)
+
+    def test_call_async(self):
+        policy = RetryPolicy(attempts=2, backoff=0.001)
+        tries = []
+
+        async def flaky(value):
+            tries.append(1)
+            if len(tries) < 2:
+                raise httpx.ReadTimeout('slow')
+            return value
+        self.assertEqual(asyncio.run(policy.call_async(flaky, 42, host='a')), 42)
+        self.assertEqual(len(tries), 2)
+
+    def test_cancelled_trial_frees_the_host(self):
+        policy = RetryPolicy(attempts=1, breaker_threshold=1, breaker_cooldown=0.05)
+        policy.failure('a', status_error(500))
+
+        async def run():
+            await asyncio.sleep(0.06)
+            trial = asyncio.ensure_future(policy.call_async(asyncio.sleep, 10, host='a'))
+            await asyncio.sleep(0)
+            trial.cancel()
+            await asyncio.gather(trial, return_exceptions=True)
+            return await policy.call_async(asyncio.sleep, 0, 'ok', host='a')
+        self.assertEqual(asyncio.run(run()), 'ok')
+
+        def interrupted():
+            raise KeyboardInterrupt
+        policy.failure('b', status_error(500))
+        time.sleep(0.06)
+        with self.assertRaises(KeyboardInterrupt):
+            policy.call(interrupted, host='b')
+        self.assertEqual(policy.call(lambda: 'ok', host='b'), 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
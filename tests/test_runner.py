@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from benchmarks.servers import FakeServers
+from better_bing_image_downloader import runner
+from better_bing_image_downloader.bing import Bing
+from better_bing_image_downloader.seen import FingerprintSet, load_seen
+
+
+def use_bing(url):
+    Bing.base_url = url
+
+
+def crash_on(url, keyword):
+    """ Point Bing at url, and kill the worker the first time it starts keyword. """
+    Bing.base_url = url
+    marker = os.path.join(tempfile.gettempdir(), 'runner-crash-%d' % os.getppid())
+    real = Bing.get_image_candidates
+
+    async def get_image_candidates(self, session=None):
+        if self.query == keyword and not os.path.exists(marker):
+            open(marker, 'w').close()
+            os._exit(1)
+        async for candidate in real(self, session):
+            yield candidate
+    Bing.get_image_candidates = get_image_candidates
+
+
+def urls_per_keyword(url):
+    """ Point Bing at url, giving every keyword urls of its own. """
+    Bing.base_url = url
+    real = Bing.get_image_candidates
+
+    async def get_image_candidates(self, session=None):
+        async for candidate in real(self, session):
+            yield candidate._replace(url='%s?k=%s' % (candidate.url, self.query))
+    Bing.get_image_candidates = get_image_candidates
+
+
+class TestShardedRunner(unittest.TestCase):
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.servers = FakeServers(images=40, hosts=2).start()
+
+    def tearDown(self):
+        self.servers.stop()
+        shutil.rmtree(self.output_dir)
+        marker = os.path.join(tempfile.gettempdir(), 'runner-crash-%d' % os.getpid())
+        if os.path.exists(marker):
+            os.remove(marker)
+
+    def make_runner(self, keywords, **kwargs):
+        options = dict(output_dir=self.output_dir, workers=2, query_concurrency=2, limit=3, dedup=False,
+                       page_rate=None, initializer=use_bing, initargs=(self.servers.bing_url,))
+        options.update(kwargs)
+        return runner.ShardedRunner(keywords, **options)
+
+    def test_run_and_resume(self):
+        keywords = ['k%d' % i for i in range(6)]
+        progress = []
+        summary = self.make_runner(keywords, progress=progress.append, progress_interval=0.1).run()
+        self.assertEqual((summary.completed, summary.errors, summary.downloaded), (6, 0, 18))
+        self.assertGreater(summary.bytes, 0)
+        self.assertFalse(summary.interrupted)
+        for keyword in keywords:
+            self.assertEqual(len(os.listdir(os.path.join(self.output_dir, keyword))), 4)  # 3 images + journal
+        with open(os.path.join(self.output_dir, runner.STATE_FILE)) as f:
+            shards = {json.loads(line)['shard'] for line in f}
+        self.assertEqual(shards, {0, 1})
+
+        summary = self.make_runner(keywords + ['k6']).run()
+        self.assertEqual((summary.skipped, summary.completed, summary.downloaded), (6, 1, 3))
+
+    def test_dead_worker_is_restarted(self):
+        keywords = ['k%d' % i for i in range(4)]
+        summary = self.make_runner(keywords, initializer=crash_on, initargs=(self.servers.bing_url, 'k1')).run()
+        self.assertEqual(summary.restarts, 1)
+        self.assertEqual((summary.completed, summary.downloaded), (4, 12))
+
+    def test_shutdown_finishes_queries_under_way(self):
+        keywords = ['k%d' % i for i in range(40)]
+        job = self.make_runner(keywords, workers=1, query_concurrency=1, progress_interval=0.01,
+                               progress=lambda summary: summary.completed and job.shutdown())
+        summary = job.run()
+        self.assertTrue(summary.interrupted)
+        self.assertLess(summary.completed, 40)
+        self.assertEqual(len(runner.load_state(self.output_dir)), summary.completed)
+        summary = self.make_runner(keywords).run()
+        self.assertEqual(summary.completed + summary.skipped, 40)
+        self.assertFalse(summary.interrupted)
+
+    def test_workers_share_a_seen_file(self):
+        seen_path = os.path.join(self.output_dir, 'seen.bin')
+        manifest = os.path.join(self.output_dir, 'manifest.jsonl')
+        summary = self.make_runner(['k%d' % i for i in range(4)], seen=seen_path, manifest=manifest,
+                                   initializer=urls_per_keyword).run()
+        self.assertEqual(summary.errors, 0)
+        saved = set()
+        for shard in range(2):
+            with open(runner._shard_path(manifest, shard)) as f:
+                saved.update(json.loads(line)['url'] for line in f)
+        self.assertEqual(len(saved), summary.downloaded)
+        # Both workers' urls are in the file, not just the last one to finish.
+        seen = load_seen(seen_path)
+        self.assertEqual(len(seen), len(saved))
+        self.assertTrue(all(url in seen for url in saved))
+
+        with self.assertRaises(ValueError):
+            self.make_runner(['k0'], seen=FingerprintSet())
+        with self.assertRaises(ValueError):
+            self.make_runner(['k0'], seen=seen_path, seen_error_rate=0.001)
+
+    def test_read_keywords(self):
+        path = os.path.join(self.output_dir, 'keywords.txt')
+        with open(path, 'w') as f:
+            f.write('cats\n\n# comment\ndogs \ncats\n')
+        self.assertEqual(runner.read_keywords(path), ['cats', 'dogs'])
+
+
+if __name__ == '__main__':
+    unittest.main()
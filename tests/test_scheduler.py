@@ -0,0 +1,77 @@
+import asyncio
+import unittest
+
+from better_bing_image_downloader.scheduler import AsyncHostScheduler, FairShare, HostScheduler, host_of
+
+
+class TestHostScheduler(unittest.TestCase):
+    def test_saturated_host_does_not_block_others(self):
+        scheduler = HostScheduler(per_host=1)
+        for url in ['http://a.com/1', 'http://a.com/2', 'http://b.com/1']:
+            scheduler.put(url)
+        scheduler.close()
+        first = scheduler.get()
+        second = scheduler.get()
+        self.assertEqual((host_of(first), host_of(second)), ('a.com', 'b.com'))
+        scheduler.release(first)
+        self.assertEqual(scheduler.get(), 'http://a.com/2')
+        self.assertIsNone(scheduler.get())
+
+    def test_async_host_rate(self):
+        async def run():
+            scheduler = AsyncHostScheduler(per_host=10, host_rate=20)
+            for i in range(3):
+                await scheduler.put('http://a.com/%d' % i)
+            await scheduler.put('http://b.com/0')
+            await scheduler.close()
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            order = []
+            while True:
+                url = await scheduler.get()
+                if url is None:
+                    break
+                order.append(url)
+            return order, loop.time() - start
+
+        order, elapsed = asyncio.run(run())
+        self.assertEqual(order[:2], ['http://a.com/0', 'http://b.com/0'])
+        self.assertGreaterEqual(elapsed, 0.09)
+
+    def test_busy_host_does_not_keep_others_out_of_the_queue(self):
+        async def run():
+            scheduler = AsyncHostScheduler(maxsize=4, per_host=1)
+            for i in range(4):
+                await scheduler.put('http://a.com/%d' % i)
+            busy = await scheduler.get()
+            await scheduler.put('http://a.com/4')
+            await asyncio.wait_for(scheduler.put('http://b.com/0'), 1)
+            return busy, await asyncio.wait_for(scheduler.get(), 1)
+
+        self.assertEqual(asyncio.run(run()), ('http://a.com/0', 'http://b.com/0'))
+
+
+class TestFairShare(unittest.TestCase):
+    def test_slots_alternate_between_owners(self):
+        async def run():
+            fair = FairShare(1)
+            order = []
+
+            async def request(owner):
+                async with fair.slot(owner):
+                    order.append(owner)
+                    await asyncio.sleep(0)
+
+            await fair.acquire('big')
+            tasks = [asyncio.ensure_future(request('big')) for _ in range(4)]
+            tasks.append(asyncio.ensure_future(request('small')))
+            await asyncio.sleep(0)
+            fair.release()
+            await asyncio.gather(*tasks)
+            return order
+
+        self.assertEqual(asyncio.run(run())[:2], ['big', 'small'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from better_bing_image_downloader.seen import (BloomFilter, FingerprintSet, load_seen, normalize_url,
+                                               open_seen, save_seen)
+
+
+class TestNormalizeUrl(unittest.TestCase):
+    def test_equivalent_urls(self):
+        urls = ['https://Example.com/a.jpg?b=2&a=1',
+                'http://example.com:80/a.jpg?a=1&b=2&utm_source=x',
+                'https://example.com:443/a.jpg?fbclid=y&a=1&b=2#top']
+        self.assertEqual({normalize_url(url) for url in urls}, {'//example.com/a.jpg?a=1&b=2'})
+
+    def test_distinct_urls(self):
+        self.assertNotEqual(normalize_url('https://example.com/a.jpg'), normalize_url('https://example.com/A.jpg'))
+        self.assertNotEqual(normalize_url('https://example.com:8443/a.jpg'), normalize_url('https://example.com/a.jpg'))
+        self.assertNotEqual(normalize_url('https://example.com/a.jpg?id=1'), normalize_url('https://example.com/a.jpg'))
+
+
+class TestSeenSets(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_fingerprint_set(self):
+        seen = FingerprintSet(capacity=4)
+        urls = ['https://example.com/%d.jpg' % i for i in range(1000)]
+        self.assertTrue(all(seen.add(url) for url in urls))
+        self.assertFalse(seen.add('http://example.com/5.jpg?utm_medium=email'))
+        self.assertEqual(len(seen), 1000)
+        self.assertTrue(all(url in seen for url in urls))
+        self.assertNotIn('https://example.com/1000.jpg', seen)
+        self.assertLessEqual(seen.nbytes, 16 * 1024 * 2)
+
+        path = os.path.join(self.dir, 'seen')
+        seen.save(path)
+        loaded = load_seen(path)
+        self.assertIsInstance(loaded, FingerprintSet)
+        self.assertEqual(len(loaded), 1000)
+        self.assertIn(urls[-1], loaded)
+        self.assertTrue(loaded.add('https://example.com/1000.jpg'))
+
+    def test_bloom_filter(self):
+        seen = BloomFilter(capacity=2000, error_rate=0.01)
+        for i in range(2000):
+            seen.add('https://example.com/%d.jpg' % i)
+        self.assertTrue(all('https://example.com/%d.jpg' % i in seen for i in range(2000)))
+        false_positives = sum('https://example.org/%d.jpg' % i in seen for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+        path = os.path.join(self.dir, 'seen')
+        seen.save(path)
+        loaded = load_seen(path)
+        self.assertIsInstance(loaded, BloomFilter)
+        self.assertEqual((loaded.size, loaded.hashes, len(loaded)), (seen.size, seen.hashes, len(seen)))
+        self.assertIn('https://example.com/7.jpg', loaded)
+
+    def test_open_seen(self):
+        path = os.path.join(self.dir, 'seen')
+        self.assertIsInstance(open_seen(path), FingerprintSet)
+        bloom = open_seen(path, error_rate=0.001, capacity=100)
+        self.assertIsInstance(bloom, BloomFilter)
+        bloom.add('https://example.com/a.jpg')
+        bloom.save(path)
+        self.assertIn('https://example.com/a.jpg', open_seen(path))
+        self.assertIsInstance(open_seen(path, error_rate=0.1), BloomFilter)
+        other = os.path.join(self.dir, 'other')
+        FingerprintSet().save(other)
+        with self.assertRaises(ValueError):
+            open_seen(other, error_rate=0.001)
+
+    def test_save_merges_other_writers(self):
+        path = os.path.join(self.dir, 'seen')
+        FingerprintSet().save(path)
+        first, second = load_seen(path), load_seen(path)
+        first.add('https://example.com/1.jpg')
+        second.add('https://example.com/2.jpg')
+        save_seen(first, path)
+        save_seen(second, path)
+        merged = load_seen(path)
+        self.assertEqual(len(merged), 2)
+        self.assertIn('https://example.com/1.jpg', merged)
+
+        bloom_path = os.path.join(self.dir, 'bloom')
+        BloomFilter(100, 0.01).save(bloom_path)
+        first, second = load_seen(bloom_path), load_seen(bloom_path)
+        first.add('https://example.com/1.jpg')
+        second.add('https://example.com/2.jpg')
+        save_seen(first, bloom_path)
+        save_seen(second, bloom_path)
+        merged = load_seen(bloom_path)
+        self.assertEqual(len(merged), 2)
+        self.assertIn('https://example.com/1.jpg', merged)
+        with self.assertRaises(ValueError):
+            save_seen(FingerprintSet(), bloom_path)
+
+    def test_load_rejects_other_files(self):
+        path = os.path.join(self.dir, 'other')
+        with open(path, 'wb') as f:
+            f.write(b'not a seen-set')
+        with self.assertRaises(ValueError):
+            load_seen(path)
+
+
+if __name__ == '__main__':
+    unittest.main()
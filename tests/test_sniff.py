@@ -0,0 +1,31 @@
+import io
+import unittest
+
+from PIL import Image
+
+from better_bing_image_downloader.sniff import NotAnImage, check_head, extension, sniff_format
+
+
+def encode(fmt):
+    buf = io.BytesIO()
+    Image.new('RGB', (4, 4)).save(buf, fmt)
+    return buf.getvalue()[:32]
+
+
+class TestSniff(unittest.TestCase):
+    def test_formats(self):
+        for fmt, expected in [('JPEG', 'jpeg'), ('PNG', 'png'), ('GIF', 'gif'), ('WEBP', 'webp'),
+                              ('BMP', 'bmp'), ('TIFF', 'tiff'), ('ICO', 'ico')]:
+            self.assertEqual(sniff_format(encode(fmt)), expected)
+        self.assertEqual(sniff_format(b'\x00\x00\x00\x1cftypavif' + b'\x00' * 20), 'avif')
+        self.assertEqual(extension('jpeg'), 'jpg')
+
+    def test_markup_is_rejected(self):
+        with self.assertRaisesRegex(NotAnImage, 'markup'):
+            check_head(b'  <!DOCTYPE html><html><head>')
+        with self.assertRaisesRegex(NotAnImage, 'unknown'):
+            check_head(b'\x00\x01\x02\x03')
+
+
+if __name__ == '__main__':
+    unittest.main()
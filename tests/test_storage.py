@@ -0,0 +1,81 @@
+import os
+import tarfile
+import tempfile
+import unittest
+
+from better_bing_image_downloader.dedup import DedupIndex
+from better_bing_image_downloader.storage import (DirectoryBackend, TarShardBackend, load_shard_index, location_exists,
+                                                  read_member)
+
+
+class TestTarShardBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, body):
+        fd, path = tempfile.mkstemp(dir=self.dir, prefix='.', suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(body)
+        return path
+
+    def test_rolls_shards_and_indexes_offsets(self):
+        bodies = {'Image_{}.jpg'.format(i): os.urandom(3000) for i in range(5)}
+        backend = TarShardBackend(self.dir, shard_size=8000)
+        locations = [backend.store(self.write(body), name) for name, body in bodies.items()]
+        backend.close()
+
+        shards = sorted(name for name in os.listdir(self.dir) if name.endswith('.tar'))
+        self.assertEqual(shards, ['shard-00000.tar', 'shard-00001.tar'])
+        self.assertFalse([name for name in os.listdir(self.dir) if name.endswith('.part')])
+        self.assertTrue(all(location_exists(location) for location in locations))
+
+        index = load_shard_index(self.dir)
+        self.assertEqual(set(index), set(bodies))
+        for name, body in bodies.items():
+            self.assertEqual(read_member(*index[name]), body)
+            with tarfile.open(index[name][0]) as tar:
+                self.assertEqual(tar.extractfile(name).read(), body)
+
+    def test_new_run_starts_new_shard(self):
+        for run in range(2):
+            backend = TarShardBackend(self.dir)
+            backend.store(self.write(b'x' * 10), 'Image_{}.jpg'.format(run))
+            backend.close()
+        self.assertEqual(sorted(load_shard_index(self.dir).values())[1][0],
+                         os.path.join(self.dir, 'shard-00001.tar'))
+
+    def test_names_taken_by_earlier_runs(self):
+        backend = TarShardBackend(self.dir)
+        backend.store(self.write(b'x' * 10), 'Image_0.jpg')
+        self.assertTrue(backend.taken('Image_0'))
+        backend.close()
+        backend = TarShardBackend(self.dir)
+        self.assertTrue(backend.taken('Image_0'))
+        self.assertFalse(backend.taken('Image_1'))
+        backend.close()
+
+        directory = DirectoryBackend(self.dir)
+        directory.store(self.write(b'x'), 'Image_5.png')
+        self.assertTrue(DirectoryBackend(self.dir).taken('Image_5'))
+        self.assertFalse(directory.taken('Image_0'))
+
+    def test_dedup_sees_shard_members(self):
+        backend = TarShardBackend(self.dir)
+        location = backend.store(self.write(b'x' * 10), 'Image_0.jpg')
+        backend.close()
+        index = DedupIndex(self.dir)
+        try:
+            index.add('abc', location)
+            self.assertEqual(index.find('abc'), location)
+            os.remove(location.partition('::')[0])
+            self.assertIsNone(index.find('abc'))
+        finally:
+            index.close()
+
+
+if __name__ == '__main__':
+    unittest.main()